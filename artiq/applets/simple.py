@@ -10,6 +10,8 @@ from sipyco.sync_struct import Subscriber, process_mod
 from sipyco import pyon
 from sipyco.pipe_ipc import AsyncioChildComm
 
+from artiq.tools import filtered_notifier_name
+
 
 logger = logging.getLogger(__name__)
 
@@ -197,17 +199,46 @@ class SimpleApplet:
         else:
             self.emit_data_changed(self.data, [mod])
 
+    async def subscribe_master(self, filtered=True):
+        if filtered:
+            # Only the datasets of the applet are sent by the master.
+            notifier_name = filtered_notifier_name(
+                "datasets", {d for d in self.datasets if d is not None})
+        else:
+            notifier_name = "datasets"
+        initialized = False
+
+        def sub_init(data):
+            nonlocal initialized
+            initialized = True
+            return self.sub_init(data)
+
+        def disconnect_cb():
+            # Masters that do not support filtered subscriptions close the
+            # connection without sending anything.
+            if filtered and not initialized and not self.unsubscribing:
+                logger.info("master rejected filtered subscription, "
+                            "subscribing to all datasets")
+                asyncio.ensure_future(self.resubscribe_master())
+
+        self.subscriber = Subscriber(notifier_name, sub_init, self.sub_mod,
+                                     disconnect_cb=disconnect_cb)
+        await self.subscriber.connect(self.args.server, self.args.port)
+
+    async def resubscribe_master(self):
+        await self.subscriber.close()
+        await self.subscribe_master(filtered=False)
+
     def subscribe(self):
         if self.embed is None:
-            self.subscriber = Subscriber("datasets",
-                                         self.sub_init, self.sub_mod)
-            self.loop.run_until_complete(self.subscriber.connect(
-                self.args.server, self.args.port))
+            self.unsubscribing = False
+            self.loop.run_until_complete(self.subscribe_master())
         else:
             self.ipc.subscribe(self.datasets, self.sub_init, self.sub_mod)
 
     def unsubscribe(self):
         if self.embed is None:
+            self.unsubscribing = True
             self.loop.run_until_complete(self.subscriber.close())
 
     def run(self):
@@ -0,0 +1,207 @@
+"""
+In-process manipulation of the ELF shared libraries produced for kernels.
+
+:func:`strip_debug` is equivalent to ``llvm-strip --strip-debug`` for the
+libraries linked with ``kernel.ld``, without the temporary files and the
+process spawn. It raises :class:`UnsupportedELF` on any input it is not
+certain to handle, in which case the external tool should be used.
+"""
+
+import struct
+
+
+class UnsupportedELF(Exception):
+    pass
+
+
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+SHF_ALLOC = 0x2
+
+SHT_NULL = 0
+SHT_SYMTAB = 2
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_DYNSYM = 11
+SHT_GROUP = 17
+SHT_SYMTAB_SHNDX = 18
+
+_formats = {
+    # class: (header, section header, symbol, st_shndx offset in symbol)
+    1: ("HHIIIIIHHHHHH", "IIIIIIIIII", "IIIBBH", 14),
+    2: ("HHIQQQIHHHHHH", "IIQQQQIIQQ", "IBBHQQ", 6),
+}
+
+_header_fields = ["type", "machine", "version", "entry", "phoff", "shoff",
+                  "flags", "ehsize", "phentsize", "phnum", "shentsize",
+                  "shnum", "shstrndx"]
+_section_fields = ["name", "type", "flags", "addr", "offset", "size",
+                   "link", "info", "addralign", "entsize"]
+
+
+class _ELF:
+    def __init__(self, data):
+        if data[:4] != b"\x7fELF":
+            raise UnsupportedELF("not an ELF file")
+        elf_class, encoding = data[4], data[5]
+        if elf_class not in _formats or encoding not in (1, 2):
+            raise UnsupportedELF("unknown ELF class or data encoding")
+        self.data = data
+        self.endian = "<" if encoding == 1 else ">"
+        header_format, section_format, symbol_format, self.shndx_offset = \
+            _formats[elf_class]
+        self.header_struct = struct.Struct(self.endian + header_format)
+        self.section_struct = struct.Struct(self.endian + section_format)
+        self.symbol_size = struct.calcsize(self.endian + symbol_format)
+
+        self.header = dict(zip(_header_fields,
+                               self.header_struct.unpack_from(data, 16)))
+        if (self.header["shnum"] == 0
+                or self.header["shstrndx"] >= SHN_LORESERVE
+                or self.header["shentsize"] != self.section_struct.size):
+            raise UnsupportedELF("unsupported section header table")
+        self.sections = [
+            dict(zip(_section_fields, self.section_struct.unpack_from(
+                data, self.header["shoff"] + i*self.section_struct.size)))
+            for i in range(self.header["shnum"])]
+        shstrtab = self.sections[self.header["shstrndx"]]
+        for section in self.sections:
+            name = data[shstrtab["offset"] + section["name"]:]
+            section["name_str"] = name[:name.index(b"\0")].decode()
+
+    def section_data(self, section):
+        if section["type"] == SHT_NOBITS:
+            return b""
+        return self.data[section["offset"]:
+                         section["offset"] + section["size"]]
+
+
+def _is_debug(section):
+    return (not section["flags"] & SHF_ALLOC
+            and section["name_str"].startswith((".debug", ".zdebug")))
+
+
+def _align(offset, alignment):
+    if alignment > 1:
+        offset += -offset % alignment
+    return offset
+
+
+def strip_debug(library):
+    """Returns ``library`` without its debug sections."""
+    elf = _ELF(library)
+    sections = elf.sections
+
+    removed = {i for i, section in enumerate(sections)
+               if _is_debug(section)}
+    for i, section in enumerate(sections):
+        if section["type"] in (SHT_GROUP, SHT_SYMTAB_SHNDX):
+            raise UnsupportedELF("unsupported section type")
+        if (section["type"] in (SHT_REL, SHT_RELA)
+                and section["info"] in removed):
+            if section["flags"] & SHF_ALLOC:
+                raise UnsupportedELF("allocated relocations of debug "
+                                     "section")
+            removed.add(i)
+    if not removed:
+        return library
+    if elf.header["shstrndx"] in removed:
+        raise UnsupportedELF("section names in a debug section")
+
+    index_map = dict()
+    for i in range(len(sections)):
+        if i not in removed:
+            index_map[i] = len(index_map)
+
+    def map_index(index):
+        if index == 0 or index >= SHN_LORESERVE:
+            return index
+        if index in removed:
+            return None
+        return index_map[index]
+
+    # Allocated sections and the program headers keep their offsets, and the
+    # other sections are laid out again after them.
+    output = bytearray()
+    end = elf.header_struct.size + 16
+    if elf.header["phnum"]:
+        end = max(end, elf.header["phoff"]
+                  + elf.header["phnum"]*elf.header["phentsize"])
+    for section in sections:
+        if section["flags"] & SHF_ALLOC and section["type"] != SHT_NOBITS:
+            end = max(end, section["offset"] + section["size"])
+    output += library[:end]
+
+    new_sections = []
+    for i, section in enumerate(sections):
+        if i in removed:
+            continue
+        section = dict(section)
+        content = elf.section_data(section)
+        if section["type"] in (SHT_SYMTAB, SHT_DYNSYM):
+            content, section["info"] = _remap_symbols(
+                elf, section, content, map_index)
+            if len(content) != section["size"] and any(
+                    other["type"] in (SHT_REL, SHT_RELA)
+                    and other["link"] == i
+                    for j, other in enumerate(sections) if j not in removed):
+                raise UnsupportedELF("relocations against removed symbols")
+            if section["flags"] & SHF_ALLOC:
+                output[section["offset"]:section["offset"] + len(content)] = \
+                    content
+        if section["type"] != SHT_NULL:
+            section["link"] = map_index(section["link"])
+            if section["link"] is None:
+                raise UnsupportedELF("section linked to a debug section")
+            if section["type"] in (SHT_REL, SHT_RELA) and section["info"]:
+                section["info"] = map_index(section["info"])
+        if (not section["flags"] & SHF_ALLOC
+                and section["type"] not in (SHT_NULL, SHT_NOBITS)):
+            offset = _align(len(output), section["addralign"])
+            output += bytes(offset - len(output))
+            section["offset"] = offset
+            section["size"] = len(content)
+            output += content
+        new_sections.append(section)
+
+    shoff = _align(len(output), 8)
+    output += bytes(shoff - len(output))
+    for section in new_sections:
+        output += elf.section_struct.pack(
+            *(section[field] for field in _section_fields))
+
+    header = dict(elf.header)
+    header["shoff"] = shoff
+    header["shnum"] = len(new_sections)
+    header["shstrndx"] = index_map[elf.header["shstrndx"]]
+    output[16:16 + elf.header_struct.size] = elf.header_struct.pack(
+        *(header[field] for field in _header_fields))
+    return bytes(output)
+
+
+def _remap_symbols(elf, section, content, map_index):
+    # Returns the symbol table with the section indices remapped, and the
+    # new index of the first non-local symbol. Local symbols of removed
+    # sections are dropped.
+    size = elf.symbol_size
+    if section["entsize"] != size or len(content) % size:
+        raise UnsupportedELF("unsupported symbol table")
+    shndx_struct = struct.Struct(elf.endian + "H")
+    symbols = []
+    first_global = section["info"]
+    for i in range(len(content)//size):
+        symbol = bytearray(content[i*size:(i + 1)*size])
+        shndx, = shndx_struct.unpack_from(symbol, elf.shndx_offset)
+        if shndx == SHN_XINDEX:
+            raise UnsupportedELF("extended section indices")
+        new_shndx = map_index(shndx)
+        if new_shndx is None:
+            if i >= section["info"] or section["flags"] & SHF_ALLOC:
+                raise UnsupportedELF("symbol defined in a debug section")
+            first_global -= 1
+            continue
+        shndx_struct.pack_into(symbol, elf.shndx_offset, new_shndx)
+        symbols.append(bytes(symbol))
+    return b"".join(symbols), first_global
@@ -166,6 +166,17 @@ class EmbeddingMap:
                           self.object_forward_map.values()))
 
 
+# Lists and arrays of numbers with at least this many elements are embedded
+# in kernels as binary data rather than as synthesized literals.
+BINARY_QUOTE_THRESHOLD = 256
+
+_numeric_dtypes = {
+    numpy.int32: builtins.TInt32,
+    numpy.int64: builtins.TInt64,
+    numpy.float64: builtins.TFloat,
+}
+
+
 class ASTSynthesizer:
     def __init__(self, embedding_map, value_map, quote_function=None, expanded_from=None):
         self.source = ""
@@ -187,43 +198,36 @@ class ASTSynthesizer:
         return source.Range(self.source_buffer, range_from, range_to,
                             expanded_from=self.expanded_from)
 
+    @staticmethod
+    def _numeric_elt_type(value):
+        # Returns the element type of a list whose elements are all numbers
+        # of the same Python type, or None.
+        if len(value) == 0:
+            return None
+        v = value[0]
+        if isinstance(v, int):
+            T, typ = int, builtins.TInt
+        elif isinstance(v, float):
+            T, typ = float, builtins.TFloat
+        elif isinstance(v, numpy.int32):
+            T, typ = numpy.int32, builtins.TInt32
+        elif isinstance(v, numpy.int64):
+            T, typ = numpy.int64, builtins.TInt64
+        else:
+            return None
+        for v in value:
+            if not isinstance(v, T):
+                return None
+        return typ()
+
     def fast_quote_list(self, value):
         elts = [None] * len(value)
-        is_T = False
-        if len(value) > 0:
-            v = value[0]
-            is_T = True
-            if isinstance(v, int):
-                T = int
-            elif isinstance(v, float):
-                T = float
-            elif isinstance(v, numpy.int32):
-                T = numpy.int32
-            elif isinstance(v, numpy.int64):
-                T = numpy.int64
-            else:
-                is_T = False
-            if is_T:
-                for v in value:
-                    if not isinstance(v, T):
-                        is_T = False
-                        break
-        if is_T:
-            is_int = T != float
-            if T == int:
-                typ = builtins.TInt()
-            elif T == float:
-                typ = builtins.TFloat()
-            elif T == numpy.int32:
-                typ = builtins.TInt32()
-            elif T == numpy.int64:
-                typ = builtins.TInt64()
-            else:
-                assert False
+        typ = self._numeric_elt_type(value)
+        if typ is not None:
             text = [repr(elt) for elt in value]
             start = len(self.source)
             self.source += ", ".join(text)
-            if is_int:
+            if builtins.is_int(typ):
                 for i, (v, t) in enumerate(zip(value, text)):
                     l = len(t)
                     elts[i] = asttyped.NumT(
@@ -248,6 +252,25 @@ class ASTSynthesizer:
                     self._add(", ")
         return elts
 
+    def _quote_numeric_list(self, value, elt_type, constructor):
+        # Quotes a large list or 1-dimensional array of numbers as a copy of
+        # a single constant, which is emitted as binary data in the LLVM
+        # module, instead of as one literal per element.
+        callee_node = self.quote(constructor)
+        begin_loc   = self._add("(")
+        quote_loc   = self._add("`")
+        repr_loc    = self._add("<{} elements>".format(len(value)))
+        unquote_loc = self._add("`")
+        end_loc     = self._add(")")
+        arg_node    = asttyped.QuoteT(value=value, type=builtins.TList(elt_type),
+                                      loc=quote_loc.join(unquote_loc))
+        return asttyped.CallT(
+            func=callee_node, args=[arg_node], keywords=[],
+            starargs=None, kwargs=None,
+            type=types.TVar(), iodelay=None, arg_exprs={},
+            begin_loc=begin_loc, end_loc=end_loc, star_loc=None, dstar_loc=None,
+            loc=callee_node.loc.join(end_loc))
+
     def quote(self, value):
         """Construct an AST fragment equal to `value`."""
         if value is None:
@@ -271,6 +294,10 @@ class ASTSynthesizer:
             typ = builtins.fn_int64()
             return asttyped.NameConstantT(value=None, type=typ,
                                           loc=self._add("numpy.int64"))
+        elif value is list:
+            typ = builtins.fn_list()
+            return asttyped.NameConstantT(value=None, type=typ,
+                                          loc=self._add("list"))
         elif value is numpy.array:
             typ = builtins.fn_array()
             return asttyped.NameConstantT(value=None, type=typ,
@@ -308,6 +335,10 @@ class ASTSynthesizer:
 
             return asttyped.QuoteT(value=value, type=builtins.TByteArray(), loc=loc)
         elif isinstance(value, list):
+            if len(value) >= BINARY_QUOTE_THRESHOLD:
+                elt_type = self._numeric_elt_type(value)
+                if elt_type is not None:
+                    return self._quote_numeric_list(value, elt_type, list)
             begin_loc = self._add("[")
             elts = self.fast_quote_list(value)
             end_loc   = self._add("]")
@@ -323,6 +354,10 @@ class ASTSynthesizer:
                                    begin_loc=begin_loc, end_loc=end_loc,
                                    loc=begin_loc.join(end_loc))
         elif isinstance(value, numpy.ndarray):
+            if value.ndim == 1 and len(value) >= BINARY_QUOTE_THRESHOLD and \
+                    value.dtype.type in _numeric_dtypes:
+                return self._quote_numeric_list(
+                    value, _numeric_dtypes[value.dtype.type](), numpy.array)
             return self.call(numpy.array, [list(value)], {})
         elif inspect.isfunction(value) or inspect.ismethod(value) or \
                 isinstance(value, pytypes.BuiltinFunctionType) or \
@@ -743,6 +778,11 @@ class TypedtreeHasher(algorithm.Visitor):
             fields = fields + node._types
         return hash(tuple(freeze(getattr(node, field_name)) for field_name in fields))
 
+    def visit_QuoteT(self, node):
+        # The quoted value is a host object, which may be a large list;
+        # only its type can change.
+        return hash(node.type.find())
+
 class Stitcher:
     def __init__(self, core, dmgr, engine=None, print_as_rpc=True):
         self.core = core
@@ -768,7 +808,6 @@ class Stitcher:
 
         self.embedding_map = EmbeddingMap()
         self.value_map = defaultdict(lambda: [])
-        self.definitely_changed = False
 
     def stitch_call(self, function, args, kwargs, callback=None):
         # We synthesize source code for the initial call so that
@@ -784,24 +823,44 @@ class Stitcher:
                                          quote=self._quote)
         typedtree_hasher = TypedtreeHasher()
 
-        # Iterate inference to fixed point.
-        old_typedtree_hash = None
+        # Iterate inference to fixed point. The top-level nodes (quoted
+        # functions and the initial call) are only inferred again if they
+        # are new or their types have changed since the previous iteration.
+        # Once none are left, a pass over the whole tree confirms that the
+        # fixed point is reached.
+        #
+        # Likewise, only the nodes just inferred and the new nodes are hashed
+        # again; the hashes of the others are carried over. Unification may
+        # have changed the types of the latter too, but the full pass, which
+        # hashes every node, notices it.
+        node_hashes = {}
         old_attr_count = None
+        dirty = None  # all nodes
         while True:
-            inferencer.visit(self.typedtree)
-            if self.definitely_changed:
-                changed = True
-                self.definitely_changed = False
+            full_pass = dirty is None
+            visited = set()
+            for node in list(self.typedtree):
+                if full_pass or id(node) in dirty:
+                    inferencer.visit(node)
+                    visited.add(id(node))
+
+            changed = set()
+            for node in self.typedtree:
+                node_id = id(node)
+                if node_id in visited or node_id not in node_hashes:
+                    node_hash = typedtree_hasher.visit(node)
+                    if node_hashes.get(node_id) != node_hash:
+                        node_hashes[node_id] = node_hash
+                        changed.add(node_id)
+            attr_count = self.embedding_map.attribute_count()
+            if changed:
+                dirty = changed
+            elif old_attr_count != attr_count or not full_pass:
+                # Newly discovered attributes may affect any node.
+                dirty = None
             else:
-                typedtree_hash = typedtree_hasher.visit(self.typedtree)
-                attr_count = self.embedding_map.attribute_count()
-                changed = old_attr_count != attr_count or \
-                          old_typedtree_hash != typedtree_hash
-                old_typedtree_hash = typedtree_hash
-                old_attr_count = attr_count
-
-            if not changed:
                 break
+            old_attr_count = attr_count
 
         # After we've discovered every referenced attribute, check if any kernel_invariant
         # specifications refers to ones we didn't encounter.
@@ -929,9 +988,6 @@ class Stitcher:
             return types.TVar()
 
     def _quote_embedded_function(self, function, flags):
-        # we are now parsing new functions... definitely changed the type
-        self.definitely_changed = True
-
         if isinstance(function, SpecializedFunction):
             host_function = function.host_function
         else:
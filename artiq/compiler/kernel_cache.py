@@ -0,0 +1,119 @@
+"""
+The :class:`KernelCache` class keeps the shared libraries produced for
+kernels, so that calling a kernel again with the same code and embedded
+values skips LLVM optimization, machine code emission, linking and
+stripping.
+"""
+
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+from artiq import __version__ as artiq_version
+
+
+# Environment variables requesting dumps of the compilation stages skipped
+# on cache hits.
+_dump_variables = ["ARTIQ_DUMP_LLVM", "ARTIQ_DUMP_ASM", "ARTIQ_DUMP_OBJ",
+                   "ARTIQ_DUMP_ELF"]
+
+
+def _read_file(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+class KernelCache:
+    """Cache of kernel libraries, in memory and optionally on disk.
+
+    Entries are keyed by :meth:`key`, a hash of the unoptimized LLVM IR of
+    the kernel, of the target and of the ARTIQ version. The LLVM IR contains
+    everything the library depends on, including the values of the host
+    object attributes and of the kernel invariants that are embedded in it.
+
+    :param directory: directory storing the libraries across processes, or
+        ``None`` to keep them in memory only.
+    :param max_entries: number of most recently used libraries kept in
+        memory.
+    """
+    def __init__(self, directory=None, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def enabled():
+        """Returns whether the cache may be used, i.e. whether no dump of
+        the skipped compilation stages is requested."""
+        return not any(os.getenv(v) is not None for v in _dump_variables)
+
+    @staticmethod
+    def key(target, llvm_ir):
+        h = hashlib.sha256()
+        for part in (artiq_version,
+                     type(target).__module__, type(target).__qualname__,
+                     target.triple, ",".join(target.features), llvm_ir):
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _filenames(self, key):
+        return (os.path.join(self.directory, key + ".elf"),
+                os.path.join(self.directory, key + ".stripped.elf"))
+
+    def get(self, key):
+        """Returns the unstripped and the stripped library stored under
+        ``key``, or ``None``."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if self.directory is not None:
+            try:
+                entry = tuple(_read_file(filename)
+                              for filename in self._filenames(key))
+            except FileNotFoundError:
+                pass
+            else:
+                self._store(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, library, stripped_library):
+        self._store(key, (library, stripped_library))
+        if self.directory is not None:
+            # The stripped library is written last, as its presence marks
+            # a complete entry.
+            for filename, data in zip(self._filenames(key),
+                                      (library, stripped_library)):
+                with tempfile.NamedTemporaryFile(
+                        "wb", dir=self.directory, delete=False) as f:
+                    f.write(data)
+                    tmpname = f.name
+                os.replace(tmpname, filename)
+
+    def get_stats(self):
+        """Returns the numbers of cache hits (including those served from
+        disk) and misses."""
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses
+        }
@@ -1,5 +1,5 @@
 import os, sys, tempfile, subprocess, io
-from artiq.compiler import types, ir
+from artiq.compiler import types, ir, elf
 from llvmlite import ir as ll, binding as llvm
 
 llvm.initialize()
@@ -134,8 +134,8 @@ class Target:
 
         llpassmgr.run(llmodule)
 
-    def compile(self, module):
-        """Compile the module to a relocatable object for this target."""
+    def generate_llvm_ir(self, module):
+        """Generate the unoptimized LLVM IR of the module for this target."""
 
         if os.getenv("ARTIQ_DUMP_SIG"):
             print("====== MODULE_SIGNATURE DUMP ======", file=sys.stderr)
@@ -148,8 +148,14 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_IR"), "ARTIQ IR", ".txt",
               lambda: "\n".join(fn.as_entity(type_printer) for fn in module.artiq_ir))
 
-        llmod = module.build_llvm_ir(self)
+        return module.build_llvm_ir(self)
 
+    def compile(self, module):
+        """Compile the module to a relocatable object for this target."""
+        return self.compile_llvm_ir(self.generate_llvm_ir(module))
+
+    def compile_llvm_ir(self, llmod):
+        """Verify and optimize LLVM IR generated by :meth:`generate_llvm_ir`."""
         try:
             llparsedmod = llvm.parse_assembly(str(llmod))
             llparsedmod.verify()
@@ -198,7 +204,14 @@ class Target:
     def compile_and_link(self, modules):
         return self.link([self.assemble(self.compile(module)) for module in modules])
 
+    def compile_and_link_llvm_ir(self, llmods):
+        return self.link([self.assemble(self.compile_llvm_ir(llmod)) for llmod in llmods])
+
     def strip(self, library):
+        try:
+            return elf.strip_debug(library)
+        except elf.UnsupportedELF:
+            pass
         with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
                      library=library, output=None) \
                 as results:
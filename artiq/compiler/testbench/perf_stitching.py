@@ -0,0 +1,113 @@
+import sys, os, tempfile
+from pythonparser import diagnostic
+from ...tools import file_import
+from ...coredevice.core import Core
+from ..embedding import Stitcher
+from . import benchmark
+
+
+# A large synthetic experiment: a chain of kernel methods, each calling a
+# method of a different host object with its own attributes.
+_header = """
+from artiq.language.core import kernel
+
+
+"""
+
+_device = """
+class Device{i}:
+    kernel_invariants = {{"core", "scale"}}
+
+    def __init__(self, core):
+        self.core = core
+        self.scale = {i}
+        self.state = 0
+        self.history = [0.0]*4
+
+    @kernel
+    def step(self, x):
+        self.state += x*self.scale
+        self.history[self.state % 4] = float(x)
+        return self.state
+
+"""
+
+_experiment_header = """
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+"""
+
+_experiment_method = """
+    @kernel
+    def method{i}(self, x):
+        return self.device{i}.step(x) + self.method{next}(x + 1)
+"""
+
+_experiment_end = """
+    @kernel
+    def method{i}(self, x):
+        return x
+
+    @kernel
+    def run(self):
+        self.method0(0)
+"""
+
+
+def _generate(n):
+    code = _header
+    for i in range(n):
+        code += _device.format(i=i)
+    code += _experiment_header
+    for i in range(n):
+        code += "        self.device{i} = Device{i}(core)\n".format(i=i)
+    for i in range(n):
+        code += _experiment_method.format(i=i, next=i + 1)
+    code += _experiment_end.format(i=n)
+    return code
+
+
+class _DeviceManager:
+    def __init__(self):
+        self.core = None
+
+    def get(self, name):
+        return self.core
+
+
+def main():
+    if len(sys.argv) > 2:
+        print("Expected at most one argument (number of methods)",
+              file=sys.stderr)
+        exit(1)
+    n = int(sys.argv[1]) if len(sys.argv) == 2 else 200
+
+    def process_diagnostic(diag):
+        print("\n".join(diag.render()), file=sys.stderr)
+        if diag.level in ("fatal", "error"):
+            exit(1)
+
+    engine = diagnostic.Engine()
+    engine.process = process_diagnostic
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "synthetic_experiment.py")
+        with open(filename, "w") as f:
+            f.write(_generate(n))
+        module = file_import(filename)
+
+        dmgr = _DeviceManager()
+        core = dmgr.core = Core(dmgr, host=None, ref_period=1e-9)
+        experiment = module.Benchmark(core)
+
+        def embed():
+            stitcher = Stitcher(core=core, dmgr=dmgr, engine=engine)
+            stitcher.stitch_call(experiment.run, (), {})
+            stitcher.finalize()
+            return stitcher
+
+        benchmark(embed, "ARTIQ embedding ({} methods)".format(n))
+
+if __name__ == "__main__":
+    main()
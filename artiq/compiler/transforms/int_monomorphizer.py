@@ -1,7 +1,7 @@
 """
-:class:`IntMonomorphizer` collapses the integer literals of undetermined
-width to 32 bits, assuming they fit into 32 bits, or 64 bits if they
-do not.
+:class:`IntMonomorphizer` collapses the integer literals, and the quoted
+lists of integers, of undetermined width to 32 bits, assuming they fit
+into 32 bits, or 64 bits if they do not.
 """
 
 from pythonparser import algorithm, diagnostic
@@ -26,3 +26,21 @@ class IntMonomorphizer(algorithm.Visitor):
                     return
 
                 node.type["width"].unify(types.TValue(width))
+
+    def visit_QuoteT(self, node):
+        if builtins.is_list(node.type):
+            elt_type = builtins.get_iterable_elt(node.type)
+            if builtins.is_int(elt_type) and types.is_var(elt_type["width"]):
+                lo, hi = min(node.value), max(node.value)
+                if -2**31 < lo and hi < 2**31-1:
+                    width = 32
+                elif -2**63 < lo and hi < 2**63-1:
+                    width = 64
+                else:
+                    diag = diagnostic.Diagnostic("error",
+                        "quoted list element out of range for a signed 64-bit value", {},
+                        node.loc)
+                    self.engine.process(diag)
+                    return
+
+                elt_type["width"].unify(types.TValue(width))
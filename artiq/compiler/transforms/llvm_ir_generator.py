@@ -1558,8 +1558,45 @@ class LLVMIRGenerator:
 
         return llresult
 
+    def _quote_numeric_to_llglobal(self, value, elt_type, kind_name):
+        # Emits the elements of a large list or array of numbers as a single
+        # byte string, instead of one LLVM constant per element.
+        if builtins.is_float(elt_type):
+            dtype = "f8"
+        elif builtins.is_int(elt_type):
+            dtype = "i{}".format(builtins.get_int_width(elt_type)//8)
+        else:
+            return None
+        if self.llmodule.data_layout.startswith("E"):
+            dtype = ">" + dtype
+        else:
+            dtype = "<" + dtype
+        if (isinstance(value, numpy.ndarray) and
+                value.dtype.kind not in ("f" if dtype[1] == "f" else "iu")):
+            return None
+        try:
+            data = numpy.asarray(value, dtype=dtype)
+        except (OverflowError, TypeError, ValueError):
+            return None
+        if dtype[1] == "i" and not numpy.array_equal(data, value):
+            # values out of range were wrapped
+            return None
+
+        lleltsary = ll.Constant(ll.ArrayType(lli8, data.nbytes),
+                                bytearray(data.tobytes()))
+        name = self.llmodule.scope.deduplicate("quoted.{}".format(kind_name))
+        llglobal = ll.GlobalVariable(self.llmodule, lleltsary.type, name)
+        llglobal.initializer = lleltsary
+        llglobal.linkage = "private"
+        llglobal.align = data.itemsize
+        return llglobal.bitcast(self.llty_of_type(elt_type).as_pointer())
+
     def _quote_listish_to_llglobal(self, value, elt_type, path, kind_name):
         fail_msg = "at " + ".".join(path())
+        if len(value) >= 16:
+            lleltsptr = self._quote_numeric_to_llglobal(value, elt_type, kind_name)
+            if lleltsptr is not None:
+                return lleltsptr
         if len(value) > 0:
             if builtins.is_int(elt_type):
                 int_typ = (int, numpy.int32, numpy.int64)
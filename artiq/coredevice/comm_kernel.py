@@ -170,6 +170,9 @@ class CommKernelDummy:
     def check_system_info(self):
         pass
 
+    def close(self):
+        pass
+
 
 class CommKernel:
     warned_of_mismatch = False
@@ -1,5 +1,7 @@
 import os, sys
+import copy
 import numpy
+from functools import wraps
 
 from pythonparser import diagnostic
 
@@ -12,6 +14,7 @@ from artiq.language.units import *
 from artiq.compiler.module import Module
 from artiq.compiler.embedding import Stitcher
 from artiq.compiler.targets import RV32IMATarget, RV32GTarget, CortexA9Target
+from artiq.compiler.kernel_cache import KernelCache
 
 from artiq.coredevice.comm_kernel import CommKernel, CommKernelDummy
 # Import for side effects (creating the exception classes).
@@ -52,6 +55,68 @@ def rtio_get_counter() -> TInt64:
     raise NotImplementedError("syscall not simulated")
 
 
+def _is_value(value):
+    # Whether the value is plain data, which is copied to detect later
+    # modifications; other objects are compared by identity.
+    if isinstance(value, (bool, int, float, str, numpy.generic)):
+        return True
+    if isinstance(value, numpy.ndarray):
+        return value.dtype != object
+    if isinstance(value, (list, tuple)):
+        return all(_is_value(elem) for elem in value)
+    return False
+
+
+def _equal(a, b):
+    if isinstance(a, numpy.ndarray):
+        return (isinstance(b, numpy.ndarray) and a.dtype == b.dtype
+                and numpy.array_equal(a, b, equal_nan=a.dtype.kind in "fc"))
+    if isinstance(a, (list, tuple)):
+        return (type(a) is type(b) and len(a) == len(b)
+                and all(_equal(x, y) for x, y in zip(a, b)))
+    return type(a) is type(b) and (a == b or (a != a and b != b))  # NaN
+
+
+class _CompileTimeValues:
+    """Values a precompiled kernel depends on: its arguments and the kernel
+    invariants of the host objects it embeds."""
+    def __init__(self, args, kwargs, embedding_map):
+        self.values = []
+        for i, arg in enumerate(args):
+            self._add(("argument {}", i), lambda arg=arg: arg)
+        for name, arg in kwargs.items():
+            self._add(("argument '{}'", name), lambda arg=arg: arg)
+        for _, obj, typ in embedding_map.iter_objects():
+            for attr in getattr(typ, "constant_attributes", ()):
+                if attr in typ.attributes and hasattr(obj, attr):
+                    self._add(("kernel invariant '{}' of {!r}", attr, obj),
+                              lambda obj=obj, attr=attr: getattr(obj, attr))
+
+    def _add(self, description, get):
+        # description is a format string and its arguments
+        value = get()
+        if _is_value(value):
+            self.values.append((description, get, True, copy.deepcopy(value)))
+        else:
+            self.values.append((description, get, False, value))
+
+    def check(self):
+        for description, get, is_value, compiled in self.values:
+            try:
+                value = get()
+            except AttributeError:
+                unchanged = False
+            else:
+                if is_value:
+                    unchanged = _equal(compiled, value)
+                else:
+                    unchanged = compiled is value
+            if not unchanged:
+                raise ValueError("{} has changed since the kernel was "
+                                 "precompiled".format(
+                                     description[0].format(*description[1:])))
+
+
 class Core:
     """Core device driver.
 
@@ -65,13 +130,18 @@ class Core:
     :param ref_multiplier: ratio between the RTIO fine timestamp frequency
         and the RTIO coarse timestamp frequency (e.g. SERDES multiplication
         factor).
+    :param kernel_cache: directory in which compiled kernels are kept across
+        experiments (see :class:`~artiq.compiler.kernel_cache.KernelCache`).
+        Compiled kernels are always kept in memory, so that calling a kernel
+        again with the same embedded values does not compile it again.
     """
 
     kernel_invariants = {
         "core", "ref_period", "coarse_ref_period", "ref_multiplier",
     }
 
-    def __init__(self, dmgr, host, ref_period, ref_multiplier=8, target="rv32g"):
+    def __init__(self, dmgr, host, ref_period, ref_multiplier=8, target="rv32g",
+                 kernel_cache=None):
         self.ref_period = ref_period
         self.ref_multiplier = ref_multiplier
         if target == "rv32g":
@@ -88,6 +158,8 @@ class Core:
         else:
             self.comm = CommKernel(host)
 
+        self.kernel_cache = KernelCache(kernel_cache)
+
         self.first_run = True
         self.dmgr = dmgr
         self.core = self
@@ -111,8 +183,19 @@ class Core:
                 attribute_writeback=attribute_writeback)
             target = self.target_cls()
 
-            library = target.compile_and_link([module])
-            stripped_library = target.strip(library)
+            if self.kernel_cache.enabled():
+                llmod = target.generate_llvm_ir(module)
+                key = self.kernel_cache.key(target, str(llmod))
+                cached = self.kernel_cache.get(key)
+                if cached is None:
+                    library = target.compile_and_link_llvm_ir([llmod])
+                    stripped_library = target.strip(library)
+                    self.kernel_cache.set(key, library, stripped_library)
+                else:
+                    library, stripped_library = cached
+            else:
+                library = target.compile_and_link([module])
+                stripped_library = target.strip(library)
 
             return stitcher.embedding_map, stripped_library, \
                    lambda addresses: target.symbolize(library, addresses), \
@@ -120,6 +203,14 @@ class Core:
         except diagnostic.Error as error:
             raise CompileError(error.diagnostic) from error
 
+    def _run_compiled(self, kernel_library, embedding_map, symbolizer, demangler):
+        if self.first_run:
+            self.comm.check_system_info()
+            self.first_run = False
+        self.comm.load(kernel_library)
+        self.comm.run()
+        self.comm.serve(embedding_map, symbolizer, demangler)
+
     def run(self, function, args, kwargs):
         result = None
         @rpc(flags={"async"})
@@ -129,16 +220,49 @@ class Core:
 
         embedding_map, kernel_library, symbolizer, demangler = \
             self.compile(function, args, kwargs, set_result)
+        self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
+        return result
 
-        if self.first_run:
-            self.comm.check_system_info()
-            self.first_run = False
+    def precompile(self, function, *args, **kwargs):
+        """Precompile a kernel and return a callable that executes it on the
+        core device at a later time.
+
+        This allows the compilation to be done in ``prepare()``, while
+        another experiment may be using the core device, instead of in
+        ``run()``. The arguments of the kernel are given to this method, and
+        the returned callable takes no arguments. It returns the return
+        value of the kernel, and may be called several times.
+
+        Host object attributes are embedded with the values they have at
+        precompilation time, and modified values are not written back; use
+        RPCs to exchange up-to-date values with the host. When the callable
+        is called, :class:`ValueError` is raised if an argument or a
+        kernel invariant of an embedded object no longer has the value
+        it was compiled with.
+        """
+        if not hasattr(function, "artiq_embedded"):
+            raise ValueError("Argument is not a kernel")
 
-        self.comm.load(kernel_library)
-        self.comm.run()
-        self.comm.serve(embedding_map, symbolizer, demangler)
+        result = None
+        @rpc(flags={"async"})
+        def set_result(new_result):
+            nonlocal result
+            result = new_result
 
-        return result
+        embedding_map, kernel_library, symbolizer, demangler = \
+            self.compile(function, args, kwargs, set_result,
+                         attribute_writeback=False)
+        snapshot = _CompileTimeValues(args, kwargs, embedding_map)
+
+        @wraps(function)
+        def run_precompiled():
+            nonlocal result
+            snapshot.check()
+            result = None
+            self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
+            return result
+
+        return run_precompiled
 
     @portable
     def seconds_to_mu(self, seconds):
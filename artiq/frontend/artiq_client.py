@@ -33,6 +33,29 @@ def clear_screen():
         sys.stdout.write("\x1b[2J\x1b[H")
 
 
+def _add_submit_args(parser):
+    parser.add_argument("-p", "--pipeline", default="main", type=str,
+                        help="pipeline to run the experiment in "
+                             "(default: %(default)s)")
+    parser.add_argument("-P", "--priority", default=0, type=int,
+                        help="priority (higher value means sooner "
+                             "scheduling, default: %(default)s)")
+    parser.add_argument("-t", "--timed", default=None, type=str,
+                        help="set a due date for the experiment")
+    parser.add_argument("-f", "--flush", default=False,
+                        action="store_true",
+                        help="flush the pipeline before preparing "
+                        "the experiment")
+    parser.add_argument("-R", "--repository", default=False,
+                        action="store_true",
+                        help="use the experiment repository")
+    parser.add_argument("-r", "--revision", default=None,
+                        help="use a specific repository revision "
+                             "(defaults to head, ignored without -R)")
+    parser.add_argument("-c", "--class-name", default=None,
+                        help="name of the class to run")
+
+
 def get_argparser():
     parser = argparse.ArgumentParser(description="ARTIQ CLI client")
     parser.add_argument(
@@ -49,31 +72,23 @@ def get_argparser():
     subparsers.required = True
 
     parser_add = subparsers.add_parser("submit", help="submit an experiment")
-    parser_add.add_argument("-p", "--pipeline", default="main", type=str,
-                            help="pipeline to run the experiment in "
-                                 "(default: %(default)s)")
-    parser_add.add_argument("-P", "--priority", default=0, type=int,
-                            help="priority (higher value means sooner "
-                                 "scheduling, default: %(default)s)")
-    parser_add.add_argument("-t", "--timed", default=None, type=str,
-                            help="set a due date for the experiment")
-    parser_add.add_argument("-f", "--flush", default=False,
-                            action="store_true",
-                            help="flush the pipeline before preparing "
-                            "the experiment")
-    parser_add.add_argument("-R", "--repository", default=False,
-                            action="store_true",
-                            help="use the experiment repository")
-    parser_add.add_argument("-r", "--revision", default=None,
-                            help="use a specific repository revision "
-                                 "(defaults to head, ignored without -R)")
-    parser_add.add_argument("-c", "--class-name", default=None,
-                            help="name of the class to run")
+    _add_submit_args(parser_add)
     parser_add.add_argument("file", metavar="FILE",
                             help="file containing the experiment to run")
     parser_add.add_argument("arguments", metavar="ARGUMENTS", nargs="*",
                             help="run arguments")
 
+    parser_add_batch = subparsers.add_parser(
+        "submit-batch", help="submit several runs of an experiment at once")
+    _add_submit_args(parser_add_batch)
+    parser_add_batch.add_argument("file", metavar="FILE",
+                                  help="file containing the experiment "
+                                       "to run")
+    parser_add_batch.add_argument("arguments_file", metavar="ARGUMENTS_FILE",
+                                  help="PYON file containing a list with the "
+                                       "arguments of each run, as "
+                                       "dictionaries")
+
     parser_delete = subparsers.add_parser("delete",
                                           help="delete an experiment "
                                                "from the schedule")
@@ -126,12 +141,7 @@ def get_argparser():
     return parser
 
 
-def _action_submit(remote, args):
-    try:
-        arguments = parse_arguments(args.arguments)
-    except Exception as err:
-        raise ValueError("Failed to parse run arguments") from err
-
+def _get_expid(args, arguments):
     expid = {
         "log_level": logging.WARNING + args.quiet*10 - args.verbose*10,
         "file": args.file,
@@ -140,15 +150,40 @@ def _action_submit(remote, args):
     }
     if args.repository:
         expid["repo_rev"] = args.revision
+    return expid
+
+
+def _get_due_date(args):
     if args.timed is None:
-        due_date = None
+        return None
     else:
-        due_date = time.mktime(parse_date(args.timed).timetuple())
-    rid = remote.submit(args.pipeline, expid,
-                        args.priority, due_date, args.flush)
+        return time.mktime(parse_date(args.timed).timetuple())
+
+
+def _action_submit(remote, args):
+    try:
+        arguments = parse_arguments(args.arguments)
+    except Exception as err:
+        raise ValueError("Failed to parse run arguments") from err
+
+    rid = remote.submit(args.pipeline, _get_expid(args, arguments),
+                        args.priority, _get_due_date(args), args.flush)
     print("RID: {}".format(rid))
 
 
+def _action_submit_batch(remote, args):
+    try:
+        arguments_list = pyon.load_file(args.arguments_file)
+    except Exception as err:
+        raise ValueError("Failed to parse run arguments") from err
+
+    expids = [_get_expid(args, arguments) for arguments in arguments_list]
+    rids = remote.submit_batch(args.pipeline, expids,
+                               args.priority, _get_due_date(args), args.flush)
+    for rid in rids:
+        print("RID: {}".format(rid))
+
+
 def _action_delete(remote, args):
     if args.g:
         remote.request_termination(args.rid)
@@ -304,6 +339,7 @@ def main():
         port = 3251 if args.port is None else args.port
         target_name = {
             "submit": "master_schedule",
+            "submit_batch": "master_schedule",
             "delete": "master_schedule",
             "set_dataset": "master_dataset_db",
             "del_dataset": "master_dataset_db",
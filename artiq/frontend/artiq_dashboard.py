@@ -193,7 +193,23 @@ def main():
 
     logmgr = log.LogDockManager(main_window)
     smgr.register(logmgr)
-    broadcast_clients["log"].notify_cbs.append(logmgr.append_message)
+    # show the messages logged before we connected, without repeating
+    # those that were also received live in the meantime
+    log_history = Client(args.server, args.port_control, "master_log")
+    try:
+        history = log_history.get_messages()
+    finally:
+        log_history.close_rpc()
+    for msg in history:
+        logmgr.append_message(msg)
+    history = set(tuple(msg) for msg in history)
+    def append_live_message(msg):
+        if history:
+            if tuple(msg) in history:
+                return
+            history.clear()
+        logmgr.append_message(msg)
+    broadcast_clients["log"].notify_cbs.append(append_live_message)
     widget_log_handler.callback = logmgr.append_message
 
     # lay out docks
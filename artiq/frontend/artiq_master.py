@@ -6,19 +6,21 @@ import atexit
 import logging
 
 from sipyco.pc_rpc import Server as RPCServer
-from sipyco.sync_struct import Publisher
 from sipyco.logging_tools import Server as LoggingServer
 from sipyco.broadcast import Broadcaster
 from sipyco import common_args
 from sipyco.asyncio_tools import atexit_register_coroutine
 
 from artiq import __version__ as artiq_version
-from artiq.master.log import log_args, init_log
+from artiq.master.log import log_args, init_log, LogHistory
+from artiq.master.publisher import Publisher
 from artiq.master.databases import DeviceDB, DatasetDB
 from artiq.master.scheduler import Scheduler
+from artiq.master.worker import WorkerPool, StickyWorkers
+from artiq.master.metrics import MetricsServer
 from artiq.master.rid_counter import RIDCounter
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
-                                      ExperimentDB)
+                                      ExperimentDB, ExamineCache)
 
 logger = logging.getLogger(__name__)
 
@@ -36,16 +38,36 @@ def get_argparser():
         ("broadcast", "broadcasts", 1067)
     ])
 
+    parser.add_argument(
+        "--port-metrics", type=int, default=None,
+        help=("TCP port to serve scheduler metrics on, in the Prometheus "
+              "text format at /metrics (default: disabled)"))
+
     group = parser.add_argument_group("databases")
     group.add_argument("--device-db", default="device_db.py",
                        help="device database file (default: '%(default)s')")
     group.add_argument("--dataset-db", default="dataset_db.pyon",
                        help="dataset file (default: '%(default)s')")
+    group.add_argument("--dataset-db-journal", default=False,
+                       action="store_true",
+                       help="save changes to persistent datasets to a "
+                            "journal file instead of rewriting the dataset "
+                            "file")
 
     group = parser.add_argument_group("repository")
     group.add_argument(
         "-g", "--git", default=False, action="store_true",
         help="use the Git repository backend")
+    group.add_argument(
+        "--git-object-cache", default=None,
+        help=("with the Git backend, directory storing file contents once "
+              "across revisions, from which checkouts are hard-linked "
+              "(default: full checkouts)"))
+    group.add_argument(
+        "--git-object-cache-max-size", default=None, type=int,
+        help=("maximum size of the Git object cache in MiB, beyond which the "
+              "least recently used files not in any checkout are deleted "
+              "(default: unlimited)"))
     group.add_argument(
         "-r", "--repository", default="repository",
         help="path to the repository (default: '%(default)s')")
@@ -53,6 +75,61 @@ def get_argparser():
         "--experiment-subdir", default="",
         help=("path to the experiment folder from the repository root "
               "(default: '%(default)s')"))
+    group.add_argument(
+        "--scan-workers", type=int, default=1,
+        help=("number of worker processes examining experiment files "
+              "during repository scans. Values above 1 examine files in "
+              "parallel, which is faster for large repositories but imports "
+              "several experiment files at the same time "
+              "(default: %(default)d)"))
+    group.add_argument(
+        "--examine-cache", default=None,
+        help=("file in which to cache the results of examining experiment "
+              "files, so that repository scans only examine new or modified "
+              "files (default: no cache)"))
+    group.add_argument(
+        "--explist-cache", default=None,
+        help=("file in which to store the list of experiments found by "
+              "repository scans, so that it is available immediately when "
+              "the master starts while the repository is scanned again in "
+              "the background (default: no cache)"))
+
+    group = parser.add_argument_group("scheduler")
+    group.add_argument(
+        "--max-concurrent-prepare", type=int, default=1,
+        help=("maximum number of runs of each pipeline that are built and "
+              "prepared at the same time (default: %(default)d)"))
+    group.add_argument(
+        "--max-concurrent-analyze", type=int, default=1,
+        help=("maximum number of runs of each pipeline that are analyzed "
+              "at the same time (default: %(default)d)"))
+
+    group = parser.add_argument_group("results")
+    group.add_argument(
+        "--stream-results", default=False, action="store_true",
+        help=("write archived datasets to the HDF5 results file while "
+              "experiments run, instead of at the end of the analyze stage"))
+    group.add_argument(
+        "--results-compression", default=None, choices=["gzip", "lzf"],
+        help=("compression filter of array datasets written with "
+              "--stream-results (default: none)"))
+
+    group = parser.add_argument_group("workers")
+    group.add_argument(
+        "--worker-pool-size", type=int, default=0,
+        help=("number of idle worker processes to spawn in advance "
+              "for new runs (default: %(default)d)"))
+    group.add_argument(
+        "--worker-preload", action="append", default=[],
+        help=("module to import in pre-spawned worker processes "
+              "(can be specified multiple times)"))
+    group.add_argument(
+        "--sticky-workers", type=int, default=0,
+        help=("number of worker processes of completed runs to keep for "
+              "reuse by later runs of the same experiment, with the "
+              "experiment imported and its devices open, until the "
+              "experiment file or the device database changes "
+              "(default: %(default)d)"))
 
     log_args(parser)
 
@@ -83,8 +160,12 @@ def main():
         bind, args.port_broadcast))
     atexit_register_coroutine(server_broadcast.stop)
 
-    log_forwarder.callback = (lambda msg:
-        server_broadcast.broadcast("log", msg))
+    def forward_log(messages):
+        for msg in messages:
+            server_broadcast.broadcast("log", msg)
+    log_forwarder.callback = forward_log
+    log_forwarder.start()
+    atexit_register_coroutine(log_forwarder.stop)
     def ccb_issue(service, *args, **kwargs):
         msg = {
             "service": service,
@@ -94,20 +175,49 @@ def main():
         server_broadcast.broadcast("ccb", msg)
 
     device_db = DeviceDB(args.device_db)
-    dataset_db = DatasetDB(args.dataset_db)
+    dataset_db = DatasetDB(args.dataset_db, journal=args.dataset_db_journal)
     dataset_db.start()
     atexit_register_coroutine(dataset_db.stop)
     worker_handlers = dict()
 
     if args.git:
-        repo_backend = GitBackend(args.repository)
+        object_cache_max_size = args.git_object_cache_max_size
+        if object_cache_max_size is not None:
+            object_cache_max_size *= 1024*1024
+        repo_backend = GitBackend(args.repository, args.git_object_cache,
+                                  object_cache_max_size)
     else:
         repo_backend = FilesystemBackend(args.repository)
+    if args.examine_cache is None:
+        examine_cache = None
+    else:
+        examine_cache = ExamineCache(args.examine_cache)
     experiment_db = ExperimentDB(
-        repo_backend, worker_handlers, args.experiment_subdir)
+        repo_backend, worker_handlers, args.experiment_subdir,
+        args.scan_workers, examine_cache, args.explist_cache)
     atexit.register(experiment_db.close)
 
-    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db)
+    if args.worker_pool_size:
+        worker_pool = WorkerPool(worker_handlers, args.worker_pool_size,
+                                 args.worker_preload)
+        worker_pool.start()
+        atexit_register_coroutine(worker_pool.stop)
+    else:
+        worker_pool = None
+    if args.sticky_workers:
+        sticky_workers = StickyWorkers(args.sticky_workers, device_db)
+        atexit_register_coroutine(sticky_workers.stop)
+    else:
+        sticky_workers = None
+
+    if args.stream_results:
+        stream_results = {"compression": args.results_compression}
+    else:
+        stream_results = None
+    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db,
+                          worker_pool, args.max_concurrent_prepare,
+                          args.max_concurrent_analyze, stream_results,
+                          sticky_workers)
     scheduler.start()
     atexit_register_coroutine(scheduler.stop)
 
@@ -132,7 +242,8 @@ def main():
         "master_device_db": device_db,
         "master_dataset_db": dataset_db,
         "master_schedule": scheduler,
-        "master_experiment_db": experiment_db
+        "master_experiment_db": experiment_db,
+        "master_log": LogHistory(log_forwarder)
     }, allow_parallel=True)
     loop.run_until_complete(server_control.start(
         bind, args.port_control))
@@ -140,6 +251,7 @@ def main():
 
     server_notify = Publisher({
         "schedule": scheduler.notifier,
+        "schedule_timing": scheduler.timing.notifier,
         "devices": device_db.data,
         "datasets": dataset_db.data,
         "explist": experiment_db.explist,
@@ -149,6 +261,12 @@ def main():
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop)
 
+    if args.port_metrics is not None:
+        server_metrics = MetricsServer(scheduler.get_metrics)
+        loop.run_until_complete(server_metrics.start(
+            bind, args.port_metrics))
+        atexit_register_coroutine(server_metrics.stop)
+
     server_logging = LoggingServer()
     loop.run_until_complete(server_logging.start(
         bind, args.port_logging))
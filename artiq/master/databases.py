@@ -1,4 +1,8 @@
 import asyncio
+import logging
+import os
+
+import numpy
 
 from artiq.tools import file_import
 
@@ -7,6 +11,9 @@ from sipyco import pyon
 from sipyco.asyncio_tools import TaskObject
 
 
+logger = logging.getLogger(__name__)
+
+
 def device_db_from_file(filename):
     mod = file_import(filename)
 
@@ -16,13 +23,34 @@ def device_db_from_file(filename):
     return mod.__dict__["device_db"]
 
 
+def _changed_region(old, new):
+    # Returns the smallest box (as a tuple of slices) containing all the
+    # elements that differ between two arrays of the same shape, or None.
+    changed = old != new
+    if old.dtype.kind in "fc":
+        changed &= ~(numpy.isnan(old) & numpy.isnan(new))
+    index = []
+    for axis in range(changed.ndim):
+        other_axes = tuple(i for i in range(changed.ndim) if i != axis)
+        nonzero = numpy.flatnonzero(changed.any(axis=other_axes))
+        if not len(nonzero):
+            return None
+        index.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(index)
+
+
 class DeviceDB:
     def __init__(self, backing_file):
         self.backing_file = backing_file
         self.data = Notifier(device_db_from_file(self.backing_file))
+        # incremented each time a scan changes the contents
+        self.generation = 0
 
     def scan(self):
-        update_from_dict(self.data, device_db_from_file(self.backing_file))
+        new_data = device_db_from_file(self.backing_file)
+        if new_data != self.data.raw_view:
+            self.generation += 1
+        update_from_dict(self.data, new_data)
 
     def get_device_db(self):
         return self.data.raw_view
@@ -36,33 +64,176 @@ class DeviceDB:
 
 
 class DatasetDB(TaskObject):
-    def __init__(self, persist_file, autosave_period=30):
+    """Dataset database, with periodic saving of the persistent datasets.
+
+    Only datasets that have changed since the last save are written. By
+    default, all persistent datasets are then rewritten to ``persist_file``.
+    If ``journal`` is set, the changed datasets are instead appended to a
+    journal file next to ``persist_file``, which is folded back into
+    ``persist_file`` (compacted) once it grows larger than it, and when the
+    database is stopped. A journal left over from a previous session is
+    always replayed when loading. Pending changes are appended to the
+    journal before compacting, so that replaying a journal left over by a
+    crash during compaction does not revert newer values.
+    """
+    # Minimum size of an array for settings of a new value to be published
+    # as an assignment to the part that has changed.
+    array_delta_threshold = 4096
+
+    def __init__(self, persist_file, autosave_period=30, journal=False):
         self.persist_file = persist_file
         self.autosave_period = autosave_period
+        self.journal_file = persist_file + ".journal"
+        self.journal = journal
 
         try:
             file_data = pyon.load_file(self.persist_file)
         except FileNotFoundError:
             file_data = dict()
+        self._journal_size, complete = self._replay_journal(file_data)
+        self._persisted_keys = set(file_data.keys())
+        self._dirty_keys = set()
         self.data = Notifier({k: (True, v) for k, v in file_data.items()})
+        if not complete or (self._journal_size and not journal):
+            # Do not append new entries after a corrupted one, and do not
+            # leave a journal that later saves would not keep up to date.
+            self.save()
+
+    def _replay_journal(self, file_data):
+        try:
+            f = open(self.journal_file, "r")
+        except FileNotFoundError:
+            return 0, True
+        with f:
+            size = 0
+            for line in f:
+                try:
+                    changes = pyon.decode(line)
+                except:
+                    # Incomplete last entry, e.g. after a crash.
+                    logger.warning("ignoring corrupted entry in dataset "
+                                   "journal '%s'", self.journal_file)
+                    return size, False
+                file_data.update(changes["set"])
+                for key in changes["delete"]:
+                    file_data.pop(key, None)
+                size += len(line)
+        return size, True
+
+    def _mark_dirty_key(self, key):
+        # Only changes of persistent datasets, or of datasets that were
+        # persistent at the last save, need to be saved.
+        entry = self.data.raw_view.get(key)
+        if (entry is not None and entry[0]) or key in self._persisted_keys:
+            self._dirty_keys.add(key)
+
+    def _mark_dirty(self, mod):
+        if mod["path"]:
+            self._mark_dirty_key(mod["path"][0])
+        elif mod["action"] == "init":
+            self._dirty_keys.update(self._persisted_keys)
+            for key in mod["struct"].keys():
+                self._mark_dirty_key(key)
+        else:
+            self._mark_dirty_key(mod["key"])
 
     def save(self):
+        """Writes all persistent datasets to ``persist_file`` and empties the
+        journal."""
+        if self._journal_size:
+            self._append_journal()
         data = {k: v[1] for k, v in self.data.raw_view.items() if v[0]}
         pyon.store_file(self.persist_file, data)
+        try:
+            os.remove(self.journal_file)
+        except FileNotFoundError:
+            pass
+        self._journal_size = 0
+        self._persisted_keys = set(data.keys())
+        self._dirty_keys.clear()
+
+    def save_changes(self):
+        """Writes the persistent datasets that have changed since the last
+        save, either to the journal or by rewriting ``persist_file``."""
+        if not self._dirty_keys:
+            return
+        if not self.journal:
+            self.save()
+            return
+
+        self._append_journal()
+        try:
+            persist_size = os.path.getsize(self.persist_file)
+        except FileNotFoundError:
+            persist_size = 0
+        if self._journal_size > persist_size:
+            self.save()
+
+    def _append_journal(self):
+        changes = {"set": dict(), "delete": []}
+        for key in self._dirty_keys:
+            entry = self.data.raw_view.get(key)
+            if entry is not None and entry[0]:
+                changes["set"][key] = entry[1]
+                self._persisted_keys.add(key)
+            elif key in self._persisted_keys:
+                changes["delete"].append(key)
+                self._persisted_keys.remove(key)
+        self._dirty_keys.clear()
+        if not changes["set"] and not changes["delete"]:
+            return
+
+        line = pyon.encode(changes) + "\n"
+        with open(self.journal_file, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(line)
 
     async def _do(self):
         try:
             while True:
                 await asyncio.sleep(self.autosave_period)
-                self.save()
+                self.save_changes()
         finally:
-            self.save()
+            if self._dirty_keys or self._journal_size:
+                self.save()
 
     def get(self, key):
         return self.data.raw_view[key][1]
 
+    def _update_array(self, mod):
+        # Setting a large array with the same shape and type as the current
+        # value is done in place, and published as an assignment to the
+        # region that has changed (if small enough). Subscribers apply it to
+        # their own copy like a mutation.
+        if mod["action"] != "setitem" or mod["path"]:
+            return False
+        current = self.data.raw_view.get(mod["key"])
+        persist, new = mod["value"]
+        if current is None or current[0] != persist:
+            return False
+        old = current[1]
+        if not (isinstance(old, numpy.ndarray)
+                and isinstance(new, numpy.ndarray)
+                and old.shape == new.shape and old.dtype == new.dtype
+                and old.dtype.kind in "biufc" and old.ndim
+                and old.flags.writeable
+                and new.nbytes >= self.array_delta_threshold):
+            return False
+        index = _changed_region(old, new)
+        if index is None:
+            return True
+        region = numpy.ascontiguousarray(new[index])
+        if 2*region.size > new.size:
+            return False
+        self.data[mod["key"]][1][index] = region
+        return True
+
     def update(self, mod):
-        process_mod(self.data, mod)
+        if not self._update_array(mod):
+            process_mod(self.data, mod)
+        self._mark_dirty(mod)
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None):
@@ -72,7 +243,9 @@ class DatasetDB(TaskObject):
             else:
                 persist = False
         self.data[key] = (persist, value)
+        self._mark_dirty_key(key)
 
     def delete(self, key):
         del self.data[key]
+        self._mark_dirty_key(key)
     #
@@ -1,12 +1,16 @@
 import asyncio
+import errno
 import os
 import tempfile
 import shutil
 import time
 import logging
+import hashlib
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
 
+from artiq import __version__ as artiq_version
 from artiq.master.worker import (Worker, WorkerInternalException,
                                  log_worker_exception)
 from artiq.tools import get_windows_drives, exc_to_warning
@@ -15,19 +19,122 @@ from artiq.tools import get_windows_drives, exc_to_warning
 logger = logging.getLogger(__name__)
 
 
+class ExamineCache:
+    """Persistent cache of the results of examining experiment files.
+
+    Entries are keyed by a hash of the file contents, of the ARTIQ version
+    and of the device database, so that only new or modified files need to
+    be examined again, and all files are examined again when the device
+    database changes. Files that read datasets while being examined (e.g.
+    for argument defaults) are not cached, since their arguments depend on
+    the current datasets.
+
+    Note that changes in modules imported by an experiment file are not
+    detected.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self._entries = pyon.load_file(self.filename)
+        except FileNotFoundError:
+            self._entries = dict()
+        except:
+            logger.warning("failed to load examine cache '%s', ignoring",
+                           self.filename, exc_info=True)
+            self._entries = dict()
+        self._used = set()
+
+    @staticmethod
+    def device_db_key(device_db):
+        return hashlib.sha256(pyon.encode(device_db).encode()).hexdigest()
+
+    @staticmethod
+    def file_key(path, device_db_key=""):
+        h = hashlib.sha256(artiq_version.encode())
+        h.update(device_db_key.encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def get(self, key):
+        description = self._entries.get(key)
+        if description is not None:
+            self._used.add(key)
+        return description
+
+    def set(self, key, description):
+        self._entries[key] = description
+        self._used.add(key)
+
+    def save(self):
+        """Stores the entries used since the last save, and drops the
+        others."""
+        self._entries = {k: v for k, v in self._entries.items()
+                         if k in self._used}
+        self._used = set()
+        pyon.store_file(self.filename, self._entries)
+
+
 class _RepoScanner:
-    def __init__(self, worker_handlers):
+    def __init__(self, worker_handlers, max_workers=1, cache=None):
         self.worker_handlers = worker_handlers
-        self.worker = None
+        self.max_workers = max_workers
+        self.cache = cache
+
+    def _list_files(self, root, subdir, prefix, files):
+        for de in os.scandir(os.path.join(root, subdir)):
+            if de.name.startswith("."):
+                continue
+            if de.is_file() and de.name.endswith(".py"):
+                files.append((os.path.join(subdir, de.name), prefix))
+            if de.is_dir():
+                self._list_files(root, os.path.join(subdir, de.name),
+                                 prefix + de.name + "/", files)
 
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+    async def _examine_files(self, root, files, descriptions,
+                             device_db_key):
+        # files is an iterator shared between all concurrent workers
+        read_datasets = False
+
+        def get_dataset(*args, **kwargs):
+            nonlocal read_datasets
+            read_datasets = True
+            return self.worker_handlers["get_dataset"](*args, **kwargs)
+        handlers = dict(self.worker_handlers, get_dataset=get_dataset)
+
+        worker = Worker(handlers)
         try:
-            description = await self.worker.examine(
-                "scan", os.path.join(root, filename))
-        except:
-            log_worker_exception()
-            raise
+            for filename, _ in files:
+                path = os.path.join(root, filename)
+                if self.cache is not None:
+                    key = self.cache.file_key(path, device_db_key)
+                    description = self.cache.get(key)
+                    if description is not None:
+                        logger.debug("using cached description of file %s",
+                                     filename)
+                        descriptions[filename] = description
+                        continue
+                logger.debug("processing file %s %s", root, filename)
+                t1 = time.monotonic()
+                read_datasets = False
+                try:
+                    description = await worker.examine("scan", path)
+                    descriptions[filename] = description
+                    if self.cache is not None and not read_datasets:
+                        self.cache.set(key, description)
+                except Exception as exc:
+                    log_worker_exception()
+                    logger.warning("Skipping file '%s'", filename,
+                        exc_info=not isinstance(exc, WorkerInternalException))
+                    # restart worker
+                    await worker.close()
+                    worker = Worker(handlers)
+                logger.debug("examined file '%s' in %.3f seconds",
+                             filename, time.monotonic() - t1)
+        finally:
+            await worker.close()
+
+    def _add_entries(self, entry_dict, filename, prefix, description):
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             arginfo = class_desc["arginfo"]
@@ -35,10 +142,10 @@ class _RepoScanner:
                 logger.warning("Character '/' is not allowed in experiment "
                                "name (%s)", name)
                 name = name.replace("/", "_")
-            if name in entry_dict:
+            if prefix + name in entry_dict:
                 basename = name
                 i = 1
-                while name in entry_dict:
+                while prefix + name in entry_dict:
                     name = basename + str(i)
                     i += 1
                 logger.warning("Duplicate experiment name: '%s'\n"
@@ -50,53 +157,93 @@ class _RepoScanner:
                 "arginfo": arginfo,
                 "scheduler_defaults": class_desc["scheduler_defaults"]
             }
-            entry_dict[name] = entry
+            entry_dict[prefix + name] = entry
 
-    async def _scan(self, root, subdir=""):
+    async def scan(self, root, subdir=""):
+        files = []
+        self._list_files(root, subdir, "", files)
+
+        device_db_key = ""
+        if self.cache is not None and "get_device_db" in self.worker_handlers:
+            device_db_key = self.cache.device_db_key(
+                self.worker_handlers["get_device_db"]())
+
+        descriptions = dict()
+        files_iter = iter(files)
+        n_workers = max(1, min(self.max_workers, len(files)))
+        await asyncio.gather(*[
+            self._examine_files(root, files_iter, descriptions, device_db_key)
+            for _ in range(n_workers)])
+
+        # Merge in directory traversal order, independently of the order in
+        # which the workers completed, so that duplicate names are resolved
+        # deterministically.
         entry_dict = dict()
-        for de in os.scandir(os.path.join(root, subdir)):
-            if de.name.startswith("."):
-                continue
-            if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
-                try:
-                    await self.process_file(entry_dict, root, filename)
-                except Exception as exc:
-                    logger.warning("Skipping file '%s'", filename,
-                        exc_info=not isinstance(exc, WorkerInternalException))
-                    # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
-            if de.is_dir():
-                subentries = await self._scan(
-                    root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
-                entry_dict.update(entries)
+        for filename, prefix in files:
+            if filename in descriptions:
+                self._add_entries(entry_dict, filename, prefix,
+                                  descriptions[filename])
         return entry_dict
 
-    async def scan(self, root, subdir=""):
-        self.worker = Worker(self.worker_handlers)
-        try:
-            r = await self._scan(root, subdir)
-        finally:
-            await self.worker.close()
-        return r
-
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers, experiment_subdir=""):
+    """Database of the experiments found in the repository.
+
+    If ``explist_cache`` is set, the result of each repository scan is
+    stored in this file, together with the revision that was scanned. On
+    startup, the stored list of experiments is served right away, and the
+    first scan then runs in the background (without setting the
+    ``scanning`` status) and only publishes the differences.
+    """
+    def __init__(self, repo_backend, worker_handlers, experiment_subdir="",
+                 scan_workers=1, examine_cache=None, explist_cache=None):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
         self.experiment_subdir = experiment_subdir
+        self.scan_workers = scan_workers
+        self.examine_cache = examine_cache
+        self.explist_cache = explist_cache
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
-        self.explist = Notifier(dict())
+        cached = self._load_explist_cache()
+        if cached is None:
+            self.explist = Notifier(dict())
+        else:
+            logger.info("using cached list of experiments of revision %s",
+                        cached["rev"])
+            self.explist = Notifier(cached["explist"])
         self._scanning = False
 
         self.status = Notifier({
             "scanning": False,
-            "cur_rev": self.cur_rev
+            "cur_rev": self.cur_rev,
+            # revision of the cached explist still to be reconciled, or None
+            "cached_rev": None if cached is None else cached["rev"]
+        })
+
+    def _load_explist_cache(self):
+        if self.explist_cache is None:
+            return None
+        try:
+            cached = pyon.load_file(self.explist_cache)
+        except FileNotFoundError:
+            return None
+        except:
+            logger.warning("failed to load explist cache '%s', ignoring",
+                           self.explist_cache, exc_info=True)
+            return None
+        if (cached.get("artiq_version") != artiq_version
+                or cached.get("experiment_subdir") != self.experiment_subdir):
+            return None
+        return cached
+
+    def _save_explist_cache(self):
+        pyon.store_file(self.explist_cache, {
+            "artiq_version": artiq_version,
+            "experiment_subdir": self.experiment_subdir,
+            "rev": self.cur_rev,
+            "explist": self.explist.raw_view
         })
 
     def close(self):
@@ -107,7 +254,10 @@ class ExperimentDB:
         if self._scanning:
             return
         self._scanning = True
-        self.status["scanning"] = True
+        # reconciling the cached explist keeps it available to clients
+        background = self.status.raw_view["cached_rev"] is not None
+        if not background:
+            self.status["scanning"] = True
         try:
             if new_cur_rev is None:
                 new_cur_rev = self.repo_backend.get_head_rev()
@@ -116,10 +266,17 @@ class ExperimentDB:
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(
-                wd, self.experiment_subdir)
+            new_explist = await _RepoScanner(
+                self.worker_handlers, self.scan_workers,
+                self.examine_cache).scan(wd, self.experiment_subdir)
             logger.info("repository scan took %d seconds", time.monotonic()-t1)
+            if self.examine_cache is not None:
+                self.examine_cache.save()
             update_from_dict(self.explist, new_explist)
+            if background:
+                self.status["cached_rev"] = None
+            if self.explist_cache is not None:
+                self._save_explist_cache()
         finally:
             self._scanning = False
             self.status["scanning"] = False
@@ -175,11 +332,111 @@ class FilesystemBackend:
         pass
 
 
+# Git tree entry modes
+_GIT_FILEMODE_TREE = 0o040000
+_GIT_FILEMODE_BLOB = 0o100644
+_GIT_FILEMODE_BLOB_EXECUTABLE = 0o100755
+_GIT_FILEMODE_LINK = 0o120000
+
+
+class _GitObjectCache:
+    """Content-addressed store of the contents of Git blobs, from which
+    checkouts are materialized as hard links (or copies where hard links
+    are not available).
+
+    Each blob is thus written at most once, and checking out a revision
+    that shares most files with previous ones is cheap. Files in the store,
+    and therefore in the checkouts, are read-only. Checkouts are made in the
+    ``checkouts`` subdirectory, on the same filesystem as the blobs.
+
+    If ``max_size`` is set, :meth:`prune` deletes the least recently used
+    blobs that no checkout links to until the store is at most that many
+    bytes.
+    """
+    def __init__(self, git, path, max_size=None):
+        self.git = git
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.checkouts_path = os.path.join(self.path, "checkouts")
+        os.makedirs(self.checkouts_path, exist_ok=True)
+
+    def _get_blob(self, oid, executable):
+        name = str(oid) + ("x" if executable else "")
+        directory = os.path.join(self.path, name[:2])
+        filename = os.path.join(directory, name[2:])
+        if os.path.exists(filename):
+            # marks the blob as recently used for prune()
+            os.utime(filename)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile("wb", dir=directory,
+                                             delete=False) as f:
+                f.write(self.git[oid].data)
+                tmpname = f.name
+            os.chmod(tmpname, 0o555 if executable else 0o444)
+            os.replace(tmpname, filename)
+        return filename
+
+    @staticmethod
+    def _link(source, target):
+        if os.name == "nt":
+            # read-only hard links would prevent deleting checkouts
+            shutil.copyfile(source, target)
+            return
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(source, target)
+
+    def checkout_tree(self, tree, directory):
+        for entry in tree:
+            target = os.path.join(directory, entry.name)
+            mode = entry.filemode
+            if mode == _GIT_FILEMODE_TREE:
+                os.mkdir(target)
+                self.checkout_tree(self.git[entry.id], target)
+            elif mode in (_GIT_FILEMODE_BLOB, _GIT_FILEMODE_BLOB_EXECUTABLE):
+                source = self._get_blob(
+                    entry.id, mode == _GIT_FILEMODE_BLOB_EXECUTABLE)
+                self._link(source, target)
+            elif mode == _GIT_FILEMODE_LINK:
+                os.symlink(self.git[entry.id].data, target)
+            # submodules are not checked out
+
+    def prune(self):
+        if self.max_size is None:
+            return
+        blobs = []
+        total_size = 0
+        for directory in os.scandir(self.path):
+            if len(directory.name) != 2 or not directory.is_dir():
+                continue
+            for blob in os.scandir(directory.path):
+                st = blob.stat()
+                total_size += st.st_size
+                if st.st_nlink == 1:
+                    blobs.append((st.st_mtime, st.st_size, blob.path))
+        blobs.sort()
+        for _, size, filename in blobs:
+            if total_size <= self.max_size:
+                break
+            os.unlink(filename)
+            total_size -= size
+
+
 class _GitCheckout:
-    def __init__(self, git, rev):
-        self.path = tempfile.mkdtemp()
+    def __init__(self, git, rev, object_cache=None):
+        if object_cache is None:
+            self.path = tempfile.mkdtemp()
+        else:
+            self.path = tempfile.mkdtemp(dir=object_cache.checkouts_path)
         commit = git.get(rev)
-        git.checkout_tree(commit, directory=self.path)
+        if object_cache is None:
+            git.checkout_tree(commit, directory=self.path)
+        else:
+            object_cache.checkout_tree(commit.tree, self.path)
         self.message = commit.message.strip()
         self.ref_count = 1
         logger.info("checked out revision %s into %s", rev, self.path)
@@ -190,12 +447,25 @@ class _GitCheckout:
 
 
 class GitBackend:
-    def __init__(self, root):
+    """Repository backend providing checkouts of Git revisions.
+
+    If ``object_cache`` is set, checkouts are made of hard links to files
+    in this directory, where each distinct file content is stored once
+    across revisions and master restarts. ``object_cache_max_size`` then
+    limits the size in bytes of the cache, whose files in use by checkouts
+    are however never deleted.
+    """
+    def __init__(self, root, object_cache=None, object_cache_max_size=None):
         # lazy import - make dependency optional
         import pygit2
 
         self.git = pygit2.Repository(root)
         self.checkouts = dict()
+        if object_cache is None:
+            self.object_cache = None
+        else:
+            self.object_cache = _GitObjectCache(self.git, object_cache,
+                                                object_cache_max_size)
 
     def get_head_rev(self):
         return str(self.git.head.target)
@@ -205,7 +475,7 @@ class GitBackend:
             co = self.checkouts[rev]
             co.ref_count += 1
         else:
-            co = _GitCheckout(self.git, rev)
+            co = _GitCheckout(self.git, rev, self.object_cache)
             self.checkouts[rev] = co
         return co.path, co.message
 
@@ -215,3 +485,5 @@ class GitBackend:
         if not co.ref_count:
             co.dispose()
             del self.checkouts[rev]
+            if self.object_cache is not None:
+                self.object_cache.prune()
@@ -1,20 +1,115 @@
+import asyncio
 import logging
 import logging.handlers
+import threading
+import time
+from collections import deque
 
 from sipyco.logging_tools import SourceFilter
+from sipyco.asyncio_tools import TaskObject
 
 
-class LogForwarder(logging.Handler):
-    def __init__(self, *args, **kwargs):
+class LogForwarder(logging.Handler, TaskObject):
+    """Passes the log messages to ``callback``, in lists of tuples of
+    level, source, creation time and formatted message.
+
+    Once started, messages are buffered and passed in periodic flushes,
+    every ``flush_period`` seconds, from the asyncio event loop, with one
+    call of ``callback`` per flush. Each source may then forward
+    ``rate_limit`` messages per second on average (with bursts of up to
+    ``rate_limit`` messages); further messages are dropped and replaced
+    with a warning giving their number at the next flush. Messages at the
+    ``WARNING`` level and above are never dropped, and do not count towards
+    the limit. Before being started, messages are passed immediately, one
+    per call.
+
+    The last ``history_size`` forwarded messages are kept in ``history``,
+    for clients that connect after they were passed (see
+    :class:`LogHistory`).
+    """
+    def __init__(self, *args, flush_period=0.1, rate_limit=100,
+                 history_size=1000, **kwargs):
         logging.Handler.__init__(self, *args, **kwargs)
         self.callback = None
         self.setFormatter(logging.Formatter("%(name)s:%(message)s"))
 
-    def emit(self, record):
+        self.flush_period = flush_period
+        self.rate_limit = rate_limit
+        self.history = deque(maxlen=history_size)
+
+        self._started = False
+        self._lock = threading.Lock()
+        self._pending = []
+        self._buckets = dict()  # source -> (tokens, time)
+        self._suppressed = dict()  # source -> number of dropped messages
+
+    def _forward(self, messages):
+        self.history.extend(messages)
         if self.callback is not None:
-            message = self.format(record)
-            self.callback((record.levelno, record.source, record.created,
-                           message))
+            self.callback(messages)
+
+    def _allow(self, source, now):
+        # token bucket
+        tokens, last = self._buckets.get(source, (self.rate_limit, now))
+        tokens = min(self.rate_limit, tokens + (now - last)*self.rate_limit)
+        if tokens < 1:
+            self._buckets[source] = (tokens, now)
+            self._suppressed[source] = self._suppressed.get(source, 0) + 1
+            return False
+        self._buckets[source] = (tokens - 1, now)
+        return True
+
+    def emit(self, record):
+        message = (record.levelno, record.source, record.created,
+                   self.format(record))
+        if not self._started:
+            self._forward([message])
+            return
+        with self._lock:
+            if (record.levelno >= logging.WARNING
+                    or self._allow(record.source, time.monotonic())):
+                self._pending.append(message)
+
+    def _flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            suppressed = self._suppressed
+            self._suppressed = dict()
+            now = time.monotonic()
+            for source, (tokens, last) in list(self._buckets.items()):
+                if tokens + (now - last)*self.rate_limit >= self.rate_limit:
+                    del self._buckets[source]
+        for source, count in suppressed.items():
+            pending.append((logging.WARNING, source, time.time(),
+                            "{}:{} log messages suppressed".format(
+                                __name__, count)))
+        if pending:
+            self._forward(pending)
+
+    def start(self):
+        self._started = True
+        TaskObject.start(self)
+
+    async def _do(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_period)
+                self._flush()
+        finally:
+            self._started = False
+            self._flush()
+
+
+class LogHistory:
+    """Gives access to the recent messages of a :class:`LogForwarder`
+    over RPC."""
+    def __init__(self, forwarder):
+        self._forwarder = forwarder
+
+    def get_messages(self):
+        """Returns the last forwarded log messages, oldest first."""
+        return list(self._forwarder.history)
 
 
 def log_args(parser):
@@ -30,6 +125,14 @@ def log_args(parser):
                        help="number of old log files to keep, or 0 to keep "
                             "all log files. '.<yyyy>-<mm>-<dd>' is added "
                             "to the base filename (default: %(default)d)")
+    group.add_argument("--log-rate-limit", type=float, default=100,
+                       help="maximum average number of log messages "
+                            "below the WARNING level per second forwarded "
+                            "to clients from each source, e.g. each worker "
+                            "(default: %(default)s)")
+    group.add_argument("--log-history", type=int, default=1000,
+                       help="number of recent log messages kept for clients "
+                            "that connect later (default: %(default)d)")
 
 
 def init_log(args):
@@ -52,7 +155,8 @@ def init_log(args):
             "%(asctime)s %(levelname)s:%(source)s:%(name)s:%(message)s"))
         handlers.append(file_handler)
     
-    log_forwarder = LogForwarder()
+    log_forwarder = LogForwarder(rate_limit=args.log_rate_limit,
+                                 history_size=args.log_history)
     handlers.append(log_forwarder)
 
     for handler in handlers:
@@ -0,0 +1,123 @@
+"""Instrumentation of the scheduler pipelines, and an HTTP endpoint exposing
+it in the Prometheus text exposition format."""
+
+import asyncio
+import logging
+from collections import Counter
+
+from sipyco.sync_struct import Notifier
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunTiming:
+    """Records the time spent by runs in each stage of the scheduler
+    pipelines.
+
+    The timing of each run in the schedule is published through
+    ``notifier``, keyed by RID, as a dictionary mapping stage names to
+    the time (in seconds) spent in them so far. The submission time is
+    under ``"submit_time"``. Totals over all runs are kept for
+    :func:`render_metrics`.
+    """
+    def __init__(self):
+        self.notifier = Notifier(dict())
+        self.totals = dict()  # stage -> [number of observations, seconds]
+        self.deleted_runs = 0
+
+    def add_run(self, rid, submit_time):
+        self.notifier[rid] = {"submit_time": submit_time}
+
+    def record(self, rid, stage, duration):
+        entry = self.notifier.raw_view.get(rid)
+        if entry is None:
+            return
+        self.notifier[rid][stage] = entry.get(stage, 0.0) + duration
+        total = self.totals.setdefault(stage, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+
+    def delete_run(self, rid):
+        if rid in self.notifier.raw_view:
+            del self.notifier[rid]
+            self.deleted_runs += 1
+
+
+def _escape_label(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def render_metrics(timing, schedule):
+    """Renders the totals of ``timing`` (a :class:`RunTiming`) and the
+    number of runs per pipeline and status in ``schedule`` (as returned by
+    ``Scheduler.get_status``) in the text exposition format."""
+    lines = [
+        "# HELP artiq_run_stage_seconds "
+        "Time spent by runs in each scheduler stage.",
+        "# TYPE artiq_run_stage_seconds summary"
+    ]
+    for stage, (count, total) in sorted(timing.totals.items()):
+        label = "{{stage=\"{}\"}}".format(_escape_label(stage))
+        lines.append("artiq_run_stage_seconds_sum{} {!r}".format(label, total))
+        lines.append("artiq_run_stage_seconds_count{} {}".format(label, count))
+
+    lines += [
+        "# HELP artiq_runs Number of runs in the schedule.",
+        "# TYPE artiq_runs gauge"
+    ]
+    runs = Counter((r["pipeline"], r["status"]) for r in schedule.values())
+    for (pipeline, status), count in sorted(runs.items()):
+        lines.append("artiq_runs{{pipeline=\"{}\",status=\"{}\"}} {}".format(
+            _escape_label(pipeline), status, count))
+
+    lines += [
+        "# HELP artiq_runs_deleted_total "
+        "Number of runs removed from the schedule.",
+        "# TYPE artiq_runs_deleted_total counter",
+        "artiq_runs_deleted_total {}".format(timing.deleted_runs)
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Minimal HTTP server answering ``GET /metrics`` with the text returned
+    by ``render``."""
+    def __init__(self, render):
+        self.render = render
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._handle_connection,
+                                                 host, port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        del self.server
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass  # ignore headers
+            if (len(request) >= 2 and request[0] == b"GET"
+                    and request[1].split(b"?")[0] == b"/metrics"):
+                status = "200 OK"
+                body = self.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write((
+                "HTTP/1.0 {}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                "Content-Length: {}\r\n"
+                "Connection: close\r\n\r\n").format(status, len(body))
+                .encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except:
+            logger.error("error serving metrics", exc_info=True)
+        finally:
+            writer.close()
@@ -0,0 +1,180 @@
+"""Publisher of the master notifiers, with optional filtering of the
+top-level keys sent to each subscriber.
+
+A subscriber selects keys by connecting to the notifier name returned by
+:func:`artiq.tools.filtered_notifier_name` instead of the plain notifier
+name. It then receives an ``init`` containing only the selected keys, and
+only the mods that concern them. Unmodified subscribers keep receiving
+everything.
+
+Subscribers are plain :class:`sipyco.sync_struct.Subscriber` instances, so
+the publisher must speak the same protocol, whose banner sipyco does not
+export publicly.
+"""
+
+import asyncio
+from contextlib import contextmanager, ExitStack
+
+from sipyco import pyon
+from sipyco.asyncio_tools import AsyncioServer
+
+from artiq.tools import parse_notifier_name
+
+try:
+    from sipyco.sync_struct import _protocol_banner
+except ImportError as e:
+    raise ImportError("the installed version of sipyco does not define "
+                      "sipyco.sync_struct._protocol_banner, which the ARTIQ "
+                      "master publisher needs to communicate with "
+                      "subscribers; install the sipyco version pinned in "
+                      "flake.lock") from e
+
+
+class _KeyFilter:
+    def __init__(self, keys, prefixes):
+        self.keys = set(keys)
+        self.prefixes = tuple(prefixes)
+
+    def match(self, key):
+        return (key in self.keys
+                or (isinstance(key, str) and key.startswith(self.prefixes)))
+
+    def filter_mod(self, mod):
+        """Returns the mod restricted to the selected keys, or ``None``."""
+        if mod["action"] == "init":
+            return {"action": "init",
+                    "struct": {k: v for k, v in mod["struct"].items()
+                               if self.match(k)}}
+        if mod["path"]:
+            return mod if self.match(mod["path"][0]) else None
+        if mod["action"] in {"setitem", "delitem"}:
+            return mod if self.match(mod["key"]) else None
+        return mod
+
+
+def _encode(mod):
+    return (pyon.encode(mod) + "\n").encode()
+
+
+class _PublishHook:
+    # Set as the publish attribute of the notifiers of a Publisher.
+    def __init__(self, publisher, name):
+        self.publisher = publisher
+        self.name = name
+        self.batch = None  # list of (mod, encoded mod) while batching
+
+    def __call__(self, mod):
+        if self.batch is None:
+            self.publisher._publish(self.name, mod)
+        else:
+            # encoded right away, as the values may be modified later
+            self.batch.append((mod, _encode(mod)))
+
+
+@contextmanager
+def _batch(notifier):
+    hook = notifier.publish
+    if not isinstance(hook, _PublishHook) or hook.batch is not None:
+        yield
+        return
+    hook.batch = []
+    try:
+        yield
+    finally:
+        batch, hook.batch = hook.batch, None
+        hook.publisher._send(hook.name, batch)
+
+
+@contextmanager
+def batch_mods(*notifiers):
+    """Context manager sending the mods of ``notifiers`` made within the
+    block to each subscriber at the end of the block, in a single message,
+    if the notifiers are published by :class:`Publisher`. Otherwise, the
+    mods are published as usual.
+
+    The block must not give control to the event loop, so that subscribers
+    connecting meanwhile do not receive the batched mods in their ``init``
+    as well."""
+    with ExitStack() as stack:
+        for notifier in notifiers:
+            stack.enter_context(_batch(notifier))
+        yield
+
+
+class Publisher(AsyncioServer):
+    """Drop-in replacement for :class:`sipyco.sync_struct.Publisher` that
+    also accepts filtered subscriptions (see
+    :func:`artiq.tools.filtered_notifier_name`)."""
+    def __init__(self, notifiers):
+        AsyncioServer.__init__(self)
+        self.notifiers = notifiers
+        self._names = {id(notifier): name
+                       for name, notifier in notifiers.items()}
+        # notifier name -> {queue: key filter or None}
+        self._subscribers = {name: dict() for name in notifiers.keys()}
+
+        for name, notifier in notifiers.items():
+            notifier.publish = _PublishHook(self, name)
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line != _protocol_banner:
+                return
+
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                notifier_name, spec = parse_notifier_name(line.decode()[:-1])
+            except:
+                return
+            key_filter = None if spec is None else _KeyFilter(*spec)
+
+            try:
+                notifier = self.notifiers[notifier_name]
+            except KeyError:
+                return
+
+            init = {"action": "init", "struct": notifier.raw_view}
+            if key_filter is not None:
+                init = key_filter.filter_mod(init)
+            writer.write((pyon.encode(init) + "\n").encode())
+
+            queue = asyncio.Queue()
+            subscribers = self._subscribers[notifier_name]
+            subscribers[queue] = key_filter
+            try:
+                while True:
+                    line = await queue.get()
+                    writer.write(line)
+                    # raise exception on connection error
+                    await writer.drain()
+            finally:
+                del subscribers[queue]
+        except (ConnectionError, TimeoutError):
+            # subscribers disconnecting are a normal occurrence
+            pass
+        finally:
+            writer.close()
+
+    def publish(self, notifier, mod):
+        self._publish(self._names[id(notifier)], mod)
+
+    def _publish(self, name, mod):
+        if self._subscribers[name]:
+            self._send(name, [(mod, _encode(mod))])
+
+    def _send(self, name, encoded_mods):
+        for queue, key_filter in self._subscribers[name].items():
+            lines = []
+            for mod, line in encoded_mods:
+                if key_filter is not None:
+                    filtered = key_filter.filter_mod(mod)
+                    if filtered is None:
+                        continue
+                    if filtered is not mod:
+                        line = _encode(filtered)
+                lines.append(line)
+            if lines:
+                queue.put_nowait(b"".join(lines))
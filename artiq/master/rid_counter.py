@@ -6,11 +6,48 @@ import re
 logger = logging.getLogger(__name__)
 
 
+# Name of the file in each day folder of the results directory listing the
+# RIDs of the results written to this folder, one per line.
+rid_index_filename = "rid_index"
+
+
+def record_rid(day_dir, rid):
+    """Adds ``rid`` to the RID index of the results folder ``day_dir``.
+
+    Each entry is appended with a single write, so that concurrent workers
+    do not need to coordinate."""
+    fd = os.open(os.path.join(day_dir, rid_index_filename),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, "{}\n".format(rid).encode())
+    finally:
+        os.close(fd)
+
+
+def _read_rid_index(day_path):
+    r = -1
+    with open(os.path.join(day_path, rid_index_filename), "r") as f:
+        for line in f:
+            try:
+                rid = int(line)
+            except ValueError:
+                # e.g. incomplete last entry after a crash
+                continue
+            if rid > r:
+                r = rid
+    return r
+
+
 class RIDCounter:
     """Monotonically incrementing counter for RIDs (experiment run ids).
 
     A cache is used, but if necessary, the last used rid will be determined
     from the given results directory.
+
+    If the cache is missing or corrupt, the RID indexes of the day folders of
+    the results directory (see :func:`record_rid`) are read, newest folder
+    first, until one gives a RID. Day folders without an index (e.g. results
+    from older versions) are scanned instead, and indexed for the next time.
     """
 
     def __init__(self, cache_filename="last_rid.pyon", results_dir="results"):
@@ -30,12 +67,14 @@ class RIDCounter:
             rid = self._last_rid_from_cache()
         except FileNotFoundError:
             logger.debug("Last RID cache not found, scanning results")
-            rid = self._last_rid_from_results()
-            self._update_cache(rid)
-            return rid
+        except ValueError:
+            logger.warning("Last RID cache is corrupt, scanning results")
         else:
             logger.debug("Using last RID from cache")
             return rid
+        rid = self._last_rid_from_results()
+        self._update_cache(rid)
+        return rid
 
     def _update_cache(self, rid):
         contents = str(rid) + "\n"
@@ -51,34 +90,50 @@ class RIDCounter:
             return int(f.read())
 
     def _last_rid_from_results(self):
-        r = -1
         try:
             day_folders = os.listdir(self.results_dir)
         except:
-            return r
+            return -1
         day_folders = filter(
             lambda x: re.fullmatch("\\d\\d\\d\\d-\\d\\d-\\d\\d", x),
             day_folders)
-        for df in day_folders:
+        for df in sorted(day_folders, reverse=True):
             day_path = os.path.join(self.results_dir, df)
             try:
-                hm_folders = os.listdir(day_path)
+                rid = _read_rid_index(day_path)
+            except FileNotFoundError:
+                rid = self._last_rid_from_day_folder(day_path)
+                if rid >= 0:
+                    try:
+                        record_rid(day_path, rid)
+                    except OSError:
+                        pass
+            except OSError:
+                continue
+            if rid >= 0:
+                return rid
+        return -1
+
+    def _last_rid_from_day_folder(self, day_path):
+        r = -1
+        try:
+            hm_folders = os.listdir(day_path)
+        except:
+            return r
+        hm_folders = filter(lambda x: re.fullmatch("\\d\\d(-\\d\\d)?", x),
+                            hm_folders)
+        for hmf in hm_folders:
+            hm_path = os.path.join(day_path, hmf)
+            try:
+                h5files = os.listdir(hm_path)
             except:
                 continue
-            hm_folders = filter(lambda x: re.fullmatch("\\d\\d(-\\d\\d)?", x),
-                                hm_folders)
-            for hmf in hm_folders:
-                hm_path = os.path.join(day_path, hmf)
-                try:
-                    h5files = os.listdir(hm_path)
-                except:
+            for x in h5files:
+                m = re.fullmatch(
+                    "(\\d\\d\\d\\d\\d\\d\\d\\d\\d)-.*\\.h5", x)
+                if m is None:
                     continue
-                for x in h5files:
-                    m = re.fullmatch(
-                        "(\\d\\d\\d\\d\\d\\d\\d\\d\\d)-.*\\.h5", x)
-                    if m is None:
-                        continue
-                    rid = int(m.group(1))
-                    if rid > r:
-                        r = rid
+                rid = int(m.group(1))
+                if rid > r:
+                    r = rid
         return r
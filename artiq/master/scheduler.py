@@ -1,5 +1,7 @@
 import asyncio
+import heapq
 import logging
+import os
 from enum import Enum
 from time import time
 
@@ -7,6 +9,8 @@ from sipyco.sync_struct import Notifier
 from sipyco.asyncio_tools import TaskObject, Condition
 
 from artiq.master.worker import Worker, log_worker_exception
+from artiq.master.metrics import RunTiming, render_metrics
+from artiq.master.publisher import batch_mods
 from artiq.tools import asyncio_wait_or_cancel
 
 
@@ -25,6 +29,18 @@ class RunStatus(Enum):
     paused = 8
 
 
+# Timing stages corresponding to the time spent in each status. The time
+# spent preparing and analyzing is instead broken down by Run.
+_status_timing_stages = {
+    RunStatus.pending: "queue_wait",
+    RunStatus.flushing: "flush_wait",
+    RunStatus.prepare_done: "run_wait",
+    RunStatus.running: "run",
+    RunStatus.paused: "pause",
+    RunStatus.run_done: "analyze_wait"
+}
+
+
 def _mk_worker_method(name):
     async def worker_method(self, *args, **kwargs):
         if self.worker.closed.is_set():
@@ -58,10 +74,16 @@ class Run:
         self.due_date = due_date
         self.flush = flush
 
+        # The process is only spawned (or taken from the pools) when the
+        # run is built.
         self.worker = Worker(pool.worker_handlers)
         self.termination_requested = False
+        self._sticky_key = None
+        self._completed = False
 
         self._status = RunStatus.pending
+        self._status_time = time()
+        self.timing = dict()
 
         notification = {
             "pipeline": self.pipeline_name,
@@ -74,7 +96,10 @@ class Run:
         notification.update(kwargs)
         self._notifier = pool.notifier
         self._notifier[self.rid] = notification
+        self._pool = pool
         self._state_changed = pool.state_changed
+        self._timing = pool.timing
+        self._timing.add_run(self.rid, self._status_time)
 
     @property
     def status(self):
@@ -82,7 +107,14 @@ class Run:
 
     @status.setter
     def status(self, value):
+        previous = self._status
         self._status = value
+        now = time()
+        if previous in _status_timing_stages:
+            self.record_timing(_status_timing_stages[previous],
+                               now - self._status_time)
+        self._status_time = now
+        self._pool.index_status_change(self, previous)
         if not self.worker.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
         self._state_changed.notify()
@@ -94,33 +126,128 @@ class Run:
         """
         return (self.priority, -(self.due_date or 0), -self.rid)
 
+    def _heap_key(self):
+        # Negation of priority_key(), so that heapq (a min-heap) yields the
+        # highest-priority run first. The RID makes keys unique.
+        return (-self.priority, self.due_date or 0, self.rid)
+
+    def record_timing(self, stage, duration):
+        """Add ``duration`` seconds to the time spent by the run in
+        ``stage``."""
+        self.timing[stage] = self.timing.get(stage, 0.0) + duration
+        self._timing.record(self.rid, stage, duration)
+
     async def close(self):
         # called through pool
-        await self.worker.close()
+        sticky_workers = self._pool.sticky_workers
+        worker = None
+        if (sticky_workers is not None and self._completed
+                and self._sticky_key is not None):
+            worker = await self.worker.release()
+        if worker is None:
+            await self.worker.close()
+        else:
+            sticky_workers.put(self._sticky_key, worker)
         del self._notifier[self.rid]
+        self._timing.delete_run(self.rid)
+
+    def _get_sticky_key(self):
+        # Identifies the experiment code imported by the worker process,
+        # so that it is only reused while the file is unchanged.
+        filename = self.expid["file"]
+        if self.wd is not None:
+            filename = os.path.join(self.wd, filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (filename, self.expid["class_name"],
+                self.expid.get("repo_rev"), st.st_mtime_ns, st.st_size)
 
     _build = _mk_worker_method("build")
 
     async def build(self):
+        worker = None
+        sticky_workers = self._pool.sticky_workers
+        if sticky_workers is not None:
+            self._sticky_key = self._get_sticky_key()
+            worker = sticky_workers.get(self._sticky_key)
+            if worker is not None:
+                logger.debug("reusing worker of RID %s for RID %d",
+                             worker.rid, self.rid)
+        if worker is None and self._pool.worker_pool is not None:
+            worker = self._pool.worker_pool.get()
+        if worker is not None:
+            asyncio.ensure_future(self.worker.close())
+            self.worker = worker
+        start = time()
         await self._build(self.rid, self.pipeline_name,
                           self.wd, self.expid,
-                          self.priority)
+                          self.priority,
+                          stream_results=self._pool.stream_results)
+        duration = time() - start
+        # The worker reports when it became ready to process requests,
+        # which may be before the build started with pre-spawned workers.
+        ready = self.worker.timing.get("ready")
+        if ready is not None:
+            spawn = min(max(ready - start, 0.0), duration)
+            self.record_timing("worker_spawn", spawn)
+            duration -= spawn
+        self.record_timing("build", duration)
+
+    _prepare = _mk_worker_method("prepare")
+
+    async def prepare(self):
+        start = time()
+        await self._prepare()
+        self.record_timing("prepare", time() - start)
 
-    prepare = _mk_worker_method("prepare")
     run = _mk_worker_method("run")
     resume = _mk_worker_method("resume")
-    analyze = _mk_worker_method("analyze")
+    _analyze = _mk_worker_method("analyze")
+
+    async def analyze(self):
+        start = time()
+        await self._analyze()
+        duration = time() - start
+        write_results = self.worker.timing.get("write_results")
+        if write_results is not None:
+            write_results = min(write_results, duration)
+            self.record_timing("write_results", write_results)
+            duration -= write_results
+        self.record_timing("analyze", duration)
+        self._completed = True
 
 
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db):
+    def __init__(self, ridc, worker_handlers, notifier, experiment_db,
+                 worker_pool=None, timing=None, stream_results=None,
+                 sticky_workers=None):
         self.runs = dict()
         self.state_changed = Condition()
+        if timing is None:
+            timing = RunTiming()
+        self.timing = timing
+
+        # Indices over self.runs, maintained through Run.status, so that the
+        # pipeline stages do not have to rescan every run on each wakeup.
+        # Heaps are invalidated lazily: stale entries (runs that have since
+        # changed status) are discarded when they reach the top.
+        self.runs_by_status = {status: set() for status in RunStatus}
+        self._pending_runnable = []  # heap of (heap key, run)
+        self._pending_due = []  # heap of (due date, RID, run)
+        self._queues = {
+            RunStatus.prepare_done: [],
+            RunStatus.run_done: []
+        }
 
         self.ridc = ridc
         self.worker_handlers = worker_handlers
         self.notifier = notifier
         self.experiment_db = experiment_db
+        self.worker_pool = worker_pool
+        self.stream_results = stream_results
+        self.sticky_workers = sticky_workers
 
     def submit(self, expid, priority, due_date, flush, pipeline_name):
         # mutates expid to insert head repository revision if None.
@@ -136,9 +263,58 @@ class RunPool:
         run = Run(rid, pipeline_name, wd, expid, priority, due_date, flush,
                   self, repo_msg=repo_msg)
         self.runs[rid] = run
+        self.index_status_change(run, None)
         self.state_changed.notify()
         return rid
 
+    def index_status_change(self, run, previous):
+        # called through Run.status
+        if run.rid not in self.runs:
+            return
+        if previous is not None:
+            self.runs_by_status[previous].discard(run)
+        status = run.status
+        self.runs_by_status[status].add(run)
+        if status == RunStatus.pending:
+            if run.due_date is None:
+                heapq.heappush(self._pending_runnable, (run._heap_key(), run))
+            else:
+                heapq.heappush(self._pending_due, (run.due_date, run.rid, run))
+        elif status in self._queues:
+            heapq.heappush(self._queues[status], (run._heap_key(), run))
+
+    @staticmethod
+    def _peek(heap, status):
+        while heap:
+            run = heap[0][-1]
+            if run.status == status:
+                return run
+            heapq.heappop(heap)
+        return None
+
+    def get_highest_priority(self, status):
+        """Return the run with the highest priority among those that have
+        the given status (``prepare_done`` or ``run_done``), or None."""
+        return self._peek(self._queues[status], status)
+
+    def get_highest_priority_pending(self, now):
+        """Return the pending run with the highest priority among those the
+        due date of which has elapsed at time ``now``, or None."""
+        due = self._pending_due
+        while due and due[0][0] < now:
+            run = heapq.heappop(due)[-1]
+            if run.status == RunStatus.pending:
+                heapq.heappush(self._pending_runnable, (run._heap_key(), run))
+        return self._peek(self._pending_runnable, RunStatus.pending)
+
+    def get_next_due_date(self):
+        """Return the earliest due date among pending runs that are not
+        yet runnable, or None."""
+        run = self._peek(self._pending_due, RunStatus.pending)
+        if run is None:
+            return None
+        return run.due_date
+
     async def delete(self, rid):
         # called through deleter
         if rid not in self.runs:
@@ -147,13 +323,15 @@ class RunPool:
         await run.close()
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
+        self.runs_by_status[run.status].discard(run)
         del self.runs[rid]
 
 
 class PrepareStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    def __init__(self, pool, delete_cb, max_concurrent=1):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.max_concurrent = max_concurrent
 
     def _get_run(self):
         """If a run should get prepared now, return it. Otherwise, return a
@@ -164,65 +342,87 @@ class PrepareStage(TaskObject):
         of them are going to become next-in-line before further pool state
         changes (which will also cause a re-evaluation).
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
         now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
-
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
+        prepared = self.pool.get_highest_priority(RunStatus.prepare_done)
         def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
+            return (prepared is None
+                    or r.priority_key() > prepared.priority_key())
 
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
+        candidate = self.pool.get_highest_priority_pending(now)
         if candidate is not None and takes_precedence(candidate):
             return candidate
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+        # The earliest due date may belong to a run that does not take
+        # precedence; waking up early for it is harmless, as it then becomes
+        # runnable and the next due date is considered.
+        next_due_date = self.pool.get_next_due_date()
+        if next_due_date is None:
+            return None
+        return float(next_due_date - now)
+
+    def _flush_complete(self, run):
+        for status, runs in self.pool.runs_by_status.items():
+            if status in (RunStatus.pending, RunStatus.deleting):
+                continue
+            for r in runs:
+                if not (r.priority < run.priority or r is run):
+                    return False
+        return True
+
+    async def _prepare(self, run):
+        try:
+            await run.build()
+            await run.prepare()
+        except:
+            logger.error("got worker exception in prepare stage, "
+                         "deleting RID %d", run.rid)
+            log_worker_exception()
+            self.delete_cb(run.rid)
+        else:
+            run.status = RunStatus.prepare_done
 
     async def _do(self):
-        while True:
-            run = self._get_run()
-            if run is None:
-                await self.pool.state_changed.wait()
-            elif isinstance(run, float):
-                await asyncio_wait_or_cancel([self.pool.state_changed.wait()],
-                                             timeout=run)
-            else:
-                if run.flush:
-                    run.status = RunStatus.flushing
-                    while not all(r.status in (RunStatus.pending,
-                                               RunStatus.deleting)
-                                  or r.priority < run.priority
-                                  or r is run
-                                  for r in self.pool.runs.values()):
-                        ev = [self.pool.state_changed.wait(),
-                              run.worker.closed.wait()]
-                        await asyncio_wait_or_cancel(
-                            ev, return_when=asyncio.FIRST_COMPLETED)
-                        if run.worker.closed.is_set():
-                            break
-                    if run.worker.closed.is_set():
-                        continue
-                run.status = RunStatus.preparing
-                try:
-                    await run.build()
-                    await run.prepare()
-                except:
-                    logger.error("got worker exception in prepare stage, "
-                                 "deleting RID %d", run.rid)
-                    log_worker_exception()
-                    self.delete_cb(run.rid)
+        # Up to max_concurrent runs are built and prepared at the same time,
+        # each in its own task. Selection of the next run (and flushing)
+        # remains sequential, in priority order.
+        tasks = set()
+        def task_done(task):
+            # The pool state may have been notified before this callback,
+            # while the task was still counted.
+            tasks.discard(task)
+            self.pool.state_changed.notify()
+        try:
+            while True:
+                if len(tasks) < self.max_concurrent:
+                    run = self._get_run()
                 else:
-                    run.status = RunStatus.prepare_done
+                    run = None
+                if run is None:
+                    await self.pool.state_changed.wait()
+                elif isinstance(run, float):
+                    await asyncio_wait_or_cancel(
+                        [self.pool.state_changed.wait()], timeout=run)
+                else:
+                    if run.flush:
+                        run.status = RunStatus.flushing
+                        while not self._flush_complete(run):
+                            ev = [self.pool.state_changed.wait(),
+                                  run.worker.closed.wait()]
+                            await asyncio_wait_or_cancel(
+                                ev, return_when=asyncio.FIRST_COMPLETED)
+                            if run.worker.closed.is_set():
+                                break
+                        if run.worker.closed.is_set():
+                            continue
+                    run.status = RunStatus.preparing
+                    task = asyncio.ensure_future(self._prepare(run))
+                    tasks.add(task)
+                    task.add_done_callback(task_done)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
 
 
 class RunStage(TaskObject):
@@ -231,14 +431,7 @@ class RunStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_highest_priority(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
@@ -280,42 +473,62 @@ class RunStage(TaskObject):
 
 
 class AnalyzeStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    def __init__(self, pool, delete_cb, max_concurrent=1):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.max_concurrent = max_concurrent
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
+        return self.pool.get_highest_priority(RunStatus.run_done)
+
+    async def _analyze(self, run):
         try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+            await run.analyze()
+        except:
+            logger.error("got worker exception in analyze stage of RID %d.",
+                         run.rid)
+            log_worker_exception()
+        self.delete_cb(run.rid)
 
     async def _do(self):
-        while True:
-            run = self._get_run()
-            while run is None:
-                await self.pool.state_changed.wait()
-                run = self._get_run()
-            run.status = RunStatus.analyzing
-            try:
-                await run.analyze()
-            except:
-                logger.error("got worker exception in analyze stage of RID %d.",
-                             run.rid)
-                log_worker_exception()
-            self.delete_cb(run.rid)
+        # Up to max_concurrent runs are analyzed at the same time, each in
+        # its own task (and worker process).
+        tasks = set()
+        def task_done(task):
+            tasks.discard(task)
+            self.pool.state_changed.notify()
+        try:
+            while True:
+                run = None
+                if len(tasks) < self.max_concurrent:
+                    run = self._get_run()
+                if run is None:
+                    await self.pool.state_changed.wait()
+                    continue
+                run.status = RunStatus.analyzing
+                task = asyncio.ensure_future(self._analyze(run))
+                tasks.add(task)
+                task.add_done_callback(task_done)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db)
-        self._prepare = PrepareStage(self.pool, deleter.delete)
+    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db,
+                 worker_pool=None, timing=None, max_concurrent_prepare=1,
+                 max_concurrent_analyze=1, stream_results=None,
+                 sticky_workers=None):
+        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db,
+                            worker_pool, timing, stream_results,
+                            sticky_workers)
+        self._prepare = PrepareStage(self.pool, deleter.delete,
+                                     max_concurrent_prepare)
         self._run = RunStage(self.pool, deleter.delete)
-        self._analyze = AnalyzeStage(self.pool, deleter.delete)
+        self._analyze = AnalyzeStage(self.pool, deleter.delete,
+                                     max_concurrent_analyze)
 
     def start(self):
         self._prepare.start()
@@ -383,12 +596,36 @@ class Deleter(TaskObject):
 
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db):
+    """Master scheduler.
+
+    ``max_concurrent_prepare`` and ``max_concurrent_analyze`` set how many
+    runs of each pipeline can respectively be built and prepared, and
+    analyzed, at the same time. Runs are always run one at a time.
+
+    If ``stream_results`` is not ``None``, workers write the results of
+    runs to HDF5 files incrementally while they run (see
+    :class:`artiq.master.worker_db.HDF5StreamWriter`) instead of at the end
+    of the analyze stage. It is a dictionary of options; its ``"compression"``
+    entry sets the compression filter of array datasets.
+
+    If ``sticky_workers`` (a :class:`artiq.master.worker.StickyWorkers`) is
+    given, the worker processes of runs that complete successfully are kept
+    in it and reused by later runs of the same experiment file and class.
+    """
+    def __init__(self, ridc, worker_handlers, experiment_db, worker_pool=None,
+                 max_concurrent_prepare=1, max_concurrent_analyze=1,
+                 stream_results=None, sticky_workers=None):
         self.notifier = Notifier(dict())
+        self.timing = RunTiming()
 
         self._pipelines = dict()
         self._worker_handlers = worker_handlers
         self._experiment_db = experiment_db
+        self._worker_pool = worker_pool
+        self._max_concurrent_prepare = max_concurrent_prepare
+        self._max_concurrent_analyze = max_concurrent_analyze
+        self._stream_results = stream_results
+        self._sticky_workers = sticky_workers
         self._terminated = False
 
         self._ridc = ridc
@@ -408,6 +645,22 @@ class Scheduler:
         if self._pipelines:
             logger.warning("some pipelines were not garbage-collected")
 
+    def _get_pipeline(self, pipeline_name):
+        try:
+            return self._pipelines[pipeline_name]
+        except KeyError:
+            logger.debug("creating pipeline '%s'", pipeline_name)
+            pipeline = Pipeline(self._ridc, self._deleter,
+                                self._worker_handlers, self.notifier,
+                                self._experiment_db, self._worker_pool,
+                                self.timing, self._max_concurrent_prepare,
+                                self._max_concurrent_analyze,
+                                self._stream_results,
+                                self._sticky_workers)
+            self._pipelines[pipeline_name] = pipeline
+            pipeline.start()
+            return pipeline
+
     def submit(self, pipeline_name, expid, priority=0, due_date=None, flush=False):
         """Submits a new run.
 
@@ -417,17 +670,25 @@ class Scheduler:
         # mutates expid to insert head repository revision if None
         if self._terminated:
             return
-        try:
-            pipeline = self._pipelines[pipeline_name]
-        except KeyError:
-            logger.debug("creating pipeline '%s'", pipeline_name)
-            pipeline = Pipeline(self._ridc, self._deleter,
-                                self._worker_handlers, self.notifier,
-                                self._experiment_db)
-            self._pipelines[pipeline_name] = pipeline
-            pipeline.start()
+        pipeline = self._get_pipeline(pipeline_name)
         return pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
 
+    def submit_batch(self, pipeline_name, expids, priority=0, due_date=None,
+                     flush=False):
+        """Submits one run for each expid in the list ``expids``, and
+        returns the list of their RIDs.
+
+        Schedule subscribers receive the updates adding the new runs in a
+        single message instead of one message per run."""
+        # mutates expids to insert head repository revision if None
+        if self._terminated:
+            return
+        pipeline = self._get_pipeline(pipeline_name)
+        with batch_mods(self.notifier, self.timing.notifier):
+            return [pipeline.pool.submit(expid, priority, due_date, flush,
+                                         pipeline_name)
+                    for expid in expids]
+
     def delete(self, rid):
         """Kills the run with the specified RID."""
         self._deleter.delete(rid)
@@ -450,6 +711,11 @@ class Scheduler:
         Must not be modified."""
         return self.notifier.raw_view
 
+    def get_metrics(self):
+        """Returns the time spent by runs in each stage and the number of
+        runs in each status, in the Prometheus text exposition format."""
+        return render_metrics(self.timing, self.notifier.raw_view)
+
     def check_pause(self, rid):
         """Returns ``True`` if there is a condition that could make ``pause``
         not return immediately (termination requested or higher priority run).
@@ -470,12 +736,8 @@ class Scheduler:
                 if run.termination_requested:
                     return True
 
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
+                r = pipeline.pool.get_highest_priority(RunStatus.prepare_done)
+                if r is None:
                     return False
                 return r.priority_key() > run.priority_key()
         raise KeyError("RID not found")
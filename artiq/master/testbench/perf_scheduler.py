@@ -0,0 +1,67 @@
+import sys, asyncio, logging
+from time import perf_counter
+
+from sipyco.sync_struct import Notifier
+
+from ..scheduler import (RunPool, RunStatus, PrepareStage, RunStage,
+                         AnalyzeStage)
+
+
+class _RIDCounter:
+    def __init__(self):
+        self._next_rid = 0
+
+    def get(self):
+        rid = self._next_rid
+        self._next_rid += 1
+        return rid
+
+
+def main():
+    if len(sys.argv) > 2:
+        print("Expected at most one argument (number of runs)",
+              file=sys.stderr)
+        exit(1)
+    n = int(sys.argv[1]) if len(sys.argv) == 2 else 10000
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = RunPool(_RIDCounter(), dict(), Notifier(dict()), None)
+    delete = lambda rid: None
+    stages = [PrepareStage(pool, delete), RunStage(pool, delete),
+              AnalyzeStage(pool, delete)]
+    expid = {
+        "log_level": logging.WARNING,
+        "file": "benchmark.py",
+        "class_name": "Benchmark",
+        "arguments": dict()
+    }
+
+    start = perf_counter()
+    for i in range(n):
+        pool.submit(expid, i % 10, None, False, "main")
+    submit_time = perf_counter() - start
+
+    # Runs go through the pipeline one at a time, so that each selection
+    # is made among all the queued runs.
+    selection_time = 0.0
+    transitions = [
+        (RunStatus.preparing, RunStatus.prepare_done),
+        (RunStatus.running, RunStatus.run_done),
+        (RunStatus.analyzing, RunStatus.deleting)
+    ]
+    for i in range(n):
+        for stage, statuses in zip(stages, transitions):
+            start = perf_counter()
+            run = stage._get_run()
+            selection_time += perf_counter() - start
+            for status in statuses:
+                run.status = status
+        loop.run_until_complete(pool.delete(run.rid))
+    loop.close()
+
+    print("{} runs: submit {:.1f}us/run, run selection {:.1f}us/stage".format(
+        n, submit_time/n*1e6, selection_time/(3*n)*1e6))
+
+if __name__ == "__main__":
+    main()
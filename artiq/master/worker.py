@@ -4,11 +4,14 @@ import asyncio
 import logging
 import subprocess
 import time
+from collections import deque
 
 from sipyco import pipe_ipc, pyon
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
+from sipyco.asyncio_tools import TaskObject
 
+from artiq.master import worker_ipc
 from artiq.tools import asyncio_wait_or_cancel
 
 
@@ -49,6 +52,9 @@ class Worker:
         self.rid = None
         self.filename = None
         self.ipc = None
+        self.binary_ipc = False
+        # timing information reported by the worker process
+        self.timing = dict()
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
 
         self.io_lock = asyncio.Lock()
@@ -76,7 +82,7 @@ class Worker:
     def _get_log_source(self):
         return "worker({},{})".format(self.rid, self.filename)
 
-    async def _create_process(self, log_level):
+    async def _create_process(self, log_level, preload=()):
         if self.ipc is not None:
             return  # process already exists, recycle
         await self.io_lock.acquire()
@@ -86,17 +92,44 @@ class Worker:
             self.ipc = pipe_ipc.AsyncioParentComm()
             env = os.environ.copy()
             env["PYTHONUNBUFFERED"] = "1"
+            env[worker_ipc.ENV_VAR] = worker_ipc.BINARY
             await self.ipc.create_subprocess(
                 sys.executable, "-m", "artiq.master.worker_impl",
-                self.ipc.get_address(), str(log_level),
+                self.ipc.get_address(), str(log_level), *preload,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 env=env, start_new_session=True)
+            # The process may be handed over to another Worker object
+            # (see release()), which then becomes the source of its logs.
+            ipc = self.ipc
+            ipc.log_source = self._get_log_source
+            get_log_source = lambda: ipc.log_source()
             asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stdout))
+                LogParser(get_log_source).stream_task(ipc.process.stdout))
             asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stderr))
+                LogParser(get_log_source).stream_task(ipc.process.stderr))
+        finally:
+            self.io_lock.release()
+
+    async def release(self):
+        """Closes this object without terminating the worker process, and
+        returns a new :class:`Worker` object controlling the process, so that
+        it can be used for another run.
+
+        Returns ``None`` if the process is not running. The caller should
+        then call :meth:`close` as usual."""
+        self.closed.set()
+        await self.io_lock.acquire()
+        try:
+            if self.ipc is None or self.ipc.process.returncode is not None:
+                return None
+            worker = Worker(self.handlers, self.send_timeout)
+            worker.ipc = self.ipc
+            worker.binary_ipc = self.binary_ipc
+            worker.rid = self.rid
+            worker.filename = self.filename
+            self.ipc.log_source = worker._get_log_source
+            self.ipc = None
+            return worker
         finally:
             self.io_lock.release()
 
@@ -157,8 +190,12 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        if self.binary_ipc:
+            for data in worker_ipc.encode_frame(obj):
+                self.ipc.write(data)
+        else:
+            line = pyon.encode(obj)
+            self.ipc.write((line + "\n").encode())
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -176,10 +213,46 @@ class Worker:
                 "Data transmission to worker cancelled (RID {})".format(
                     self.rid))
 
+    async def _read_exactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = await self.ipc.read(n - len(data))
+            if not chunk:
+                raise WorkerError(
+                    "Worker ended while attempting to receive data (RID {})".
+                    format(self.rid))
+            data += chunk
+        return data
+
+    async def _read_object(self):
+        first = await self.ipc.read(1)
+        if first == worker_ipc.FRAME_MARKER:
+            try:
+                obj = await worker_ipc.read_frame_async(self._read_exactly)
+            except WorkerError:
+                raise
+            except:
+                raise WorkerError(
+                    "Worker sent invalid frame (RID {})".format(self.rid))
+            # The worker supports binary framing; use it from now on.
+            self.binary_ipc = True
+            return obj
+        line = first + await self.ipc.readline()
+        if not line:
+            raise WorkerError(
+                "Worker ended while attempting to receive data (RID {})".
+                format(self.rid))
+        try:
+            obj = pyon.decode(line.decode())
+        except:
+            raise WorkerError("Worker sent invalid PYON data (RID {})".format(
+                self.rid))
+        return obj
+
     async def _recv(self, timeout):
         assert self.io_lock.locked()
         fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
+            [self._read_object(), self.closed.wait()],
             timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
@@ -188,17 +261,15 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
-        line = fs[0].result()
-        if not line:
-            raise WorkerError(
-                "Worker ended while attempting to receive data (RID {})".
-                format(self.rid))
-        try:
-            obj = pyon.decode(line.decode())
-        except:
-            raise WorkerError("Worker sent invalid PYON data (RID {})".format(
-                self.rid))
-        return obj
+        return fs[0].result()
+
+    def _update_datasets(self, mods):
+        for mod in mods:
+            try:
+                self.handlers["update_dataset"](mod)
+            except:
+                logger.error("failed to apply dataset update from worker "
+                             "(RID %s)", self.rid, exc_info=True)
 
     async def _handle_worker_requests(self):
         while True:
@@ -212,11 +283,16 @@ class Worker:
                 raise WorkerWatchdogTimeout
             action = obj["action"]
             if action == "completed":
+                self.timing.update(obj.get("timing", dict()))
                 return True
             elif action == "pause":
                 return False
             elif action == "exception":
                 raise WorkerInternalException
+            elif action == "update_datasets":
+                # Batched, asynchronous updates: there is no reply.
+                self._update_datasets(obj["mods"])
+                continue
             elif action == "create_watchdog":
                 func = self.create_watchdog
             elif action == "delete_watchdog":
@@ -258,7 +334,7 @@ class Worker:
         return completed
 
     async def build(self, rid, pipeline_name, wd, expid, priority,
-                    timeout=15.0):
+                    timeout=15.0, stream_results=None):
         self.rid = rid
         self.filename = os.path.basename(expid["file"])
         await self._create_process(expid["log_level"])
@@ -268,7 +344,8 @@ class Worker:
              "pipeline_name": pipeline_name,
              "wd": wd,
              "expid": expid,
-             "priority": priority},
+             "priority": priority,
+             "stream_results": stream_results},
             timeout)
 
     async def prepare(self):
@@ -307,3 +384,112 @@ class Worker:
                                   timeout)
         del self.register_experiment
         return r
+
+
+class WorkerPool(TaskObject):
+    """Keeps a number of idle worker processes spawned in advance, so that
+    new runs do not have to wait for the Python interpreter to start and
+    import the worker modules.
+
+    Workers are handed out by :meth:`get` and replenished in the
+    background, so that at most ``size`` idle processes exist. The worker
+    processes additionally import the modules listed in ``preload`` when
+    they start.
+    """
+    def __init__(self, handlers, size, preload=()):
+        self.handlers = handlers
+        self.size = size
+        self.preload = list(preload)
+
+        self._idle = deque()
+        self._replenish = asyncio.Event()
+
+    def get(self):
+        """Returns an idle pre-spawned worker, or ``None`` if none is
+        available."""
+        self._replenish.set()
+        while self._idle:
+            worker = self._idle.popleft()
+            if worker.ipc.process.returncode is None:
+                return worker
+            logger.warning("pre-spawned worker exited with status code %s",
+                           worker.ipc.process.returncode)
+            asyncio.ensure_future(worker.close())
+        return None
+
+    async def _do(self):
+        while True:
+            while len(self._idle) < self.size:
+                worker = Worker(self.handlers)
+                try:
+                    await worker._create_process(logging.WARNING,
+                                                 self.preload)
+                except asyncio.CancelledError:
+                    await worker.close()
+                    raise
+                except Exception:
+                    logger.warning("failed to pre-spawn worker",
+                                   exc_info=True)
+                    await worker.close()
+                    break
+                self._idle.append(worker)
+            self._replenish.clear()
+            await self._replenish.wait()
+
+    async def stop(self):
+        await TaskObject.stop(self)
+        while self._idle:
+            await self._idle.popleft().close()
+
+
+class StickyWorkers:
+    """Keeps the worker processes of completed runs, so that later runs of
+    the same experiment can reuse them, with the experiment module already
+    imported and the device drivers already created.
+
+    Workers are stored and looked up by a key identifying the experiment
+    code they have imported (see :meth:`artiq.master.scheduler.Run.build`).
+    At most ``size`` idle workers are kept; the least recently stored ones
+    are terminated first. All idle workers are terminated when the
+    ``generation`` attribute of ``device_db`` changes.
+    """
+    def __init__(self, size, device_db):
+        self.size = size
+        self.device_db = device_db
+
+        self._idle = []  # (key, worker), least recently stored first
+        self._generation = device_db.generation
+
+    def _check_device_db(self):
+        if self.device_db.generation != self._generation:
+            self._generation = self.device_db.generation
+            if self._idle:
+                logger.debug("device database changed, terminating %d "
+                             "sticky workers", len(self._idle))
+            self._close_idle(len(self._idle))
+
+    def _close_idle(self, n):
+        for _key, worker in self._idle[:n]:
+            asyncio.ensure_future(worker.close())
+        del self._idle[:n]
+
+    def get(self, key):
+        """Returns an idle worker stored with ``key``, or ``None``."""
+        self._check_device_db()
+        for i in reversed(range(len(self._idle))):
+            if self._idle[i][0] == key:
+                _key, worker = self._idle.pop(i)
+                if worker.ipc.process.returncode is None:
+                    return worker
+                asyncio.ensure_future(worker.close())
+        return None
+
+    def put(self, key, worker):
+        """Stores ``worker``, which must have completed its run."""
+        self._check_device_db()
+        self._idle.append((key, worker))
+        self._close_idle(max(len(self._idle) - self.size, 0))
+
+    async def stop(self):
+        while self._idle:
+            await self._idle.pop()[1].close()
@@ -5,10 +5,18 @@ standalone command line tools).
 """
 
 from operator import setitem
+import copy
 import importlib
 import logging
+import os
+import queue
+import threading
+import time
 
-from sipyco.sync_struct import Notifier
+import numpy
+import h5py
+
+from sipyco.sync_struct import Notifier, process_mod
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
 
 
@@ -53,6 +61,18 @@ class DeviceError(Exception):
     pass
 
 
+def _desc_key(desc):
+    # Hashable equivalent of a device description, such that equal
+    # descriptions have equal keys.
+    if isinstance(desc, dict):
+        return (dict, frozenset((k, _desc_key(v)) for k, v in desc.items()))
+    elif isinstance(desc, (list, tuple)):
+        return (list, tuple(_desc_key(v) for v in desc))
+    else:
+        hash(desc)
+        return desc
+
+
 class DeviceManager:
     """Handles creation and destruction of local device drivers and controller
     RPC clients."""
@@ -60,13 +80,23 @@ class DeviceManager:
         self.ddb = ddb
         self.virtual_devices = virtual_devices
         self.active_devices = []
+        # Descriptions are requested from the device database (possibly
+        # through the master) once per name, and drivers are looked up by
+        # description without comparing it to each active device.
+        self._desc_cache = dict()
+        self._active_by_key = dict()
 
     def get_device_db(self):
         """Returns the full contents of the device database."""
         return self.ddb.get_device_db()
 
     def get_desc(self, name):
-        return self.ddb.get(name, resolve_alias=True)
+        try:
+            return self._desc_cache[name]
+        except KeyError:
+            desc = self.ddb.get(name, resolve_alias=True)
+            self._desc_cache[name] = desc
+            return desc
 
     def get(self, name):
         """Get the device driver or controller client corresponding to a
@@ -80,9 +110,17 @@ class DeviceManager:
             raise DeviceError("Failed to get description of device '{}'"
                               .format(name)) from e
 
-        for existing_desc, existing_dev in self.active_devices:
-            if desc == existing_desc:
-                return existing_dev
+        try:
+            key = _desc_key(desc)
+        except TypeError:
+            # unhashable values in the description
+            key = None
+            for existing_desc, existing_dev in self.active_devices:
+                if desc == existing_desc:
+                    return existing_dev
+        else:
+            if key in self._active_by_key:
+                return self._active_by_key[key]
 
         try:
             dev = _create_device(desc, self)
@@ -90,6 +128,8 @@ class DeviceManager:
             raise DeviceError("Failed to create device '{}'"
                               .format(name)) from e
         self.active_devices.append((desc, dev))
+        if key is not None:
+            self._active_by_key[key] = dev
         return dev
 
     def close_devices(self):
@@ -104,6 +144,116 @@ class DeviceManager:
             except Exception as e:
                 logger.warning("Exception %r when closing device %r", e, dev)
         self.active_devices.clear()
+        self._active_by_key.clear()
+        self._desc_cache.clear()
+
+
+def _same_index(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:
+        # e.g. numpy arrays used as indices
+        return False
+
+
+class DatasetUpdateBatcher:
+    """Buffers the mods published by a :class:`DatasetManager` and passes
+    them in batches to ``send`` (a function taking a list of mods).
+
+    Pending mods are sent once ``max_mods`` of them have accumulated, when
+    the oldest of them is older than ``max_delay`` seconds (from a background
+    timer thread), or when :meth:`flush` is called. Users must flush before
+    any other request to the master, so that the master observes the
+    updates in order. Mods remain pending if ``send`` raises.
+
+    ``send`` is always called with ``lock`` held (a new reentrant lock by
+    default); users that write to the same channel from other places should
+    hold it too.
+
+    Values are copied when the mods are buffered, so that later changes of
+    the objects by the experiment are not sent with earlier mods, and the
+    timer thread only encodes these copies. Mods of the same dataset are
+    merged: setting or deleting a dataset supersedes all its pending mods,
+    mutations of a dataset whose setting is still pending are applied to the
+    pending value, and consecutive assignments to the same element keep only
+    the last value.
+    """
+    def __init__(self, send, max_mods=1000, max_delay=0.1, lock=None):
+        self.send = send
+        self.max_mods = max_mods
+        self.max_delay = max_delay
+
+        self._lock = threading.RLock() if lock is None else lock
+        self._pending = dict()  # dataset key -> list of mods
+        self._count = 0
+        self._first_time = None
+        self._timer = None
+
+    def update(self, mod):
+        mod = copy.deepcopy(mod)
+        with self._lock:
+            if mod["path"]:
+                key = mod["path"][0]
+                pending = self._pending.setdefault(key, [])
+                if (pending and not pending[0]["path"]
+                        and pending[0]["action"] == "setitem"):
+                    process_mod({key: pending[0]["value"]}, mod)
+                else:
+                    last = pending[-1] if pending else None
+                    if (last is not None
+                            and mod["action"] == "setitem"
+                            and last["action"] == "setitem"
+                            and last["path"] == mod["path"]
+                            and _same_index(last["key"], mod["key"])):
+                        pending[-1] = mod
+                    else:
+                        pending.append(mod)
+                        self._count += 1
+            else:
+                key = mod["key"]
+                pending = self._pending.pop(key, [])
+                self._count -= len(pending) - 1
+                self._pending[key] = [mod]
+
+            now = time.monotonic()
+            if self._first_time is None:
+                self._first_time = now
+            if (self._count >= self.max_mods
+                    or now - self._first_time >= self.max_delay):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(
+                    self.max_delay - (now - self._first_time),
+                    self._timer_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _timer_flush(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # cancelled by a flush after expiring
+                return
+            try:
+                self._flush()
+            except:
+                logger.warning("failed to send dataset updates",
+                               exc_info=True)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            mods = [mod for mods in self._pending.values() for mod in mods]
+            self.send(mods)
+            self._pending.clear()
+            self._count = 0
+        self._first_time = None
+
+    def flush(self):
+        """Sends all pending mods."""
+        with self._lock:
+            self._flush()
 
 
 class DatasetManager:
@@ -111,6 +261,7 @@ class DatasetManager:
         self._broadcaster = Notifier(dict())
         self.local = dict()
         self.archive = dict()
+        self._stream_writer = None
 
         self.ddb = ddb
         self._broadcaster.publish = ddb.update
@@ -126,8 +277,12 @@ class DatasetManager:
 
         if archive:
             self.local[key] = value
+            if self._stream_writer is not None:
+                self._stream_writer.set("datasets", key, value)
         elif key in self.local:
             del self.local[key]
+            if self._stream_writer is not None:
+                self._stream_writer.delete("datasets", key)
 
     def _get_mutation_target(self, key):
         target = self.local.get(key, None)
@@ -147,9 +302,13 @@ class DatasetManager:
             else:
                 index = slice(*index)
         setitem(target, index, value)
+        if self._stream_writer is not None and key in self.local:
+            self._stream_writer.mutate("datasets", key, index, value)
 
     def append_to(self, key, value):
         self._get_mutation_target(key).append(value)
+        if self._stream_writer is not None and key in self.local:
+            self._stream_writer.append("datasets", key, value)
 
     def get(self, key, archive=False):
         if key in self.local:
@@ -161,6 +320,8 @@ class DatasetManager:
                 logger.warning("Dataset '%s' is already in archive, "
                                "overwriting", key, stack_info=True)
             self.archive[key] = data
+            if self._stream_writer is not None:
+                self._stream_writer.set("archive", key, data)
         return data
 
     def write_hdf5(self, f):
@@ -172,6 +333,24 @@ class DatasetManager:
         for k, v in self.archive.items():
             _write(archive_group, k, v)
 
+    def start_streaming(self, writer):
+        """Writes the archived datasets through ``writer`` (a
+        :class:`HDF5StreamWriter`), then keeps writing them as they are
+        modified, until :meth:`finish_streaming` is called."""
+        for k, v in self.local.items():
+            writer.set("datasets", k, v)
+        for k, v in self.archive.items():
+            writer.set("archive", k, v)
+        self._stream_writer = writer
+
+    def finish_streaming(self, metadata):
+        """Completes the file of the current stream writer, adding the
+        ``metadata`` dictionary to its root group."""
+        writer = self._stream_writer
+        self._stream_writer = None
+        writer.finish({"datasets": self.local, "archive": self.archive},
+                      metadata)
+
 
 def _write(group, k, v):
     # Add context to exception message when the user writes a dataset that is
@@ -181,3 +360,197 @@ def _write(group, k, v):
     except TypeError as e:
         raise TypeError("Error writing dataset '{}' of type '{}': {}".format(
             k, type(v), e))
+
+
+def _stream_array(value):
+    # Returns the value as a numeric array that can be stored in a resizable
+    # HDF5 dataset, or None.
+    try:
+        data = numpy.asarray(value)
+    except ValueError:  # e.g. ragged nested lists
+        return None
+    if data.ndim == 0 or data.dtype.kind not in "biufc":
+        return None
+    return data
+
+
+def _resizable(dataset):
+    return bool(dataset.maxshape) and dataset.maxshape[0] is None
+
+
+def _same_contents(dataset, value):
+    data = _stream_array(value)
+    if (data is None or data.shape != dataset.shape
+            or data.dtype != dataset.dtype):
+        return False
+    return numpy.array_equal(dataset[()], data,
+                             equal_nan=data.dtype.kind in "fc")
+
+
+class HDF5StreamWriter:
+    """Writes datasets incrementally into an HDF5 file from a background
+    thread, so that results are not only written to disk at the end of an
+    experiment.
+
+    Numeric arrays and lists are stored in chunked datasets that are
+    resizable along their first axis, so that appending to them only writes
+    the new elements. ``compression`` is passed to :meth:`h5py.Group.create_dataset`
+    for those datasets. Other values are written whole.
+
+    The file is written under a temporary name (``filename`` followed by
+    ``.part``) and only renamed to ``filename`` by :meth:`finish`. If the
+    experiment crashes, the temporary file holds the datasets as of the last
+    periodic flush, every ``flush_period`` seconds.
+    """
+    def __init__(self, filename, compression=None, flush_period=1.0):
+        self.filename = filename
+        self.compression = compression
+        self.flush_period = flush_period
+
+        self._file = h5py.File(filename + ".part", "w")
+        self._groups = {name: self._file.create_group(name)
+                        for name in ("datasets", "archive")}
+        # Keys of datasets whose streamed copy is incomplete or incorrect
+        # (e.g. type changes), and which are written whole by finish().
+        self._rewrite = set()
+        # Keys of datasets set to an empty list, created on the first append.
+        self._empty = set()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def set(self, group, key, value):
+        # Values are copied, as the experiment may modify them before the
+        # writer thread gets to them.
+        if isinstance(value, numpy.ndarray):
+            value = value.copy()
+        else:
+            value = copy.deepcopy(value)
+        self._queue.put(("set", group, key, value))
+
+    def delete(self, group, key):
+        self._queue.put(("delete", group, key))
+
+    def mutate(self, group, key, index, value):
+        self._queue.put(("mutate", group, key, index, copy.deepcopy(value)))
+
+    def append(self, group, key, value):
+        self._queue.put(("append", group, key, copy.deepcopy(value)))
+
+    def _set(self, group, key, value):
+        self._rewrite.discard((group.name, key))
+        self._empty.discard((group.name, key))
+        if key in group:
+            del group[key]
+        data = _stream_array(value)
+        if data is None:
+            _write(group, key, value)
+        elif data.size == 0 and isinstance(value, list):
+            # The type of the elements is only known after the first append.
+            self._empty.add((group.name, key))
+        else:
+            group.create_dataset(key, data=data, chunks=True,
+                                 maxshape=(None,) + data.shape[1:],
+                                 compression=self.compression)
+
+    def _append(self, group, key, value):
+        element = numpy.asarray(value)
+        if (group.name, key) in self._empty:
+            self._empty.discard((group.name, key))
+            if element.dtype.kind not in "biufc":
+                self._rewrite.add((group.name, key))
+                return
+            group.create_dataset(key, shape=(0,) + element.shape,
+                                 dtype=element.dtype, chunks=True,
+                                 maxshape=(None,) + element.shape,
+                                 compression=self.compression)
+        if (group.name, key) in self._rewrite:
+            return
+        dataset = group[key]
+        if (not _resizable(dataset)
+                or dataset.shape[1:] != element.shape
+                or numpy.result_type(dataset.dtype, element) != dataset.dtype):
+            self._rewrite.add((group.name, key))
+            return
+        n = dataset.shape[0]
+        dataset.resize(n + 1, axis=0)
+        dataset[n] = element
+
+    def _mutate(self, group, key, index, value):
+        if ((group.name, key) in self._rewrite
+                or (group.name, key) in self._empty):
+            return
+        dataset = group[key]
+        data = numpy.asarray(value)
+        if (not _resizable(dataset)
+                or numpy.result_type(dataset.dtype, data) != dataset.dtype):
+            self._rewrite.add((group.name, key))
+            return
+        dataset[index] = data
+
+    def _delete(self, group, key):
+        self._rewrite.discard((group.name, key))
+        self._empty.discard((group.name, key))
+        if key in group:
+            del group[key]
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                op = self._queue.get(timeout=self.flush_period)
+            except queue.Empty:
+                op = None
+            else:
+                if op[0] == "finish":
+                    return
+            if op is not None:
+                action, group_name, key, *args = op
+                group = self._groups[group_name]
+                try:
+                    if action == "set":
+                        self._set(group, key, *args)
+                    elif action == "delete":
+                        self._delete(group, key)
+                    elif action == "append":
+                        self._append(group, key, *args)
+                    elif action == "mutate":
+                        self._mutate(group, key, *args)
+                except Exception:
+                    logger.debug("failed to stream %s of dataset '%s', "
+                                 "writing it at completion", action, key,
+                                 exc_info=True)
+                    self._rewrite.add((group.name, key))
+            now = time.monotonic()
+            if now - last_flush >= self.flush_period:
+                self._file.flush()
+                last_flush = now
+
+    def finish(self, groups, metadata):
+        """Waits for pending writes, makes sure the file matches ``groups``
+        (a dictionary mapping group names to dictionaries of datasets),
+        writes ``metadata`` into the root group and renames the file to its
+        final name."""
+        self._queue.put(("finish",))
+        self._thread.join()
+        try:
+            for group_name, datasets in groups.items():
+                group = self._groups[group_name]
+                for k, v in datasets.items():
+                    # Only resizable datasets are kept, and only if they
+                    # match the final value: the experiment may have
+                    # modified values in place without mutate_dataset, and
+                    # some mutations cannot be reproduced (e.g. list slice
+                    # assignments changing the length).
+                    if ((group.name, k) not in self._rewrite
+                            and k in group and _resizable(group[k])
+                            and _same_contents(group[k], v)):
+                        continue
+                    if k in group:
+                        del group[k]
+                    _write(group, k, v)
+            for k, v in metadata.items():
+                self._file[k] = v
+        finally:
+            self._file.close()
+        os.replace(self.filename + ".part", self.filename)
@@ -10,7 +10,9 @@ import sys
 import time
 import os
 import inspect
+import importlib
 import logging
+import threading
 import traceback
 from collections import OrderedDict
 
@@ -22,28 +24,64 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq import tools
-from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
+from artiq.master import worker_ipc
+from artiq.master.worker_db import (DeviceManager, DatasetManager,
+                                   DatasetUpdateBatcher, HDF5StreamWriter,
+                                   DummyDevice)
+from artiq.master.rid_counter import record_rid
 from artiq.language.environment import (
     is_public_experiment, TraceArgumentManager, ProcessArgumentManager
 )
 from artiq.language.core import set_watchdog_factory, TerminationRequested
 from artiq.language.types import TBool
 from artiq.compiler import import_cache
-from artiq.coredevice.core import CompileError, host_only, _render_diagnostic
+from artiq.coredevice.core import (Core, CompileError, host_only,
+                                   _render_diagnostic)
 from artiq import __version__ as artiq_version
 
 
 ipc = None
+binary_ipc = os.environ.get(worker_ipc.ENV_VAR) == worker_ipc.BINARY
+
+
+def _read_exactly(n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = ipc.read(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
 
 
 def get_object():
-    line = ipc.readline().decode()
+    first = ipc.read(1)
+    if first == worker_ipc.FRAME_MARKER:
+        return worker_ipc.read_frame(_read_exactly)
+    line = (first + ipc.readline()).decode()
     return pyon.decode(line)
 
 
+# Also held by the dataset update timer thread.
+ipc_write_lock = threading.RLock()
+
+
+def _write_object(obj):
+    with ipc_write_lock:
+        if binary_ipc:
+            for data in worker_ipc.encode_frame(obj):
+                ipc.write(data)
+        else:
+            ds = pyon.encode(obj)
+            ipc.write((ds + "\n").encode())
+
+
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
+    # Send pending dataset updates first, so that the master processes them
+    # before any subsequent request (e.g. get_dataset) or completion.
+    with ipc_write_lock:
+        dataset_updates.flush()
+        _write_object(obj)
 
 
 def make_parent_action(action):
@@ -68,9 +106,18 @@ class ParentDeviceDB:
     get = make_parent_action("get_device")
 
 
+def _send_dataset_updates(mods):
+    # No reply is expected; errors are logged by the master.
+    _write_object({"action": "update_datasets", "mods": mods})
+
+
+dataset_updates = DatasetUpdateBatcher(_send_dataset_updates,
+                                       lock=ipc_write_lock)
+
+
 class ParentDatasetDB:
     get = make_parent_action("get_dataset")
-    update = make_parent_action("update_dataset")
+    update = dataset_updates.update
 
 
 class Watchdog:
@@ -208,8 +255,11 @@ def setup_diagnostics(experiment_file, repository_path):
         render_diagnostic
 
 
-def put_completed():
-    put_object({"action": "completed"})
+def put_completed(timing=None):
+    obj = {"action": "completed"}
+    if timing is not None:
+        obj["timing"] = timing
+    put_object(obj)
 
 
 def put_exception_report():
@@ -238,30 +288,60 @@ def main():
     multiline_log_config(level=int(sys.argv[2]))
     ipc = pipe_ipc.ChildComm(sys.argv[1])
 
+    # Pre-spawned workers are started before the log level of their run is
+    # known and may be asked to import additional modules ahead of time.
+    for module in sys.argv[3:]:
+        try:
+            importlib.import_module(module)
+        except:
+            logging.warning("Failed to preload module '%s'", module,
+                            exc_info=True)
+
     start_time = None
     run_time = None
     rid = None
     expid = None
     exp = None
+    exp_key = None
     exp_inst = None
     repository_path = None
+    dataset_mgr = None
 
-    def write_results():
-        filename = "{:09}-{}.h5".format(rid, exp.__name__)
-        with h5py.File(filename, "w") as f:
-            dataset_mgr.write_hdf5(f)
-            f["artiq_version"] = artiq_version
-            f["rid"] = rid
-            f["start_time"] = start_time
-            f["run_time"] = run_time
-            f["expid"] = pyon.encode(expid)
+    stream_results = None
 
+    def results_filename():
+        return "{:09}-{}.h5".format(rid, exp.__name__)
+
+    def write_results():
+        metadata = {
+            "artiq_version": artiq_version,
+            "rid": rid,
+            "start_time": start_time,
+            "run_time": run_time,
+            "expid": pyon.encode(expid)
+        }
+        if stream_results is not None:
+            dataset_mgr.finish_streaming(metadata)
+        else:
+            with h5py.File(results_filename(), "w") as f:
+                dataset_mgr.write_hdf5(f)
+                for k, v in metadata.items():
+                    f[k] = v
+        try:
+            record_rid(os.path.dirname(os.getcwd()), rid)
+        except OSError:
+            logging.warning("Failed to update RID index", exc_info=True)
+
+    # The process may be kept to build further runs of the same experiment
+    # (sticky workers), reusing the imported experiment class and the
+    # device drivers.
     device_mgr = DeviceManager(ParentDeviceDB,
                                virtual_devices={"scheduler": Scheduler(),
                                                 "ccb": CCB()})
-    dataset_mgr = DatasetManager(ParentDatasetDB)
 
     import_cache.install_hook()
+    ready_time = time.time()
+    start_dir = os.getcwd()
 
     try:
         while True:
@@ -271,6 +351,8 @@ def main():
                 start_time = time.time()
                 rid = obj["rid"]
                 expid = obj["expid"]
+                stream_results = obj.get("stream_results")
+                logging.getLogger().setLevel(expid["log_level"])
                 if obj["wd"] is not None:
                     # Using repository
                     experiment_file = os.path.join(obj["wd"], expid["file"])
@@ -279,23 +361,29 @@ def main():
                     experiment_file = expid["file"]
                     repository_path = None
                 setup_diagnostics(experiment_file, repository_path)
-                exp = get_experiment(experiment_file, expid["class_name"])
+                if exp_key != (experiment_file, expid["class_name"]):
+                    exp = get_experiment(experiment_file, expid["class_name"])
+                    exp_key = (experiment_file, expid["class_name"])
+                dataset_mgr = DatasetManager(ParentDatasetDB)
                 device_mgr.virtual_devices["scheduler"].set_run_info(
                     rid, obj["pipeline_name"], expid, obj["priority"])
                 start_local_time = time.localtime(start_time)
-                dirname = os.path.join("results",
+                dirname = os.path.join(start_dir, "results",
                                    time.strftime("%Y-%m-%d", start_local_time),
                                    time.strftime("%H", start_local_time))
                 os.makedirs(dirname, exist_ok=True)
                 os.chdir(dirname)
                 argument_mgr = ProcessArgumentManager(expid["arguments"])
                 exp_inst = exp((device_mgr, dataset_mgr, argument_mgr, {}))
-                put_completed()
+                put_completed({"ready": ready_time})
             elif action == "prepare":
                 exp_inst.prepare()
                 put_completed()
             elif action == "run":
                 run_time = time.time()
+                if stream_results is not None:
+                    dataset_mgr.start_streaming(HDF5StreamWriter(
+                        results_filename(), stream_results.get("compression")))
                 try:
                     exp_inst.run()
                 except:
@@ -307,9 +395,17 @@ def main():
             elif action == "analyze":
                 try:
                     exp_inst.analyze()
-                    put_completed()
                 finally:
+                    write_start = time.time()
                     write_results()
+                write_time = time.time() - write_start
+                # Do not hold the core device connection while waiting for
+                # a further run. It is reopened on demand, without checking
+                # the system information again.
+                for _desc, dev in device_mgr.active_devices:
+                    if isinstance(dev, Core):
+                        dev.close()
+                put_completed({"write_results": write_time})
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
@@ -0,0 +1,127 @@
+"""Binary framing of the messages exchanged between the master and the
+worker processes.
+
+By default, messages are newline-terminated PYON. In binary framing mode, a
+message is sent as a frame starting with a marker byte (which cannot start a
+PYON message), followed by a header, the PYON encoding of the message in
+which numpy arrays have been replaced by references, and the raw contents of
+those arrays. Arrays thus cross the pipe without text conversion.
+
+The master offers binary framing to the worker through the environment
+variable named by ``ENV_VAR``. A worker that supports it sends all its
+messages as frames, and the master switches to frames once it has received
+one. Both sides accept either format at any time, so that old workers keep
+working with PYON only.
+"""
+
+import struct
+
+import numpy
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+
+from sipyco import pyon
+
+
+ENV_VAR = "ARTIQ_WORKER_IPC"
+BINARY = "binary"
+
+FRAME_MARKER = b"\x00"
+
+# length of the PYON header, number of out-of-band buffers
+_frame_header = struct.Struct("<II")
+_buffer_ref_key = "__artiq_ipc_buffer__"
+
+
+def _extract_buffers(obj, buffers):
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            return obj
+        buffers.append(
+            numpy.ascontiguousarray(obj).reshape(-1).view(numpy.uint8))
+        return {_buffer_ref_key: (len(buffers) - 1,
+                                  dtype_to_descr(obj.dtype), obj.shape)}
+    elif isinstance(obj, dict):
+        r = None
+        for k, v in obj.items():
+            nv = _extract_buffers(v, buffers)
+            if nv is not v:
+                if r is None:
+                    r = obj.copy()
+                r[k] = nv
+        return obj if r is None else r
+    elif isinstance(obj, (list, tuple)):
+        items = [_extract_buffers(v, buffers) for v in obj]
+        if all(nv is v for nv, v in zip(items, obj)):
+            return obj
+        return type(obj)(items)
+    else:
+        return obj
+
+
+def _insert_buffers(obj, buffers):
+    if isinstance(obj, dict):
+        if _buffer_ref_key in obj and len(obj) == 1:
+            index, descr, shape = obj[_buffer_ref_key]
+            buf = buffers[index]
+            if not isinstance(buf, bytearray):
+                buf = bytearray(buf)
+            return numpy.frombuffer(buf, descr_to_dtype(descr)).reshape(shape)
+        for k, v in obj.items():
+            obj[k] = _insert_buffers(v, buffers)
+        return obj
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            obj[i] = _insert_buffers(v, buffers)
+        return obj
+    elif isinstance(obj, tuple):
+        return tuple(_insert_buffers(v, buffers) for v in obj)
+    else:
+        return obj
+
+
+def encode_frame(obj):
+    """Encodes ``obj`` into a frame, returned as a list of bytes-like objects
+    to be written in order (the header, then the out-of-band buffers)."""
+    buffers = []
+    header = pyon.encode(_extract_buffers(obj, buffers)).encode()
+    prefix = [FRAME_MARKER, _frame_header.pack(len(header), len(buffers))]
+    if buffers:
+        prefix.append(struct.pack("<{}Q".format(len(buffers)),
+                                  *(b.nbytes for b in buffers)))
+    prefix.append(header)
+    return [b"".join(prefix)] + [memoryview(b) for b in buffers]
+
+
+def _decode(header, buffers):
+    obj = pyon.decode(bytes(header).decode())
+    if buffers:
+        obj = _insert_buffers(obj, buffers)
+    return obj
+
+
+def read_frame(read_exactly):
+    """Reads the remainder of a frame (after the marker byte) using the
+    ``read_exactly(n)`` function, and returns the decoded object."""
+    header_len, n_buffers = _frame_header.unpack(
+        read_exactly(_frame_header.size))
+    lengths = ()
+    if n_buffers:
+        lengths = struct.unpack("<{}Q".format(n_buffers),
+                                read_exactly(8*n_buffers))
+    header = read_exactly(header_len)
+    buffers = [read_exactly(length) for length in lengths]
+    return _decode(header, buffers)
+
+
+async def read_frame_async(read_exactly):
+    """Coroutine version of :func:`read_frame`, where ``read_exactly`` is
+    also a coroutine function."""
+    header_len, n_buffers = _frame_header.unpack(
+        await read_exactly(_frame_header.size))
+    lengths = ()
+    if n_buffers:
+        lengths = struct.unpack("<{}Q".format(n_buffers),
+                                await read_exactly(8*n_buffers))
+    header = await read_exactly(header_len)
+    buffers = [await read_exactly(length) for length in lengths]
+    return _decode(header, buffers)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from artiq.compiler import elf
+
+
+_source = """
+static int helper(int x) { return x*3; }
+int counter = 5;
+int kernel(int a) {
+    int s = 0;
+    for (int i = 0; i < a; i++)
+        s += helper(i) + counter;
+    return s;
+}
+"""
+
+
+@unittest.skipUnless(shutil.which("cc"), "no C compiler")
+class TestStripDebug(unittest.TestCase):
+    def build(self, *flags):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, "kernel.c")
+            output = os.path.join(tmpdir, "kernel.out")
+            with open(source, "w") as f:
+                f.write(_source)
+            subprocess.check_call(["cc", "-g", "-O1", "-fPIC", *flags,
+                                   "-o", output, source])
+            with open(output, "rb") as f:
+                return f.read()
+
+    def test_shared_library(self):
+        library = self.build("-shared")
+        stripped = elf.strip_debug(library)
+        self.assertLess(len(stripped), len(library))
+
+        before = elf._ELF(library)
+        after = elf._ELF(stripped)
+        self.assertTrue(any(s["name_str"].startswith(".debug")
+                            for s in before.sections))
+        self.assertEqual(
+            [s["name_str"] for s in after.sections],
+            [s["name_str"] for s in before.sections
+             if not s["name_str"].startswith(".debug")])
+        for section in after.sections:
+            original, = [s for s in before.sections
+                         if s["name_str"] == section["name_str"]]
+            if section["flags"] & elf.SHF_ALLOC:
+                self.assertEqual(section["offset"], original["offset"])
+            if section["type"] not in (elf.SHT_SYMTAB, elf.SHT_DYNSYM):
+                self.assertEqual(after.section_data(section),
+                                 before.section_data(original))
+
+        self.assertEqual(elf.strip_debug(stripped), stripped)
+
+    def test_unsupported(self):
+        with self.assertRaises(elf.UnsupportedELF):
+            elf.strip_debug(b"not an ELF file")
+        # relocatable objects have relocations against debug sections
+        with self.assertRaises(elf.UnsupportedELF):
+            elf.strip_debug(self.build("-c"))
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from artiq.compiler.kernel_cache import KernelCache
+
+
+class _Target:
+    triple = "riscv32-unknown-linux"
+    features = ["m", "a"]
+
+
+class _OtherTarget(_Target):
+    features = ["m", "a", "f", "d"]
+
+
+class TestKernelCache(unittest.TestCase):
+    def test_key(self):
+        key = KernelCache.key(_Target(), "define void @f() {}")
+        self.assertEqual(key, KernelCache.key(_Target(), "define void @f() {}"))
+        self.assertNotEqual(key, KernelCache.key(_Target(), "define void @g() {}"))
+        self.assertNotEqual(key, KernelCache.key(_OtherTarget(), "define void @f() {}"))
+
+    def test_memory(self):
+        cache = KernelCache(max_entries=2)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", b"lib a", b"a")
+        cache.set("b", b"lib b", b"b")
+        self.assertEqual(cache.get("a"), (b"lib a", b"a"))
+        cache.set("c", b"lib c", b"c")
+        # least recently used entry evicted
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), (b"lib c", b"c"))
+        self.assertEqual(cache.get_stats(),
+                         {"hits": 2, "disk_hits": 0, "misses": 2})
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, "kernels")
+            KernelCache(directory).set("a", b"lib a", b"a")
+            cache = KernelCache(directory)
+            self.assertEqual(cache.get("a"), (b"lib a", b"a"))
+            self.assertEqual(cache.get("a"), (b"lib a", b"a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get_stats(),
+                             {"hits": 2, "disk_hits": 1, "misses": 1})
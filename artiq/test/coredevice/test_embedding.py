@@ -538,3 +538,47 @@ class _Alignment(EnvExperiment):
 class AlignmentTest(ExperimentCase):
     def test_tuple(self):
         self.create(_Alignment).run()
+
+
+class _Precompile(EnvExperiment):
+    kernel_invariants = {"gain"}
+
+    def build(self):
+        self.setattr_device("core")
+        self.gain = 2
+        self.offset = 1
+        self.received = []
+
+    @rpc
+    def receive(self, value):
+        self.received.append(value)
+
+    @kernel
+    def compute(self, values):
+        for value in values:
+            self.receive(value*self.gain + self.offset)
+        return len(values)
+
+    def run(self):
+        values = [1, 2, 3]
+        precompiled = self.core.precompile(self.compute, values)
+        # non-invariant attributes keep their values at precompilation time
+        self.offset = 100
+        return precompiled, values
+
+
+class PrecompileTest(ExperimentCase):
+    def test_precompile(self):
+        exp = self.create(_Precompile)
+        precompiled, values = exp.run()
+        self.assertEqual(precompiled(), 3)
+        self.assertEqual(precompiled(), 3)
+        self.assertEqual(exp.received, [3, 5, 7]*2)
+
+        values.append(4)
+        with self.assertRaises(ValueError):
+            precompiled()
+        values.pop()
+        exp.gain = 3
+        with self.assertRaises(ValueError):
+            precompiled()
@@ -0,0 +1,37 @@
+# RUN: env ARTIQ_DUMP_UNOPT_LLVM=%t %python -m artiq.compiler.testbench.embedding +compile %s
+# RUN: OutputCheck %s --file-to-check=%t_unopt.ll
+
+from artiq.language.core import *
+from artiq.language.types import *
+import numpy as np
+
+int_list = list(range(1000))
+wide_int_list = [2**40 + i for i in range(1000)]
+float_list = [i / 2 for i in range(1000)]
+int_vec = np.arange(1000, dtype=np.int32)
+float_vec = np.linspace(0.0, 1.0, 1001)
+
+# The elements are emitted as little-endian binary data, in the order in
+# which the values are used.
+
+# CHECK-L: [4000 x i8] c"\00\00\00\00\01\00\00\00\02\00\00\00\03\00\00\00
+# CHECK-L: [8000 x i8] c"\00\00\00\00\00\01\00\00\01\00\00\00\00\01\00\00
+# CHECK-L: [8000 x i8] c"\00\00\00\00\00\00\00\00\00\00\00\00\00\00\E0?\00\00\00\00\00\00\F0?
+# CHECK-L: [4000 x i8] c"\00\00\00\00\01\00\00\00\02\00\00\00\03\00\00\00
+# CHECK-L: [8008 x i8] c"\00\00\00\00\00\00\00\00
+
+@kernel
+def entrypoint():
+    assert len(int_list) == 1000
+    assert int_list[0] == 0
+    assert int_list[999] == 999
+
+    assert wide_int_list[999] == 2**40 + 999
+
+    assert float_list[999] == 499.5
+
+    assert int_vec.shape == (1000, )
+    assert int_vec[999] == 999
+
+    assert float_vec.shape == (1001, )
+    assert float_vec[1000] == 1.0
@@ -1,12 +1,22 @@
 """Tests for the (Env)Experiment-facing dataset interface."""
 
 import copy
+import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+import h5py
+import numpy as np
+from sipyco import pyon
 from sipyco.sync_struct import process_mod
 
 from artiq.experiment import EnvExperiment
-from artiq.master.worker_db import DatasetManager
+from artiq.master.databases import DatasetDB
+from artiq.master.worker_db import (DatasetManager, DatasetUpdateBatcher,
+                                    HDF5StreamWriter)
 
 
 class MockDatasetDB:
@@ -103,3 +113,313 @@ class ExperimentDatasetCase(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.exp.append(KEY, 0)
 
+
+
+class BatchedDatasetCase(unittest.TestCase):
+    def setUp(self):
+        # Mirror the worker setup, where updates are batched on their way to
+        # the master while reads go through directly.
+        self.dataset_db = MockDatasetDB()
+        self.batches = []
+        def send(mods):
+            self.batches.append(mods)
+            for mod in mods:
+                self.dataset_db.update(mod)
+        self.batcher = DatasetUpdateBatcher(send, max_mods=10, max_delay=60)
+
+        class ParentDatasetDB:
+            get = self.dataset_db.get
+            update = self.batcher.update
+        self.dataset_mgr = DatasetManager(ParentDatasetDB)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def tearDown(self):
+        self.batcher.flush()
+
+    def test_append_after_set(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(5):
+            self.exp.append(KEY, i)
+        self.assertNotIn(KEY, self.dataset_db.data)
+        self.batcher.flush()
+        self.assertEqual(self.dataset_db.data[KEY][1], list(range(5)))
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.batches[0]), 1)
+
+    def test_append(self):
+        self.exp.set(KEY, [], broadcast=True)
+        self.batcher.flush()
+        for i in range(12):
+            self.exp.append(KEY, [i])
+        self.assertEqual(len(self.batches), 2)
+        self.batcher.flush()
+        self.assertEqual(self.dataset_db.data[KEY][1],
+                         [[i] for i in range(12)])
+
+    def test_mutate(self):
+        self.exp.set(KEY, [0, 0], broadcast=True)
+        self.batcher.flush()
+        for i in range(5):
+            self.exp.mutate_dataset(KEY, 0, i)
+        self.exp.mutate_dataset(KEY, 1, 1)
+        self.batcher.flush()
+        self.assertEqual(self.dataset_db.data[KEY][1], [4, 1])
+        self.assertEqual(len(self.batches[1]), 2)
+
+    def test_set_copies_value(self):
+        value = [1, 1, 1]
+        self.exp.set("shot0", value, broadcast=True)
+        value[:] = [2, 2, 2]
+        self.exp.set("shot1", value, broadcast=True)
+        self.batcher.flush()
+        self.assertEqual(self.dataset_db.data["shot0"][1], [1, 1, 1])
+        self.assertEqual(self.dataset_db.data["shot1"][1], [2, 2, 2])
+
+    def test_failed_send(self):
+        send = self.batcher.send
+        def failing_send(mods):
+            raise OSError
+        self.batcher.send = failing_send
+        self.exp.set(KEY, [0], broadcast=True)
+        self.exp.append(KEY, 1)
+        with self.assertRaises(OSError):
+            self.batcher.flush()
+        self.batcher.send = send
+        self.batcher.flush()
+        self.assertEqual(self.dataset_db.data[KEY][1], [0, 1])
+
+    def test_delivered_when_idle(self):
+        delivered = threading.Event()
+        send = self.batcher.send
+        def send_and_notify(mods):
+            send(mods)
+            delivered.set()
+        self.batcher.send = send_and_notify
+        self.batcher.max_delay = 0.05
+        t0 = time.monotonic()
+        self.exp.set(KEY, [0], broadcast=True)
+        self.exp.append(KEY, 1)
+        self.assertTrue(delivered.wait(5))
+        self.assertGreaterEqual(time.monotonic() - t0, 0.05)
+        self.assertEqual(self.dataset_db.data[KEY][1], [0, 1])
+        self.assertEqual(len(self.batches), 1)
+
+    def test_set_supersedes(self):
+        self.exp.set(KEY, [0], broadcast=True)
+        self.batcher.flush()
+        self.exp.append(KEY, 1)
+        self.exp.set(KEY, 2, broadcast=True)
+        self.exp.set("bar", 3, broadcast=True)
+        self.exp.set(KEY, 4, broadcast=False)
+        self.batcher.flush()
+        self.assertEqual(self.batches[1],
+            [{"action": "setitem", "path": [], "key": "bar",
+              "value": (False, 3)},
+             {"action": "delitem", "path": [], "key": KEY}])
+        self.assertNotIn(KEY, self.dataset_db.data)
+
+
+class DatasetDBJournalCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.pyon")
+        pyon.store_file(self.persist_file,
+                        {"a": 1, "b": [2], "big": "y"*1000})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_journal(self):
+        db = DatasetDB(self.persist_file, journal=True)
+        mtime = os.stat(self.persist_file).st_mtime_ns
+        db.save_changes()
+        self.assertFalse(os.path.exists(db.journal_file))
+
+        db.set("a", 10)
+        db.update({"action": "append", "path": ["b", 1], "x": 3})
+        db.set("c", 4, persist=False)
+        db.delete("a")
+        db.set("d", "x"*100, persist=True)
+        db.save_changes()
+        self.assertTrue(os.path.exists(db.journal_file))
+        self.assertEqual(os.stat(self.persist_file).st_mtime_ns, mtime)
+
+        db = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(db.data.raw_view,
+                         {"b": (True, [2, 3]), "big": (True, "y"*1000),
+                          "d": (True, "x"*100)})
+
+        # The journal is folded into the persist file once it gets larger.
+        for i in range(100):
+            db.set("d", str(i)*100)
+            db.save_changes()
+            if not os.path.exists(db.journal_file):
+                break
+        else:
+            self.fail("journal was not compacted")
+        self.assertEqual(pyon.load_file(self.persist_file),
+                         {"b": [2, 3], "big": "y"*1000, "d": str(i)*100})
+
+    def test_corrupted_journal(self):
+        db = DatasetDB(self.persist_file, journal=True)
+        db.set("a", 10)
+        db.save_changes()
+        with open(db.journal_file, "a") as f:
+            f.write("{\"set\": {\"a\": 2")
+
+        db = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(db.get("a"), 10)
+        self.assertFalse(os.path.exists(db.journal_file))
+
+
+    def test_crash_during_compaction(self):
+        db = DatasetDB(self.persist_file, journal=True)
+        db.set("a", 10)
+        db.save_changes()
+        db.set("a", 11)
+        with mock.patch("os.remove", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                db.save()
+        self.assertTrue(os.path.exists(db.journal_file))
+
+        db = DatasetDB(self.persist_file, journal=True)
+        self.assertEqual(db.get("a"), 11)
+
+    def test_non_persistent_changes(self):
+        db = DatasetDB(self.persist_file)
+        mtime = os.stat(self.persist_file).st_mtime_ns
+        db.set("c", 4, persist=False)
+        db.update({"action": "setitem", "path": [], "key": "d",
+                   "value": (False, [5])})
+        db.update({"action": "append", "path": ["d", 1], "x": 3})
+        db.save_changes()
+        self.assertEqual(os.stat(self.persist_file).st_mtime_ns, mtime)
+
+        # A persistent dataset made non-persistent is removed from the file.
+        db.update({"action": "setitem", "path": [], "key": "a",
+                   "value": (False, 1)})
+        db.save_changes()
+        self.assertEqual(pyon.load_file(self.persist_file),
+                         {"b": [2], "big": "y"*1000})
+
+
+class DatasetDBArrayDeltaCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = DatasetDB(os.path.join(self.tmpdir.name, "dataset_db.pyon"))
+        self.mods = []
+        self.db.data.publish = self.mods.append
+        # A copy of the datasets kept up to date by the published mods, as
+        # on subscribers.
+        self.db.set("image", np.zeros((100, 100)))
+        self.subscriber = copy.deepcopy(self.db.data.raw_view)
+        del self.mods[:]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def update(self, value, persist=False):
+        self.db.update({"action": "setitem", "path": [], "key": "image",
+                        "value": (persist, value)})
+        for mod in self.mods:
+            process_mod(self.subscriber, copy.deepcopy(mod))
+        mods = self.mods[:]
+        del self.mods[:]
+        return mods
+
+    def test_array_delta(self):
+        image = np.zeros((100, 100))
+        image[10:12, 20] = 1
+        mods = self.update(image.copy())
+        self.assertEqual(mods, [{"action": "setitem", "path": ["image", 1],
+                                 "key": (slice(10, 12), slice(20, 21)),
+                                 "value": mods[0]["value"]}])
+        np.testing.assert_array_equal(mods[0]["value"], [[1], [1]])
+        np.testing.assert_array_equal(self.db.get("image"), image)
+        np.testing.assert_array_equal(self.subscriber["image"][1], image)
+
+        # unchanged
+        self.assertEqual(self.update(image.copy()), [])
+
+        # mostly changed, or changed type or persistence
+        for value, persist in ((np.ones((100, 100)), False),
+                               (np.ones((100, 100), dtype=np.int32), False),
+                               (np.ones((100, 100)), True)):
+            mods = self.update(value, persist)
+            self.assertEqual(len(mods), 1)
+            self.assertEqual(mods[0]["path"], [])
+            self.assertEqual(self.subscriber["image"][0], persist)
+            np.testing.assert_array_equal(self.subscriber["image"][1], value)
+
+
+class StreamedResultsCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "results.h5")
+        self.dataset_db = MockDatasetDB()
+        self.dataset_mgr = DatasetManager(self.dataset_db)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_file(self):
+        # The streamed file must match the file written at once.
+        with h5py.File(self.filename, "r") as f:
+            for group, datasets in (("datasets", self.dataset_mgr.local),
+                                    ("archive", self.dataset_mgr.archive)):
+                self.assertEqual(set(f[group].keys()), set(datasets.keys()))
+                for k, v in datasets.items():
+                    expected = np.asarray(v)
+                    written = f[group][k][()]
+                    if expected.dtype.kind == "U":
+                        written = written.astype(str)
+                    self.assertEqual(written.dtype, expected.dtype)
+                    np.testing.assert_array_equal(written, expected)
+            self.assertEqual(f["rid"][()], 1)
+
+    def test_stream(self):
+        self.exp.set("before", [1, 2])
+        self.dataset_db.data["db"] = (True, 3.0)
+        self.dataset_mgr.start_streaming(
+            HDF5StreamWriter(self.filename, "gzip"))
+        self.exp.set("counts", [])
+        for i in range(100):
+            self.exp.append("counts", i)
+        self.exp.set("image", np.zeros((4, 3)))
+        self.exp.mutate_dataset("image", 1, [1, 2, 3])
+        self.exp.mutate_dataset("image", (0, 4, 2), np.ones((2, 3)))
+        self.exp.append("before", 3)
+        self.exp.get_dataset("db", archive=True)
+        self.exp.set("scalar", 1.5)
+        self.exp.set("removed", [1])
+        self.exp.set("removed", 0, archive=False)
+        self.assertFalse(os.path.exists(self.filename))
+        self.dataset_mgr.finish_streaming({"rid": 1})
+        self.assertFalse(os.path.exists(self.filename + ".part"))
+        self.check_file()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["datasets/counts"].compression, "gzip")
+
+    def test_type_changes(self):
+        self.dataset_mgr.start_streaming(HDF5StreamWriter(self.filename))
+        self.exp.set("promoted", [1, 2])
+        self.exp.append("promoted", 2.5)
+        self.exp.set("strings", [])
+        self.exp.append("strings", "a")
+        self.exp.set("shrunk", [1, 2, 3])
+        self.exp.mutate_dataset("shrunk", (0, 2), [9])
+        self.exp.set("empty", [])
+        self.dataset_mgr.finish_streaming({"rid": 1})
+        self.check_file()
+
+    def test_in_place_change(self):
+        self.dataset_mgr.start_streaming(HDF5StreamWriter(self.filename))
+        value = np.zeros(4)
+        self.exp.set("modified", value)
+        counts = []
+        self.exp.set("counts", counts)
+        value[:] = 7
+        counts.append(1)
+        self.dataset_mgr.finish_streaming({"rid": 1})
+        self.check_file()
@@ -6,6 +6,7 @@ import tempfile
 from pathlib import Path
 
 from artiq.master.databases import DeviceDB
+from artiq.master.worker_db import DeviceManager
 from artiq.tools import file_import
 
 
@@ -116,3 +117,46 @@ device_db["core_log"] = {
         raw = file_import(self.ddb_file.name).device_db
 
         self.assertEqual(ddb, raw)
+
+
+class CountingDeviceDB:
+    def __init__(self, device_db):
+        self.device_db = device_db
+        self.requests = 0
+
+    def get(self, key, resolve_alias=False):
+        self.requests += 1
+        desc = self.device_db[key]
+        while resolve_alias and isinstance(desc, str):
+            desc = self.device_db[desc]
+        return desc
+
+
+class TestDeviceManager(unittest.TestCase):
+    def setUp(self):
+        self.ddb = CountingDeviceDB({
+            "dev": {"type": "dummy", "arguments": {"channel": [1, 2]}},
+            "dev_alias": "dev",
+            "same_dev": {"arguments": {"channel": [1, 2]}, "type": "dummy"},
+            "other_dev": {"type": "dummy", "arguments": {"channel": [3]}},
+        })
+        self.device_mgr = DeviceManager(self.ddb)
+
+    def tearDown(self):
+        self.device_mgr.close_devices()
+
+    def test_get(self):
+        dev = self.device_mgr.get("dev")
+        self.assertIs(self.device_mgr.get("dev"), dev)
+        self.assertIs(self.device_mgr.get("dev_alias"), dev)
+        self.assertIs(self.device_mgr.get("same_dev"), dev)
+        self.assertIsNot(self.device_mgr.get("other_dev"), dev)
+        self.assertEqual(len(self.device_mgr.active_devices), 2)
+        # One request per name
+        self.assertEqual(self.ddb.requests, 4)
+
+    def test_close_devices(self):
+        dev = self.device_mgr.get("dev")
+        self.device_mgr.close_devices()
+        self.assertIsNot(self.device_mgr.get("dev"), dev)
+        self.assertEqual(self.ddb.requests, 2)
@@ -0,0 +1,346 @@
+import asyncio
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+from artiq.master.experiments import (ExperimentDB, ExamineCache,
+                                      FilesystemBackend, GitBackend,
+                                      _RepoScanner)
+from artiq.master.worker import Worker
+
+
+_experiment_template = """
+from artiq.experiment import *
+
+class {name}(EnvExperiment):
+    def run(self):
+        pass
+"""
+
+_dataset_experiment = """
+from artiq.experiment import *
+
+class ExpB(EnvExperiment):
+    def build(self):
+        self.setattr_argument("x", NumberValue(self.get_dataset("default")))
+
+    def run(self):
+        pass
+"""
+
+
+class ExplistCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.repository = os.path.join(self.tmpdir.name, "repository")
+        os.mkdir(self.repository)
+        self.explist_cache = os.path.join(self.tmpdir.name, "explist.pyon")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def write_experiment(self, filename, name):
+        with open(os.path.join(self.repository, filename), "w") as f:
+            f.write(_experiment_template.format(name=name))
+
+    def create_db(self):
+        return ExperimentDB(FilesystemBackend(self.repository), dict(),
+                            explist_cache=self.explist_cache)
+
+    def test_explist_cache(self):
+        self.write_experiment("a.py", "ExpA")
+        experiment_db = self.create_db()
+        self.assertEqual(experiment_db.explist.raw_view, dict())
+        self.assertIsNone(experiment_db.status.raw_view["cached_rev"])
+        self.loop.run_until_complete(experiment_db.scan_repository())
+        experiment_db.close()
+        self.assertEqual(list(experiment_db.explist.raw_view.keys()),
+                         ["ExpA"])
+
+        # served from the cache before scanning
+        self.write_experiment("b.py", "ExpB")
+        experiment_db = self.create_db()
+        self.assertEqual(list(experiment_db.explist.raw_view.keys()),
+                         ["ExpA"])
+        self.assertEqual(experiment_db.status.raw_view["cached_rev"], "N/A")
+
+        mods = []
+        experiment_db.explist.publish = mods.append
+        statuses = []
+        experiment_db.status.publish = lambda mod: statuses.append(
+            dict(experiment_db.status.raw_view))
+        self.loop.run_until_complete(experiment_db.scan_repository())
+        experiment_db.close()
+        self.assertEqual(sorted(experiment_db.explist.raw_view.keys()),
+                         ["ExpA", "ExpB"])
+        self.assertEqual([(mod["action"], mod["key"]) for mod in mods],
+                         [("setitem", "ExpB")])
+        self.assertFalse(any(status["scanning"] for status in statuses))
+        self.assertIsNone(experiment_db.status.raw_view["cached_rev"])
+
+
+class RepoScannerCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.repository = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def write_experiment(self, filename, name, delay=0):
+        with open(os.path.join(self.repository, filename), "w") as f:
+            f.write(_experiment_template.format(name=name))
+            if delay:
+                f.write("\nimport time\ntime.sleep({})\n".format(delay))
+
+    def scan(self, max_workers):
+        scanner = _RepoScanner(dict(), max_workers)
+        return self.loop.run_until_complete(scanner.scan(self.repository))
+
+    def test_parallel_scan(self):
+        os.mkdir(os.path.join(self.repository, "sub"))
+        for filename in ["a.py", "b.py", "c.py", "d.py",
+                         os.path.join("sub", "e.py")]:
+            self.write_experiment(filename, "Exp")
+        files = []
+        _RepoScanner(dict())._list_files(self.repository, "", "", files)
+        # make the first file in traversal order the last to be examined
+        self.write_experiment(files[0][0], "Exp", delay=1)
+
+        expected = dict()
+        i = 0
+        for filename, prefix in files:
+            if prefix:
+                expected[prefix + "Exp"] = filename
+            else:
+                expected["Exp" + (str(i) if i else "")] = filename
+                i += 1
+        for max_workers in 1, 4:
+            explist = self.scan(max_workers)
+            self.assertEqual(list(explist.keys()), list(expected.keys()))
+            self.assertEqual({name: entry["file"]
+                              for name, entry in explist.items()}, expected)
+            self.assertTrue(all(entry["class_name"] == "Exp"
+                                for entry in explist.values()))
+
+
+class ExamineCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.repository = os.path.join(self.tmpdir.name, "repository")
+        os.mkdir(self.repository)
+        self.cache_file = os.path.join(self.tmpdir.name, "examine.pyon")
+        self.handlers = dict()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def write_experiment(self, filename, name):
+        with open(os.path.join(self.repository, filename), "w") as f:
+            f.write(_experiment_template.format(name=name))
+
+    def scan(self):
+        """Scans the repository with a fresh cache loaded from the file, and
+        returns the experiment list and the names of the examined files."""
+        examined = []
+        examine = Worker.examine
+
+        def examine_hook(worker, rid, file, *args, **kwargs):
+            examined.append(os.path.basename(file))
+            return examine(worker, rid, file, *args, **kwargs)
+
+        cache = ExamineCache(self.cache_file)
+        scanner = _RepoScanner(self.handlers, cache=cache)
+        with mock.patch.object(Worker, "examine", examine_hook):
+            explist = self.loop.run_until_complete(
+                scanner.scan(self.repository))
+        cache.save()
+        return explist, sorted(examined)
+
+    def test_hit(self):
+        self.write_experiment("a.py", "ExpA")
+        self.write_experiment("b.py", "ExpB")
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py", "b.py"])
+        self.assertEqual(sorted(explist.keys()), ["ExpA", "ExpB"])
+
+        cached_explist, examined = self.scan()
+        self.assertEqual(examined, [])
+        self.assertEqual(cached_explist, explist)
+
+        # entries are keyed by contents, not by file metadata
+        os.utime(os.path.join(self.repository, "a.py"))
+        _, examined = self.scan()
+        self.assertEqual(examined, [])
+
+    def test_invalidation(self):
+        self.write_experiment("a.py", "ExpA")
+        self.write_experiment("b.py", "ExpB")
+        self.scan()
+        path = os.path.join(self.repository, "a.py")
+
+        # same size and modification time, different contents
+        st = os.stat(path)
+        self.write_experiment("a.py", "ExpC")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+        self.assertEqual(sorted(explist.keys()), ["ExpB", "ExpC"])
+
+        # different size
+        self.write_experiment("a.py", "ExpLonger")
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+        self.assertEqual(sorted(explist.keys()), ["ExpB", "ExpLonger"])
+
+        # reverting to previous contents, whose entry was dropped
+        self.write_experiment("a.py", "ExpA")
+        _, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+
+    def test_device_db(self):
+        device_db = {"core": {"type": "local"}}
+        self.handlers["get_device_db"] = lambda: device_db
+        self.write_experiment("a.py", "ExpA")
+        self.scan()
+        _, examined = self.scan()
+        self.assertEqual(examined, [])
+
+        device_db["ttl0"] = {"type": "local"}
+        _, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+
+    def test_datasets(self):
+        datasets = {"default": 1.0}
+        self.handlers["get_dataset"] = datasets.__getitem__
+        self.write_experiment("a.py", "ExpA")
+        with open(os.path.join(self.repository, "b.py"), "w") as f:
+            f.write(_dataset_experiment)
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py", "b.py"])
+        self.assertEqual(
+            explist["ExpB"]["arginfo"]["x"][0]["default"], 1.0)
+
+        # b.py is examined again, with the current datasets
+        datasets["default"] = 2.0
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["b.py"])
+        self.assertEqual(
+            explist["ExpB"]["arginfo"]["x"][0]["default"], 2.0)
+
+    def test_corrupt_file(self):
+        self.write_experiment("a.py", "ExpA")
+        with open(self.cache_file, "w") as f:
+            f.write("{\"abc")
+        with self.assertLogs("artiq.master.experiments", "WARNING"):
+            explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+        self.assertEqual(list(explist.keys()), ["ExpA"])
+
+        # rewritten on save
+        _, examined = self.scan()
+        self.assertEqual(examined, [])
+
+    def test_missing_file(self):
+        self.write_experiment("a.py", "ExpA")
+        _, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        os.remove(self.cache_file)
+        explist, examined = self.scan()
+        self.assertEqual(examined, ["a.py"])
+        self.assertEqual(list(explist.keys()), ["ExpA"])
+
+
+@unittest.skipIf(pygit2 is None, "pygit2 not available")
+class GitObjectCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, "repository")
+        self.object_cache = os.path.join(self.tmpdir.name, "objects")
+        self.git = pygit2.init_repository(self.root)
+        self.revs = [self.commit({"a.py": "a = 1\n", "b.py": "b = 1\n"}),
+                     self.commit({"b.py": "b = 2\n"})]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def commit(self, files):
+        for name, contents in files.items():
+            with open(os.path.join(self.root, name), "w") as f:
+                f.write(contents)
+        index = self.git.index
+        index.add_all()
+        index.write()
+        signature = pygit2.Signature("test", "test@example.com")
+        parents = [] if self.git.head_is_unborn else [self.git.head.target]
+        return str(self.git.create_commit(
+            "HEAD", signature, signature, "commit", index.write_tree(),
+            parents))
+
+    def read(self, path, name):
+        with open(os.path.join(path, name)) as f:
+            return f.read()
+
+    def blobs(self):
+        return [os.path.join(directory, name)
+                for directory, _, names in os.walk(self.object_cache)
+                if os.path.basename(directory) != "checkouts"
+                and os.path.dirname(directory) == self.object_cache
+                for name in names]
+
+    def test_hits(self):
+        backend = GitBackend(self.root, self.object_cache)
+        path0, _ = backend.request_rev(self.revs[0])
+        path1, _ = backend.request_rev(self.revs[1])
+        self.assertEqual(os.path.dirname(path0),
+                         os.path.join(self.object_cache, "checkouts"))
+        self.assertEqual(self.read(path0, "b.py"), "b = 1\n")
+        self.assertEqual(self.read(path1, "b.py"), "b = 2\n")
+        # unchanged files are stored once
+        self.assertTrue(os.path.samefile(os.path.join(path0, "a.py"),
+                                         os.path.join(path1, "a.py")))
+        self.assertEqual(len(self.blobs()), 3)
+        backend.release_rev(self.revs[0])
+        backend.release_rev(self.revs[1])
+        self.assertFalse(os.path.exists(path0))
+        self.assertEqual(len(self.blobs()), 3)
+
+    def test_link_fallback(self):
+        backend = GitBackend(self.root, self.object_cache)
+        with mock.patch("os.link",
+                        side_effect=OSError(errno.EXDEV, "cross-device link")):
+            path, _ = backend.request_rev(self.revs[1])
+        self.assertEqual(self.read(path, "a.py"), "a = 1\n")
+        self.assertEqual(self.read(path, "b.py"), "b = 2\n")
+        self.assertEqual(os.stat(os.path.join(path, "a.py")).st_nlink, 1)
+        backend.release_rev(self.revs[1])
+
+    def test_eviction(self):
+        backend = GitBackend(self.root, self.object_cache,
+                             object_cache_max_size=0)
+        path0, _ = backend.request_rev(self.revs[0])
+        path1, _ = backend.request_rev(self.revs[1])
+        backend.release_rev(self.revs[0])
+        # only the blob of b.py at the first revision is unused
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(self.read(path1, "a.py"), "a = 1\n")
+        backend.release_rev(self.revs[1])
+        self.assertEqual(self.blobs(), [])
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import unittest
+
+from artiq.master.log import LogForwarder, LogHistory
+
+
+def _record(source, message, level=logging.INFO):
+    record = logging.LogRecord("test", level, __file__, 0, message,
+                               None, None)
+    record.source = source
+    return record
+
+
+class LogForwarderCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.batches = []
+        self.messages = []
+        self.forwarder = LogForwarder(flush_period=0.01, rate_limit=5,
+                                      history_size=8)
+        def callback(messages):
+            self.batches.append(messages)
+            self.messages.extend(messages)
+        self.forwarder.callback = callback
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_unstarted(self):
+        self.forwarder.emit(_record("master", "hello"))
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.messages), 1)
+        level, source, _, message = self.messages[0]
+        self.assertEqual((level, source, message),
+                         (logging.INFO, "master", "test:hello"))
+
+    def test_rate_limit(self):
+        loop = self.loop
+        self.forwarder.start()
+        for i in range(20):
+            self.forwarder.emit(_record("worker(1,x)", str(i)))
+        self.forwarder.emit(_record("master", "other"))
+        self.assertEqual(self.messages, [])
+        loop.run_until_complete(asyncio.sleep(0.05))
+        loop.run_until_complete(self.forwarder.stop())
+
+        # one batch per flush
+        self.assertEqual(len(self.batches), 1)
+        messages = [m[3] for m in self.messages]
+        self.assertEqual(messages[:6],
+                         ["test:" + str(i) for i in range(5)]
+                         + ["test:other"])
+        self.assertEqual(self.messages[6][:2],
+                         (logging.WARNING, "worker(1,x)"))
+        self.assertTrue(messages[6].endswith(":15 log messages suppressed"))
+        self.assertEqual(len(messages), 7)
+
+    def test_rate_limit_warnings(self):
+        loop = self.loop
+        self.forwarder.start()
+        for i in range(20):
+            self.forwarder.emit(_record("worker(1,x)", str(i)))
+            if i % 4 == 3:
+                self.forwarder.emit(_record("worker(1,x)", "w" + str(i),
+                                            logging.WARNING))
+        self.forwarder.emit(_record("worker(1,x)", "e", logging.ERROR))
+        loop.run_until_complete(asyncio.sleep(0.05))
+        loop.run_until_complete(self.forwarder.stop())
+
+        messages = [m[3] for m in self.messages]
+        self.assertEqual(messages[:-1],
+                         ["test:" + str(i) for i in range(4)]
+                         + ["test:w3", "test:4"]
+                         + ["test:w" + str(i) for i in range(7, 20, 4)]
+                         + ["test:e"])
+        self.assertTrue(messages[-1].endswith(":15 log messages suppressed"))
+
+    def test_history(self):
+        loop = self.loop
+        self.forwarder.start()
+        for i in range(4):
+            self.forwarder.emit(_record("source" + str(i), str(i)))
+        loop.run_until_complete(self.forwarder.stop())
+        for i in range(4, 10):
+            self.forwarder.emit(_record("master", str(i)))
+
+        history = LogHistory(self.forwarder).get_messages()
+        self.assertEqual([m[3] for m in history],
+                         ["test:" + str(i) for i in range(2, 10)])
+        self.assertEqual(history, self.messages[2:])
@@ -0,0 +1,154 @@
+import asyncio
+import copy
+import unittest
+
+from sipyco.sync_struct import Notifier, Subscriber
+
+from artiq.master.publisher import Publisher, batch_mods
+from artiq.tools import filtered_notifier_name
+
+
+test_address = "::1"
+test_port = 7780
+
+
+class PublisherCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_filtered_subscription(self):
+        loop = self.loop
+        notifier = Notifier({"a": 1, "b.x": 2, "b.y": 3, "c": [4]})
+        publisher = Publisher({"datasets": notifier})
+        loop.run_until_complete(publisher.start(test_address, test_port))
+
+        received = {"all": [], "filtered": []}
+        initialized = {"all": asyncio.Event(), "filtered": asyncio.Event()}
+        done = {"all": asyncio.Event(), "filtered": asyncio.Event()}
+        def subscriber(name):
+            def init(struct):
+                received[name].append(("init", copy.deepcopy(struct)))
+                initialized[name].set()
+                return struct
+            def mod(mod):
+                if mod["action"] != "init":
+                    received[name].append(mod)
+                if mod.get("key") == "end":
+                    done[name].set()
+            return init, mod
+        subscribers = [
+            Subscriber("datasets", *subscriber("all")),
+            Subscriber(
+                filtered_notifier_name("datasets", ["c", "end"], ["b."]),
+                *subscriber("filtered"))
+        ]
+        for s in subscribers:
+            loop.run_until_complete(s.connect(test_address, test_port))
+        for event in initialized.values():
+            loop.run_until_complete(event.wait())
+
+        notifier["a"] = 10
+        notifier["b.x"] = 20
+        notifier["c"].append(5)
+        del notifier["b.y"]
+        notifier["end"] = None
+        for event in done.values():
+            loop.run_until_complete(event.wait())
+
+        try:
+            self.assertEqual(received["filtered"], [
+                ("init", {"b.x": 2, "b.y": 3, "c": [4]}),
+                {"action": "setitem", "path": [], "key": "b.x", "value": 20},
+                {"action": "append", "path": ["c"], "x": 5},
+                {"action": "delitem", "path": [], "key": "b.y"},
+                {"action": "setitem", "path": [], "key": "end", "value": None}
+            ])
+            self.assertEqual(received["all"][0],
+                             ("init", {"a": 1, "b.x": 2, "b.y": 3,
+                                       "c": [4]}))
+            self.assertEqual(len(received["all"]), 6)
+        finally:
+            for s in subscribers:
+                loop.run_until_complete(s.close())
+            loop.run_until_complete(publisher.stop())
+
+    def test_rejected_subscription(self):
+        loop = self.loop
+        publisher = Publisher({"datasets": Notifier(dict())})
+        loop.run_until_complete(publisher.start(test_address, test_port))
+
+        # applets rely on rejected subscriptions being closed before any
+        # init is sent, to fall back to unfiltered ones
+        received = []
+        disconnected = asyncio.Event()
+        subscriber = Subscriber(filtered_notifier_name("unknown", ["a"]),
+                                received.append,
+                                disconnect_cb=disconnected.set)
+        loop.run_until_complete(subscriber.connect(test_address, test_port))
+        try:
+            loop.run_until_complete(
+                asyncio.wait_for(disconnected.wait(), 10))
+            self.assertEqual(received, [])
+        finally:
+            loop.run_until_complete(subscriber.close())
+            loop.run_until_complete(publisher.stop())
+
+    def test_batch(self):
+        loop = self.loop
+        notifier = Notifier({"a": [], "b": 0})
+        publisher = Publisher({"schedule": notifier})
+        loop.run_until_complete(publisher.start(test_address, test_port))
+
+        received = {"all": [], "filtered": []}
+        initialized = {"all": asyncio.Event(), "filtered": asyncio.Event()}
+        done = {"all": asyncio.Event(), "filtered": asyncio.Event()}
+        def subscriber(name):
+            def init(struct):
+                initialized[name].set()
+                return struct
+            def mod(mod):
+                if mod["action"] != "init":
+                    received[name].append(copy.deepcopy(mod))
+                if mod.get("key") == "end":
+                    done[name].set()
+            return init, mod
+        subscribers = [
+            Subscriber("schedule", *subscriber("all")),
+            Subscriber(filtered_notifier_name("schedule", ["a", "end"]),
+                       *subscriber("filtered"))
+        ]
+        for s in subscribers:
+            loop.run_until_complete(s.connect(test_address, test_port))
+        for event in initialized.values():
+            loop.run_until_complete(event.wait())
+
+        try:
+            queues = list(publisher._subscribers["schedule"].keys())
+            with batch_mods(notifier):
+                notifier["a"].append([1])
+                notifier["a"][0].append(2)
+                notifier["b"] = 3
+                notifier["end"] = None
+                self.assertTrue(all(queue.empty() for queue in queues))
+            # one message per subscriber
+            self.assertTrue(all(queue.qsize() == 1 for queue in queues))
+            for event in done.values():
+                loop.run_until_complete(event.wait())
+
+            self.assertEqual(received["all"], [
+                {"action": "append", "path": ["a"], "x": [1]},
+                {"action": "append", "path": ["a", 0], "x": 2},
+                {"action": "setitem", "path": [], "key": "b", "value": 3},
+                {"action": "setitem", "path": [], "key": "end",
+                 "value": None}
+            ])
+            self.assertEqual(received["filtered"],
+                             received["all"][:2] + received["all"][3:])
+        finally:
+            for s in subscribers:
+                loop.run_until_complete(s.close())
+            loop.run_until_complete(publisher.stop())
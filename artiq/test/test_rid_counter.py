@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from artiq.master.rid_counter import (RIDCounter, record_rid,
+                                      rid_index_filename)
+
+
+class RIDCounterCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.tmpdir.name, "last_rid.pyon")
+        self.results = os.path.join(self.tmpdir.name, "results")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_results(self, day, hour, rid):
+        path = os.path.join(self.results, day, hour)
+        os.makedirs(path, exist_ok=True)
+        open(os.path.join(path, "{:09}-Exp.h5".format(rid)), "w").close()
+
+    def create_counter(self):
+        return RIDCounter(self.cache, self.results)
+
+    def test_empty(self):
+        self.assertEqual(self.create_counter().get(), 0)
+
+    def test_scan_and_index(self):
+        self.add_results("2026-01-01", "10", 3)
+        self.add_results("2026-01-02", "09", 8)
+        self.add_results("2026-01-02", "11", 5)
+        self.assertEqual(self.create_counter().get(), 9)
+        with open(os.path.join(self.results, "2026-01-02",
+                               rid_index_filename)) as f:
+            self.assertEqual(f.read(), "8\n")
+        # older day folders are not needed
+        self.assertFalse(os.path.exists(os.path.join(
+            self.results, "2026-01-01", rid_index_filename)))
+
+        # results files are not listed again once indexed
+        os.remove(self.cache)
+        os.remove(os.path.join(self.results, "2026-01-02", "09",
+                               "000000008-Exp.h5"))
+        self.assertEqual(self.create_counter().get(), 9)
+
+    def test_newest_index(self):
+        for day, rids in ("2026-01-03", [41, 40]), ("2026-01-04", [43, 42]):
+            day_dir = os.path.join(self.results, day)
+            os.makedirs(day_dir)
+            for rid in rids:
+                record_rid(day_dir, rid)
+        # empty day folders are skipped
+        os.makedirs(os.path.join(self.results, "2026-01-05"))
+        self.assertEqual(self.create_counter().get(), 44)
+
+    def test_cache(self):
+        counter = self.create_counter()
+        self.assertEqual(counter.get(), 0)
+        # the results are not read when the cache is valid
+        day_dir = os.path.join(self.results, "2026-01-03")
+        os.makedirs(day_dir)
+        record_rid(day_dir, 41)
+        self.assertEqual(self.create_counter().get(), 1)
+
+        with open(self.cache, "w") as f:
+            f.write("4\x00")
+        self.assertEqual(self.create_counter().get(), 42)
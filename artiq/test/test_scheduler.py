@@ -4,8 +4,12 @@ import asyncio
 import sys
 from time import time, sleep
 
+from sipyco.sync_struct import Notifier
+
 from artiq.experiment import *
-from artiq.master.scheduler import Scheduler
+from artiq.master.scheduler import (Scheduler, RunPool, RunStatus,
+                                    PrepareStage, RunStage, AnalyzeStage)
+from artiq.master.worker import StickyWorkers, WorkerPool
 
 
 class EmptyExperiment(EnvExperiment):
@@ -30,6 +34,36 @@ class BackgroundExperiment(EnvExperiment):
                              broadcast=True, archive=False)
 
 
+class SlowPrepareExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def prepare(self):
+        sleep(1)
+
+    def run(self):
+        pass
+
+
+class FailingBuildExperiment(EnvExperiment):
+    def build(self):
+        raise ValueError("build failure")
+
+    def run(self):
+        pass
+
+
+class SlowAnalyzeExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+
+    def analyze(self):
+        sleep(1)
+
+
 class CheckPauseBackgroundExperiment(EnvExperiment):
     def build(self):
         self.setattr_device("scheduler")
@@ -122,6 +156,17 @@ class SchedulerCase(unittest.TestCase):
 
         loop.run_until_complete(done.wait())
         scheduler.notifier.publish = None
+
+        self.assertEqual(scheduler.timing.deleted_runs, 1)
+        for stage in ("queue_wait", "worker_spawn", "build", "prepare",
+                      "run_wait", "run", "analyze_wait", "analyze",
+                      "write_results"):
+            self.assertEqual(scheduler.timing.totals[stage][0], 1)
+        self.assertIn("artiq_run_stage_seconds_count{stage=\"build\"} 1\n",
+                      scheduler.get_metrics())
+        self.assertIn("artiq_runs{pipeline=\"main\",status=\"pending\"} 1\n",
+                      scheduler.get_metrics())
+
         loop.run_until_complete(scheduler.stop())
 
     def test_pending_priority(self):
@@ -424,5 +469,234 @@ class SchedulerCase(unittest.TestCase):
         loop.run_until_complete(done.wait())
         loop.run_until_complete(scheduler.stop())
 
+    def test_concurrent_prepare(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              max_concurrent_prepare=2)
+        expid = _get_expid("SlowPrepareExperiment")
+
+        statuses = []
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["path"] and mod["key"] == "status":
+                statuses.append((mod["path"][0], mod["value"]))
+            if mod["action"] == "delitem" and mod["key"] == 2:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        for i in range(3):
+            scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+        # RID 0 and 1 are prepared concurrently, then RID 2 is prepared
+        # once one of them has left the prepare stage.
+        first_done = min(statuses.index((0, "prepare_done")),
+                         statuses.index((1, "prepare_done")))
+        self.assertLess(statuses.index((1, "preparing")), first_done)
+        self.assertGreater(statuses.index((2, "preparing")), first_done)
+
+    def test_worker_pool(self):
+        loop = self.loop
+        worker_pool = WorkerPool(dict(), 1)
+        worker_pool.start()
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              worker_pool=worker_pool)
+        expid = _get_expid("EmptyExperiment")
+
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "delitem" and mod["key"] == 3:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        late = time() + 100000
+        for i in range(3):
+            scheduler.submit("main", expid, 0, late, False)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(asyncio.wait_for(done.wait(), 10))
+        # Runs that have not been built do not hold worker processes.
+        runs = scheduler._pipelines["main"].pool.runs
+        self.assertEqual(sorted(runs.keys()), [0, 1, 2])
+        for run in runs.values():
+            self.assertIsNone(run.worker.ipc)
+        self.assertLessEqual(len(worker_pool._idle), 1)
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+        loop.run_until_complete(worker_pool.stop())
+
+    def test_failed_build_then_queued(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None)
+
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "delitem" and mod["key"] == 1:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        # The run queued behind the failing one is still prepared once the
+        # latter is deleted.
+        scheduler.submit("main", _get_expid("FailingBuildExperiment"),
+                         0, None, False)
+        scheduler.submit("main", _get_expid("EmptyExperiment"),
+                         0, None, False)
+        loop.run_until_complete(asyncio.wait_for(done.wait(), 10))
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+    def test_sticky_workers(self):
+        loop = self.loop
+
+        class DeviceDB:
+            generation = 0
+        device_db = DeviceDB()
+        sticky_workers = StickyWorkers(1, device_db)
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              sticky_workers=sticky_workers)
+        expid = _get_expid("EmptyExperiment")
+
+        pids = dict()
+        deleted = dict()
+        def notify(mod):
+            if mod["path"] and mod["key"] == "status" \
+                    and mod["value"] == "running":
+                rid = mod["path"][0]
+                run = scheduler._pipelines["main"].pool.runs[rid]
+                pids[rid] = run.worker.ipc.process.pid
+            if mod["action"] == "delitem":
+                deleted[mod["key"]].set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        for rid in range(3):
+            if rid == 2:
+                device_db.generation += 1
+            deleted[rid] = asyncio.Event()
+            scheduler.submit("main", expid, 0, None, False)
+            loop.run_until_complete(deleted[rid].wait())
+            # Let the pipeline be garbage-collected before the next
+            # submission.
+            loop.run_until_complete(scheduler._deleter.join())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+        loop.run_until_complete(sticky_workers.stop())
+
+        # The process of RID 0 is reused by RID 1, but not after the device
+        # database has changed.
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_submit_batch(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None)
+        expids = [_get_expid("EmptyExperiment") for i in range(5)]
+
+        mods = []
+        done = asyncio.Event()
+        def notify(mod):
+            if not mod["path"]:
+                mods.append((mod["action"], mod["key"]))
+            if mod["action"] == "delitem" and mod["key"] == 4:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        rids = scheduler.submit_batch("main", expids, 0, None, False)
+        self.assertEqual(rids, list(range(5)))
+        # Only the new runs are published, not the whole schedule.
+        self.assertEqual(mods, [("setitem", rid) for rid in rids])
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+        self.assertEqual(mods[5:], [("delitem", rid) for rid in rids])
+
+    def test_concurrent_analyze(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None,
+                              max_concurrent_analyze=2)
+        expid = _get_expid("SlowAnalyzeExperiment")
+
+        statuses = []
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["path"] and mod["key"] == "status":
+                statuses.append((mod["path"][0], mod["value"]))
+            if mod["action"] == "delitem" and mod["key"] == 2:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        for i in range(3):
+            scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+        # Runs are still run one at a time, but RID 1 starts being analyzed
+        # while RID 0 is being analyzed.
+        self.assertLess(statuses.index((0, "run_done")),
+                        statuses.index((1, "running")))
+        self.assertLess(statuses.index((1, "analyzing")),
+                        statuses.index((0, "deleting")))
+
+    def test_slow_analyze_then_queued(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None)
+
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "delitem" and mod["key"] == 1:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start()
+        # The run that completes while another one is being analyzed is
+        # analyzed once the latter is deleted.
+        scheduler.submit("main", _get_expid("SlowAnalyzeExperiment"),
+                         0, None, False)
+        scheduler.submit("main", _get_expid("EmptyExperiment"),
+                         0, None, False)
+        loop.run_until_complete(asyncio.wait_for(done.wait(), 10))
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+    def test_selection_order(self):
+        loop = self.loop
+        pool = RunPool(_RIDCounter(0), dict(), Notifier(dict()), None)
+        delete = lambda rid: None
+        prepare = PrepareStage(pool, delete)
+        run_stage = RunStage(pool, delete)
+        analyze = AnalyzeStage(pool, delete)
+        expid = _get_expid("EmptyExperiment")
+
+        now = time()
+        for i in range(50):
+            due_date = None if i % 3 else now - i
+            pool.submit(expid, i % 5, due_date, False, "main")
+        # not yet due
+        pool.submit(expid, 10, now + 100000, False, "main")
+        expected = sorted((run for run in pool.runs.values()
+                           if run.rid != 50),
+                          key=lambda run: run.priority_key(), reverse=True)
+
+        for run in expected:
+            self.assertIs(prepare._get_run(), run)
+            run.status = RunStatus.preparing
+            run.status = RunStatus.prepare_done
+            self.assertIs(run_stage._get_run(), run)
+            run.status = RunStatus.running
+            run.status = RunStatus.run_done
+            self.assertIs(analyze._get_run(), run)
+            run.status = RunStatus.analyzing
+            run.status = RunStatus.deleting
+            loop.run_until_complete(pool.delete(run.rid))
+        self.assertIsInstance(prepare._get_run(), float)
+        self.assertEqual(list(pool.runs.keys()), [50])
+
     def tearDown(self):
         self.loop.close()
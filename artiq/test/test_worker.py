@@ -4,8 +4,11 @@ import asyncio
 import sys
 from time import sleep
 
+import numpy
+
 from artiq.experiment import *
 from artiq.master.worker import *
+from artiq.master import worker_ipc
 
 
 class SimpleExperiment(EnvExperiment):
@@ -101,5 +104,54 @@ class WorkerCase(unittest.TestCase):
         with self.assertRaises(WorkerWatchdogTimeout):
             _run_experiment("WatchdogTimeoutInBuild")
 
+    def test_pool(self):
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "SimpleExperiment",
+            "arguments": dict()
+        }
+        pool = WorkerPool({}, 1, ["numpy"])
+        pool.start()
+        try:
+            while not pool._idle:
+                self.loop.run_until_complete(asyncio.sleep(0.1))
+            worker = pool.get()
+            self.assertIsNotNone(worker.ipc)
+            self.assertIsNone(pool.get())
+            self.loop.run_until_complete(_call_worker(worker, expid))
+        finally:
+            self.loop.run_until_complete(pool.stop())
+
+    def test_binary_framing(self):
+        obj = {
+            "action": "update_dataset",
+            "args": ({"action": "setitem", "key": "x", "path": [],
+                      "value": (True, numpy.arange(12.).reshape(3, 4))},),
+            "kwargs": {"l": [numpy.array(3, dtype=numpy.int32), "s", 1.5],
+                       "e": numpy.zeros((0, 2)),
+                       "o": numpy.array([None, 1], dtype=object)}
+        }
+        data = b"".join(bytes(d) for d in worker_ipc.encode_frame(obj))
+        self.assertEqual(data[:1], worker_ipc.FRAME_MARKER)
+        pos = 1
+        def read_exactly(n):
+            nonlocal pos
+            pos += n
+            return data[pos-n:pos]
+        decoded = worker_ipc.read_frame(read_exactly)
+        self.assertEqual(pos, len(data))
+
+        value = decoded["args"][0]["value"][1]
+        self.assertEqual(value.dtype, numpy.float64)
+        numpy.testing.assert_array_equal(value, obj["args"][0]["value"][1])
+        value[0, 0] = 1.0  # decoded arrays are writable
+        l = decoded["kwargs"]["l"]
+        self.assertEqual(l[0].shape, ())
+        self.assertEqual(l[0].dtype, numpy.int32)
+        self.assertEqual(l[1:], ["s", 1.5])
+        self.assertEqual(decoded["kwargs"]["e"].shape, (0, 2))
+        self.assertEqual(list(decoded["kwargs"]["o"]), [None, 1])
+
     def tearDown(self):
         self.loop.close()
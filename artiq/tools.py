@@ -20,7 +20,8 @@ from artiq.language.environment import is_public_experiment
 __all__ = ["parse_arguments", "elide", "short_format", "file_import",
            "get_experiment",
            "exc_to_warning", "asyncio_wait_or_cancel",
-           "get_windows_drives", "get_user_config_dir"]
+           "get_windows_drives", "get_user_config_dir",
+           "filtered_notifier_name", "parse_notifier_name"]
 
 
 logger = logging.getLogger(__name__)
@@ -147,3 +148,30 @@ def get_user_config_dir():
     dir = user_config_dir("artiq", "m-labs", major)
     os.makedirs(dir, exist_ok=True)
     return dir
+
+
+_notifier_filter_separator = "?"
+
+
+def filtered_notifier_name(notifier_name, keys=(), prefixes=()):
+    """Returns the name under which to subscribe to ``notifier_name`` on the
+    master to receive only the top-level keys listed in ``keys`` or starting
+    with one of ``prefixes``.
+
+    Masters that do not support filtered subscriptions close the connection
+    without sending anything."""
+    return notifier_name + _notifier_filter_separator + pyon.encode({
+        "keys": sorted(keys),
+        "prefixes": sorted(prefixes)
+    })
+
+
+def parse_notifier_name(name):
+    """Splits a name returned by :func:`filtered_notifier_name` (or a plain
+    notifier name) into the notifier name, and the lists of keys and of
+    prefixes, or ``None`` if the name is not filtered."""
+    if _notifier_filter_separator not in name:
+        return name, None
+    name, spec = name.split(_notifier_filter_separator, 1)
+    spec = pyon.decode(spec)
+    return name, (list(spec["keys"]), list(spec["prefixes"]))